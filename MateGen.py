@@ -1,6 +1,18 @@
+import copy
 from chatmessage import ChatMessages
+from compaction import ConversationCompactor
+from retrieval import DocumentIndex
+from tokenizer import get_prompt_budget
+from turnstate import TurnRecord, MAX_TURN_STEPS
+from responsecache import ResponseCache
+from parallelcalls import add_parallel_function
+from debugsampling import DEFAULT_DEBUG_CANDIDATES
+from tracing import Trace, TraceMetrics, append_trace
+from budget import BudgetGovernor
+from toolresult import DEFAULT_RESULT_TOKENS
 from IPython.display import display, Code, Markdown
 from response import *
+from asyncresponse import async_get_chat_response, aask
 
 
 class MateGen():
@@ -12,7 +24,27 @@ class MateGen():
                  messages=None,
                  available_functions=None,
                  is_enhanced_mode=False,
-                 is_developer_mode=False):
+                 is_developer_mode=False,
+                 is_streaming_mode=False,
+                 is_compaction_mode=False,
+                 is_retrieval_mode=False,
+                 retrieval_top_k=3,
+                 reserved_completion_tokens=None,
+                 max_turn_steps=MAX_TURN_STEPS,
+                 is_cache_mode=False,
+                 cache_path="mategen_cache.sqlite",
+                 is_parallel_tools_mode=False,
+                 is_fast_debug_mode=False,
+                 debug_candidates=DEFAULT_DEBUG_CANDIDATES,
+                 interaction_policy=None,
+                 output_sink=None,
+                 namespace=None,
+                 is_tracing_mode=False,
+                 trace_path=None,
+                 session_budget=None,
+                 turn_budget=None,
+                 fallback_model='gpt-3.5-turbo-0613',
+                 max_tool_result_tokens=DEFAULT_RESULT_TOKENS):
         """
         'api_key': Required parameter, representing the string key necessary to call the OpenAI model. There is no default value; users must set this before using MateGen.
         'model': Optional parameter, representing the type of Chat model currently selected. The default is gpt-3.5-turbo-0613. For information on which models are available for the current OpenAI account, refer to the official limit link: OpenAI Account Limits.
@@ -23,29 +55,70 @@ class MateGen():
         'is_enhanced_mode': Optional parameter, indicating whether the current conversation is in enhanced mode. Enhanced mode will automatically enable complex task decomposition processes and deep debugging functions, which will require more computation time and cost but will improve overall Agent performance. 
         'is_developer_mode': Optional parameter, indicating whether the current conversation is in developer mode. In developer mode, the model will first confirm with the user whether the text or code is correct before choosing to save or execute it. 
          This can greatly enhance model usability for developers, but it is not recommended for beginners. The default is False.
+        'is_streaming_mode': Optional parameter, indicating whether the model's responses are streamed. In streaming mode, the text is rendered as it arrives
+         and the time to the first token of each turn is recorded in self.turn_timings. The default is False.
+        'is_compaction_mode': Optional parameter, indicating whether the earliest turns are folded into a running summary once the conversation reaches a high-water mark of tokens_thr,
+         instead of being dropped. The summary is written in the background between turns. The default is False.
+        'is_retrieval_mode': Optional parameter, indicating whether the external documents in system_content_list are chunked and indexed locally with BM25 instead of being sent whole.
+         Each turn then only sends the retrieval_top_k chunks most relevant to the current question as system messages. The default is False.
+        'retrieval_top_k': Optional parameter, the number of document chunks sent with each question in retrieval mode. The default is 3.
+        'reserved_completion_tokens': Optional parameter, the number of tokens of the context window kept free for the model's reply. The default is None, meaning an eighth of the context window, at least 1000 tokens.
+        'max_turn_steps': Optional parameter, the maximum number of steps (model calls, reviews and external function calls) of a single turn. A turn reaching it is stopped.
+         The steps of the latest turn are recorded in self.last_turn_record. The default is MAX_TURN_STEPS.
+        'is_cache_mode': Optional parameter, indicating whether the responses of the model are cached by request. A question asked again with the same conversation, functions and model
+         is then answered from the cache without calling the model. The hit rate and the saved latency and tokens are returned by cache_report(). The default is False.
+        'cache_path': Optional parameter, the SQLite file of the response cache, shared by the sessions using the same file. The default is mategen_cache.sqlite.
+        'is_parallel_tools_mode': Optional parameter, indicating whether the model can ask for several external function calls in one step through the multi_function_call function,
+         e.g. loading four tables with extract_data. Independent calls run at the same time in a thread pool, calls using a variable created by an earlier call wait for it,
+         and all results are returned to the model together. The default is False.
+        'is_fast_debug_mode': Optional parameter, indicating whether a failed external function call is first debugged by requesting debug_candidates candidate fixes at once.
+         The candidates run in parallel, each in a copy of the namespace, and the first one running without error is accepted; the debug agent is only used if all of them fail.
+         The time to a working fix of each debug run is recorded and compared with the sequential debug agent by debug_report(). The default is False.
+        'debug_candidates': Optional parameter, the number of candidate fixes requested in fast debug mode. The default is DEFAULT_DEBUG_CANDIDATES.
+        'interaction_policy': Optional parameter, an InteractionPolicy object taking the decisions that need a human: approving code in developer mode, reviewing answers and task decompositions,
+         handling connection errors and asking for the next question of a multi-round conversation. The default is None, meaning the console prompts of DEFAULT_INTERACTION_POLICY.
+         With AutoPolicy the conversation runs unattended, e.g. in a worker serving a queue of questions.
+        'output_sink': Optional parameter, the sink receiving the output of the conversation: NotebookSink, TextSink, JSONSink or SilentSink. The default is None, meaning NotebookSink.
+        'namespace': Optional parameter, the dictionary in which the external functions create the variables of the conversation, e.g. the tables loaded by extract_data.
+         The default is None, meaning the globals of the response module, shared by every MateGen object of the process.
+        'is_tracing_mode': Optional parameter, indicating whether each turn is traced: spans around each model call, external function call, tool and debug round
+         record the wall time, the prompt and completion tokens and the payload sizes. The trace of the latest turn is kept in self.last_trace, and all spans are aggregated
+         into counters and histograms returned in the Prometheus text format by metrics_text(). The default is False.
+        'trace_path': Optional parameter, a JSONL file to which the spans of each traced turn are appended. The default is None, meaning the traces are not written.
+        'session_budget': Optional parameter, a Budget object limiting the tokens, model calls, wall time and cost of all turns of the session together.
+         As a budget runs low, enhanced mode is turned off, then the model calls use fallback_model, and the turn stops once the budget is used up.
+         The live usage is returned by usage_report(). The default is None, meaning no session budget.
+        'turn_budget': Optional parameter, a Budget object limiting each turn in the same way. The default is None, meaning no turn budget.
+        'fallback_model': Optional parameter, the cheaper model used once a budget runs low. The default is gpt-3.5-turbo-0613.
+        'max_tool_result_tokens': Optional parameter, the maximum number of tokens of the result of an external function kept in the messages. DataFrames are summarized
+         (shape, dtypes, first and last rows, summary statistics), long collections and SQL results are truncated with their counts, and a longer result is cut in the middle.
+         The default is DEFAULT_RESULT_TOKENS, None meaning no limit.
         """
 
         self.api_key = api_key
         self.model = model
         self.project = project
         self.system_content_list = system_content_list
-        tokens_thr = None
-
-        # calculate tokens_thr
-        if '1106' in model:
-            tokens_thr = 110000
-        elif '16k' in model:
-            tokens_thr = 12000
-        elif '4-0613' in model:
-            tokens_thr = 7000
-        else:
-            tokens_thr = 3000
+        self.reserved_completion_tokens = reserved_completion_tokens
+
+        # in parallel tools mode, add the multi_function_call function before the function definitions are counted
+        if is_parallel_tools_mode:
+            available_functions = add_parallel_function(available_functions)
+
+        # calculate tokens_thr from the context window of the model, the reserved completion budget and the function definitions
+        functions = available_functions.functions if available_functions is not None else None
+        tokens_thr = get_prompt_budget(model, functions=functions, reserved_completion_tokens=reserved_completion_tokens)
 
         self.tokens_thr = tokens_thr
 
+        # in retrieval mode, the documents are indexed and only the relevant chunks are sent with each question
+        self.retrieval_top_k = retrieval_top_k
+        self.document_index = DocumentIndex(system_content_list) if is_retrieval_mode else None
+
         # create self.messages
-        self.messages = ChatMessages(system_content_list=system_content_list,
-                                     tokens_thr=tokens_thr)
+        self.messages = ChatMessages(system_content_list=self.initial_system_content_list(),
+                                     tokens_thr=tokens_thr,
+                                     model=model)
 
         # if the initial messages is not none, add it to the self.messages
         if messages != None:
@@ -54,52 +127,284 @@ class MateGen():
         self.available_functions = available_functions
         self.is_enhanced_mode = is_enhanced_mode
         self.is_developer_mode = is_developer_mode
+        self.is_streaming_mode = is_streaming_mode
+        # time to the first token and number of streamed model calls of each turn
+        self.turn_timings = []
+        # step budget and step record of the latest turn
+        self.max_turn_steps = max_turn_steps
+        self.last_turn_record = None
+
+        # number of candidate fixes requested at once in fast debug mode, and the time to a working fix of each debug run
+        self.debug_candidates = debug_candidates if is_fast_debug_mode else 0
+        self.debug_timings = []
+
+        # interaction policy taking the decisions of the conversation and output sink receiving its output
+        self.interaction_policy = interaction_policy if interaction_policy is not None else DEFAULT_INTERACTION_POLICY
+        self.output_sink = output_sink if output_sink is not None else DEFAULT_OUTPUT_SINK
+        self.namespace = namespace
+        # maximum number of tokens of the result of an external function
+        self.max_tool_result_tokens = max_tool_result_tokens
+
+        # trace of the latest turn, and the metrics aggregated over the traced turns
+        self.metrics = TraceMetrics() if is_tracing_mode else None
+        self.trace_path = trace_path
+        self.last_trace = None
+
+        # governor enforcing the session and turn budgets, with the live usage counters of the session
+        if session_budget is not None or turn_budget is not None:
+            self.budget_governor = BudgetGovernor(session_budget=session_budget, turn_budget=turn_budget, fallback_model=fallback_model)
+        else:
+            self.budget_governor = None
+
+        # create the response cache, an LRU in memory backed by SQLite on disk
+        self.response_cache = ResponseCache(path=cache_path) if is_cache_mode else None
 
-    def chat(self, question=None):
+        # create the compactor which summarizes the earliest turns in the background
+        self.compactor = self.new_compactor() if is_compaction_mode else None
+
+    def chat(self, question=None, bypass_cache=False):
         """
         The MateGen class's main method supports both single-round and multi-round conversation modes. When the user does not input a question, multi-round conversation mode is enabled; otherwise, single-round conversation mode is activated. 
         Regardless of whether single-round or multi-round conversation mode is enabled, the conversation results will be saved in self.messages, making it convenient for future use.
+        In cache mode, bypass_cache=True asks the model again instead of answering from the cache, the new answers replace the cached ones.
+        """
+        head_str = "▌ Model set to %s" % self.model
+        self.output_sink.markdown(head_str)
+
+        if question != None:
+            self.apply_compaction()
+            self.messages.messages_append({"role": "user", "content": question})
+            timings_count = self.begin_turn()
+            self.messages = get_chat_response(**self.turn_arguments(bypass_cache))
+            self.end_turn(timings_count)
+
+        else:
+            while True:
+                timings_count = self.begin_turn()
+                self.messages = get_chat_response(**self.turn_arguments(bypass_cache))
+                self.end_turn(timings_count)
+
+                user_input = self.interaction_policy.next_question()
+                if user_input is None:
+                    break
+                else:
+                    self.apply_compaction()
+                    self.messages.messages_append({"role": "user", "content": user_input})
+
+    async def achat(self, question=None, bypass_cache=False):
+        """
+        Asynchronous counterpart of chat, running the conversation with async_get_chat_response. Model calls are awaited and the external functions run in a thread pool,
+        so one process can serve many MateGen sessions concurrently, e.g. await asyncio.gather(mg1.achat(q1), mg2.achat(q2)).
         """
         head_str = "▌ Model set to %s" % self.model
-        display(Markdown(head_str))
+        self.output_sink.markdown(head_str)
 
         if question != None:
+            self.apply_compaction()
             self.messages.messages_append({"role": "user", "content": question})
-            self.messages = get_chat_response(model=self.model,
-                                              messages=self.messages,
-                                              available_functions=self.available_functions,
-                                              is_developer_mode=self.is_developer_mode,
-                                              is_enhanced_mode=self.is_enhanced_mode)
+            timings_count = self.begin_turn()
+            self.messages = await async_get_chat_response(**self.turn_arguments(bypass_cache))
+            self.end_turn(timings_count)
 
         else:
             while True:
-                self.messages = get_chat_response(model=self.model,
-                                                  messages=self.messages,
-                                                  available_functions=self.available_functions,
-                                                  is_developer_mode=self.is_developer_mode,
-                                                  is_enhanced_mode=self.is_enhanced_mode)
-
-                user_input = input(" Do you have any other questions? (Enter 'exit' to end the conversation) ")
-                if user_input == "exit":
+                timings_count = self.begin_turn()
+                self.messages = await async_get_chat_response(**self.turn_arguments(bypass_cache))
+                self.end_turn(timings_count)
+
+                user_input = await aask(self.interaction_policy.next_question)
+                if user_input is None:
                     break
                 else:
+                    self.apply_compaction()
                     self.messages.messages_append({"role": "user", "content": user_input})
 
+    def begin_turn(self):
+        """
+        prepare a new turn after the question was appended: retrieve the system messages, and create the record and the trace of the turn.
+        return the number of response timings before the turn
+        """
+        self.retrieve_system_messages()
+        self.last_turn_record = TurnRecord(max_steps=self.max_turn_steps)
+        self.last_trace = Trace(model=self.model) if self.metrics is not None else None
+        if self.budget_governor is not None:
+            self.budget_governor.start_turn()
+        return len(self.messages.response_timings)
+
+    def turn_arguments(self, bypass_cache=False):
+        """
+        return the keyword arguments of get_chat_response and async_get_chat_response for the current turn
+        """
+        return {"model": self.model,
+                "messages": self.messages,
+                "available_functions": self.available_functions,
+                "is_developer_mode": self.is_developer_mode,
+                "is_enhanced_mode": self.is_enhanced_mode,
+                "is_streaming_mode": self.is_streaming_mode,
+                "turn_record": self.last_turn_record,
+                "response_cache": self.response_cache,
+                "bypass_cache": bypass_cache,
+                "debug_candidates": self.debug_candidates,
+                "interaction_policy": self.interaction_policy,
+                "output_sink": self.output_sink,
+                "namespace": self.namespace,
+                "trace": self.last_trace,
+                "budget_governor": self.budget_governor,
+                "max_result_tokens": self.max_tool_result_tokens}
+
+    def end_turn(self, timings_count):
+        """
+        record the statistics and the trace of the turn that just finished, and start the background compaction
+        """
+        self.record_turn_timing(timings_count)
+        self.debug_timings.extend(self.last_turn_record.debug_timings)
+        if self.budget_governor is not None:
+            self.budget_governor.end_turn()
+        if self.last_trace is not None:
+            self.metrics.observe(self.last_trace)
+            if self.trace_path is not None:
+                append_trace(self.trace_path, self.last_trace)
+        self.schedule_compaction()
+
+    def initial_system_content_list(self):
+        """
+        return the system messages the conversation starts with: the whole documents, or none in retrieval mode
+        """
+        if self.document_index is not None:
+            return []
+        return self.system_content_list
+
+    def retrieve_system_messages(self):
+        """
+        in retrieval mode, replace the system messages with the document chunks most relevant to the latest user question, called before a question is sent
+        """
+        if self.document_index is None or not self.messages.history_messages:
+            return
+        question = self.messages.history_messages[-1].get("content") or ''
+        chunks = self.document_index.search(question, top_k=self.retrieval_top_k)
+        self.messages.delete_system_messages()
+        if chunks:
+            self.messages.add_system_messages(chunks)
+
+    def record_turn_timing(self, timings_count):
+        """
+        record the time to the first token of the turn that just finished, from the streamed responses timed after timings_count
+        """
+        if not self.is_streaming_mode or self.messages is None:
+            return
+        timings = self.messages.response_timings[timings_count:]
+        if timings:
+            self.turn_timings.append({"time_to_first_token": timings[0]["time_to_first_token"],
+                                      "model_calls": len(timings),
+                                      "total_time": sum(timing["total_time"] for timing in timings)})
+
+    def new_compactor(self):
+        """
+        create the compactor of the session: its summaries use the output sink, the budget governor and the tracing of the session
+        """
+        return ConversationCompactor(model=self.model,
+                                     output_sink=self.output_sink,
+                                     budget_governor=self.budget_governor,
+                                     metrics=self.metrics,
+                                     trace_path=self.trace_path)
+
+    def schedule_compaction(self):
+        """
+        start summarizing the earliest turns in the background once the conversation reaches the high-water mark, called after a turn is answered
+        """
+        if self.compactor is not None and self.messages is not None:
+            self.compactor.schedule(self.messages)
+
+    def apply_compaction(self):
+        """
+        fold the summarized turns into the running summary message if the background summary is finished, called before a question is sent
+        """
+        if self.compactor is not None and self.messages is not None:
+            self.compactor.apply(self.messages)
+
+    def compaction_report(self):
+        """
+        return the compaction statistics of the current session: summaries written, tokens saved and tool re-executions avoided
+        """
+        if self.compactor is None:
+            return None
+        return dict(self.compactor.stats)
+
+    def cache_report(self):
+        """
+        return the response cache statistics of the current session: hits, misses, hit rate, and the latency and tokens saved by the hits
+        """
+        if self.response_cache is None:
+            return None
+        return self.response_cache.report()
+
+    def debug_report(self):
+        """
+        return the debug statistics of the current session by debug mode: debug runs, working fixes and the mean wall-clock time to a working fix,
+        so that fast debug ("parallel") can be compared with the sequential debug agent ("sequential")
+        """
+        report = {}
+        for timing in self.debug_timings:
+            stats = report.setdefault(timing["mode"], {"runs": 0, "fixed": 0, "total_time_to_fix": 0.0})
+            stats["runs"] += 1
+            if timing["fixed"]:
+                stats["fixed"] += 1
+                stats["total_time_to_fix"] += timing["time_to_fix"]
+        for stats in report.values():
+            stats["mean_time_to_fix"] = stats["total_time_to_fix"] / stats["fixed"] if stats["fixed"] else None
+        return report
+
+    def fork(self, namespace=None, interaction_policy=None, output_sink=None):
+        """
+        create a new session with the configuration of this one: it shares the model, the external functions, the document index and the response cache,
+        and starts from a copy of the current messages with its own namespace and statistics. Creating a session this way does not count the tokens of the documents again.
+        """
+        session = copy.copy(self)
+        session.messages = self.messages.copy()
+        session.namespace = namespace
+        session.interaction_policy = interaction_policy if interaction_policy is not None else self.interaction_policy
+        session.output_sink = output_sink if output_sink is not None else self.output_sink
+        session.turn_timings = []
+        session.debug_timings = []
+        session.last_turn_record = None
+        session.last_trace = None
+        session.budget_governor = self.budget_governor.new_session() if self.budget_governor is not None else None
+        session.compactor = session.new_compactor() if self.compactor is not None else None
+        return session
+
+    def usage_report(self):
+        """
+        return the live usage of the session and of the current turn (tokens, model calls, wall time and estimated cost) with the budgets and the degradation level
+        """
+        if self.budget_governor is None:
+            return None
+        return self.budget_governor.report()
+
+    def metrics_text(self):
+        """
+        return the span counters and histograms of the traced turns in the Prometheus text format
+        """
+        if self.metrics is None:
+            return None
+        return self.metrics.to_prometheus()
+
     def reset(self):
         """
         reset the messages
         """
-        self.messages = ChatMessages(system_content_list=self.system_content_list)
+        self.messages = ChatMessages(system_content_list=self.initial_system_content_list(),
+                                     tokens_thr=self.tokens_thr,
+                                     model=self.model)
 
     def upload_messages(self):
         """
         upload the current messages to project file 
         """
         if self.project == None:
-            print("You need to first input the project parameter (which needs to be an InterProject object) before uploading messages.")
+            self.output_sink.text("You need to first input the project parameter (which needs to be an InterProject object) before uploading messages.", ERROR)
             return None
         else:
-            self.project.append_doc_content(content=self.messages.history_messages)
+            self.project.append_doc_content(content=[message.to_dict() for message in self.messages.history_messages])
 
 if __name__ == '__main__':
     print("this file contains the MateGen class")
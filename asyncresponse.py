@@ -0,0 +1,129 @@
+import asyncio
+from response import gpt_response_steps, chat_response_steps
+from turnstate import MAX_TURN_STEPS
+from effects import arun_steps
+from toolresult import DEFAULT_RESULT_TOKENS
+
+
+async def aask(decide, *args):
+    """
+    Take a decision of an interaction policy in a worker thread, since the default policy waits for input().
+    :param decide: Required parameter, a method of an InteractionPolicy object, e.g. policy.review_code.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, decide, *args)
+
+
+async def async_get_gpt_response(model,
+                                 messages,
+                                 available_functions=None,
+                                 is_developer_mode=False,
+                                 is_enhanced_mode=False,
+                                 is_streaming_mode=False,
+                                 response_cache=None,
+                                 bypass_cache=False,
+                                 interaction_policy=None,
+                                 output_sink=None,
+                                 trace=None,
+                                 budget_governor=None):
+    """
+    Asynchronous counterpart of `get_gpt_response`, running the same steps (response.gpt_response_steps) with effects.arun_steps:
+    the Chat model is called with openai.ChatCompletion.acreate, the response cache is read and written in a worker thread,
+    and waiting after a connection error does not block the event loop.
+    :param model: Required parameter indicating the name of the large model to be called.
+    :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
+    :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.
+    :param is_developer_mode: Indicates whether developer mode is enabled, default is False.
+    :param is_enhanced_mode: Optional parameter indicating whether enhanced mode is enabled, default is False.
+    :param is_streaming_mode: Optional parameter indicating whether streaming mode is enabled, default is False.
+    :param response_cache: Optional parameter, a ResponseCache object answering repeated requests without calling the model.
+    :param bypass_cache: Optional parameter, if True the cache is not looked up, the new response is still stored. Default is False.
+    :param interaction_policy: Optional parameter, an InteractionPolicy object, defaults to DEFAULT_INTERACTION_POLICY.
+    :param output_sink: Optional parameter, an output sink receiving the output, defaults to DEFAULT_OUTPUT_SINK.
+    :param trace: Optional parameter, a Trace object in which the call is recorded as a model_call span. Defaults to None, indicating no tracing.
+    :param budget_governor: Optional parameter, a BudgetGovernor object checked before each attempt. Defaults to None, indicating no budget.
+    :return: Returns the response message from the model.
+    """
+    return await arun_steps(gpt_response_steps(model,
+                                               messages,
+                                               available_functions=available_functions,
+                                               is_developer_mode=is_developer_mode,
+                                               is_enhanced_mode=is_enhanced_mode,
+                                               is_streaming_mode=is_streaming_mode,
+                                               response_cache=response_cache,
+                                               bypass_cache=bypass_cache,
+                                               interaction_policy=interaction_policy,
+                                               output_sink=output_sink,
+                                               trace=trace,
+                                               budget_governor=budget_governor))
+
+
+async def async_get_chat_response(model,
+                                  messages,
+                                  available_functions=None,
+                                  is_developer_mode=False,
+                                  is_enhanced_mode=False,
+                                  is_streaming_mode=False,
+                                  delete_some_messages=False,
+                                  is_task_decomposition=False,
+                                  max_steps=MAX_TURN_STEPS,
+                                  turn_record=None,
+                                  response_cache=None,
+                                  bypass_cache=False,
+                                  debug_candidates=0,
+                                  interaction_policy=None,
+                                  output_sink=None,
+                                  namespace=None,
+                                  trace=None,
+                                  budget_governor=None,
+                                  max_result_tokens=DEFAULT_RESULT_TOKENS):
+    """
+    Asynchronous counterpart of `get_chat_response`, executing a complete conversation session without blocking the event loop.
+    The session loop and its steps are those of get_chat_response (response.chat_response_steps), run with effects.arun_steps:
+    model calls and rate limiter waits are awaited, while the external functions run in TOOL_EXECUTOR and the response cache is used in a worker thread.
+    Many sessions can therefore be served concurrently by one process, e.g. with asyncio.gather over several MateGen.achat calls.
+    :param model: Required parameter indicating the name of the large model to be called.
+    :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
+    :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.
+    :param is_developer_mode: Indicates whether developer mode is enabled, default is False.
+    :param is_enhanced_mode: Optional parameter indicating whether enhanced mode is enabled, default is False.
+    :param is_streaming_mode: Optional parameter indicating whether streaming mode is enabled, default is False.
+    :param delete_some_messages: Optional parameter indicating whether to delete several intermediate messages when concatenating messages, default is False.
+    :param is_task_decomposition: Optional parameter indicating whether the current task is task decomposition review, default is False.
+    :param max_steps: Optional parameter, the maximum number of steps of the session, default is MAX_TURN_STEPS.
+    :param turn_record: Optional parameter, a TurnRecord object in which the steps of the session are recorded for inspection.
+    :param response_cache: Optional parameter, a ResponseCache object answering repeated requests without calling the model.
+    :param bypass_cache: Optional parameter, if True the cache is not looked up during this session. Default is False.
+    :param debug_candidates: Optional parameter, the number of candidate fixes requested at once when an external function fails (fast debug mode). Default is 0.
+    :param interaction_policy: Optional parameter, an InteractionPolicy object taking the decisions of the session, defaults to DEFAULT_INTERACTION_POLICY.\
+    The decisions are taken in a worker thread, so a console prompt does not block the other sessions.
+    :param output_sink: Optional parameter, an output sink receiving the output of the session, defaults to DEFAULT_OUTPUT_SINK.
+    :param namespace: Optional parameter, the dictionary in which the external functions of the session create their variables, defaults to the globals of the response module.
+    :param trace: Optional parameter, a Trace object in which the session is recorded, defaults to None, indicating no tracing.
+    :param budget_governor: Optional parameter, a BudgetGovernor object enforcing the budgets of the session and the turn, defaults to None, indicating no budget.
+    :param max_result_tokens: Optional parameter, the maximum number of tokens of the result of an external function, defaults to DEFAULT_RESULT_TOKENS, None for no limit.
+    :return: Messages concatenating the final results of this Q&A session.
+    """
+    return await arun_steps(chat_response_steps(model,
+                                                messages,
+                                                available_functions=available_functions,
+                                                is_developer_mode=is_developer_mode,
+                                                is_enhanced_mode=is_enhanced_mode,
+                                                is_streaming_mode=is_streaming_mode,
+                                                delete_some_messages=delete_some_messages,
+                                                is_task_decomposition=is_task_decomposition,
+                                                max_steps=max_steps,
+                                                turn_record=turn_record,
+                                                response_cache=response_cache,
+                                                bypass_cache=bypass_cache,
+                                                debug_candidates=debug_candidates,
+                                                interaction_policy=interaction_policy,
+                                                output_sink=output_sink,
+                                                namespace=namespace,
+                                                trace=trace,
+                                                budget_governor=budget_governor,
+                                                max_result_tokens=max_result_tokens))
+
+
+if __name__ == '__main__':
+    print("this file contains the asynchronous functions to get responses from llm")
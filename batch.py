@@ -0,0 +1,214 @@
+import os
+import csv
+import json
+import time
+import types
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import response
+from turnstate import STATE_RESPOND
+from interaction import AutoPolicy
+from outputsink import JSONSink, SilentSink
+
+# Default number of questions answered at the same time
+DEFAULT_BATCH_WORKERS = 4
+
+
+def session_namespace():
+    """
+    Create the namespace of one batch session: the modules and functions the external functions find in the globals of the response module (pd, np, plt, ...),
+    without the tables and variables created by other sessions.
+    """
+    namespace = {"__builtins__": __builtins__}
+    for name, value in vars(response).items():
+        if isinstance(value, types.ModuleType) or callable(value):
+            namespace[name] = value
+    return namespace
+
+
+def load_questions(path):
+    """
+    Read the questions of a batch from a JSONL or a CSV file.
+    A JSONL line is either a string or an object with a "question" key and an optional "id" key, a CSV file has a "question" column and an optional "id" column.
+    Questions without an id are numbered by their position in the file.
+    :param path: Required parameter, the path of the .jsonl or .csv file.
+    :return: A list of dictionaries with the "id" and the "question" of each question.
+    """
+    questions = []
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if path.lower().endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    for index, row in enumerate(rows):
+        if isinstance(row, str):
+            row = {"question": row}
+        question_id = row.get("id")
+        questions.append({"id": str(question_id) if question_id not in (None, '') else str(index),
+                          "question": row["question"]})
+    return questions
+
+
+def read_results(path):
+    """
+    Read the results already written to a JSONL results file, keeping the latest result of each question.
+    A line cut off by a crash is removed from the file, so that new results are appended after the last complete line.
+    :return: A dictionary of the results by question id.
+    """
+    results = {}
+    if not os.path.exists(path):
+        return results
+
+    valid_size = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b'\n'):
+                break
+            results[result["id"]] = result
+            valid_size += len(line)
+
+    if valid_size < os.path.getsize(path):
+        with open(path, 'r+b') as f:
+            f.truncate(valid_size)
+    return results
+
+
+def stage_latencies(turn_record):
+    """
+    Sum the durations of the steps of a turn by state, e.g. the time spent waiting for the model (respond) and running external functions (review_code).
+    """
+    stages = {}
+    for step in turn_record:
+        stages[step.state] = stages.get(step.state, 0.0) + step.duration
+    return stages
+
+
+class BatchRunner():
+    """
+    The BatchRunner class answers a file of questions with a pool of worker threads, each question in its own session forked from one MateGen object:
+    a copy of its messages, an isolated namespace, AutoPolicy instead of the console prompts, and a silent or JSON output sink.
+    The sessions share the tokenizer encoders, the document index, the response cache, the rate limiter and the database connection pool of the process.
+    Each result is appended to a JSONL file as soon as its question is answered, with the answer, the token usage and the latency of each stage;
+    running the batch again skips the questions already answered, so a batch stopped by a crash resumes where it stopped.
+    """
+
+    def __init__(self,
+                 mategen,
+                 results_path,
+                 workers=DEFAULT_BATCH_WORKERS,
+                 retry_errors=True,
+                 keep_events=False):
+        """
+        :param mategen: Required parameter, the MateGen object whose configuration and messages every session starts from.
+        :param results_path: Required parameter, the JSONL file to which the results are appended.
+        :param workers: Optional parameter, the number of questions answered at the same time.
+        :param retry_errors: Optional parameter, whether questions that failed in an earlier run are asked again when the batch resumes. Default is True.
+        :param keep_events: Optional parameter, whether the output of each session (code, debug and status messages) is recorded in its result. Default is False.
+        """
+        self.mategen = mategen
+        self.results_path = results_path
+        self.workers = workers
+        self.retry_errors = retry_errors
+        self.keep_events = keep_events
+        self._lock = threading.Lock()
+        # Statistics of the current run
+        self.stats = {"questions": 0, "skipped": 0, "answered": 0, "errors": 0, "elapsed": 0.0}
+
+    def pending_questions(self, questions):
+        """
+        Return the questions that have no result yet, or only a failed result if retry_errors is True.
+        """
+        results = read_results(self.results_path)
+        pending = []
+        for question in questions:
+            result = results.get(question["id"])
+            if result is None or (self.retry_errors and result["status"] == "error"):
+                pending.append(question)
+        return pending
+
+    def run(self, questions):
+        """
+        Answer the questions that have no result yet.
+        :param questions: Required parameter, a list of dictionaries with the "id" and the "question" of each question, or the path of a JSONL or CSV file.
+        :return: The statistics of the run.
+        """
+        if isinstance(questions, str):
+            questions = load_questions(questions)
+        pending = self.pending_questions(questions)
+        self.stats = {"questions": len(questions), "skipped": len(questions) - len(pending), "answered": 0, "errors": 0, "elapsed": 0.0}
+
+        # Each session in enhanced mode sends at most one speculative task decomposition request at a time
+        if self.workers > response.SPECULATION_WORKERS:
+            response.configure_speculation(self.workers)
+
+        start_time = time.perf_counter()
+        with open(self.results_path, 'a', encoding='utf-8') as results_file:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="mategen-batch") as executor:
+                futures = [executor.submit(self.answer, question) for question in pending]
+                for future in as_completed(futures):
+                    self.write_result(results_file, future.result())
+        self.stats["elapsed"] = time.perf_counter() - start_time
+        return self.stats
+
+    def answer(self, question):
+        """
+        Answer one question in a new session, and return its result. An exception of the session is returned as a failed result.
+        """
+        sink = JSONSink() if self.keep_events else SilentSink()
+        session = self.mategen.fork(namespace=session_namespace(), interaction_policy=AutoPolicy(), output_sink=sink)
+        result = {"id": question["id"], "question": question["question"], "started_at": time.time()}
+
+        start_time = time.perf_counter()
+        try:
+            session.chat(question["question"])
+            last_message = session.messages.history_messages[-1]
+            record = session.last_turn_record
+            result["status"] = "stopped" if record.stopped else "ok"
+            result["answer"] = last_message.get("content") if last_message.get("role") == "assistant" else None
+            result["steps"] = len(record)
+            result["model_calls"] = sum(1 for step in record if step.state == STATE_RESPOND)
+            result["prompt_tokens"] = sum(step.tokens_count for step in record if step.state == STATE_RESPOND)
+            result["completion_tokens"] = last_message.tokens_count if result["answer"] is not None else 0
+            result["stages"] = stage_latencies(record)
+            result["debug_timings"] = session.debug_timings
+        except Exception as e:
+            result["status"] = "error"
+            result["error"] = "%s: %s" % (type(e).__name__, e)
+            result["traceback"] = traceback.format_exc()
+        result["latency"] = time.perf_counter() - start_time
+
+        if self.keep_events:
+            result["events"] = sink.events
+        return result
+
+    def write_result(self, results_file, result):
+        # One complete line per result, flushed at once so that a crash loses at most the questions still running
+        with self._lock:
+            results_file.write(json.dumps(result, ensure_ascii=False, default=str) + '\n')
+            results_file.flush()
+            self.stats["errors" if result["status"] == "error" else "answered"] += 1
+
+
+def run_batch(mategen, questions_path, results_path, workers=DEFAULT_BATCH_WORKERS, retry_errors=True, keep_events=False):
+    """
+    Answer the questions of a JSONL or CSV file with a pool of workers and append the results to a JSONL file, resuming a stopped batch.
+    :param mategen: Required parameter, the MateGen object whose configuration every session uses.
+    :param questions_path: Required parameter, the JSONL or CSV file of the questions.
+    :param results_path: Required parameter, the JSONL file of the results.
+    :param workers: Optional parameter, the number of questions answered at the same time.
+    :param retry_errors: Optional parameter, whether failed questions are asked again when the batch resumes.
+    :param keep_events: Optional parameter, whether the output of each session is recorded in its result.
+    :return: The statistics of the run.
+    """
+    runner = BatchRunner(mategen, results_path, workers=workers, retry_errors=retry_errors, keep_events=keep_events)
+    return runner.run(questions_path)
+
+
+if __name__ == '__main__':
+    print("this file contains the batch runner answering a file of questions with a pool of workers")
@@ -0,0 +1,172 @@
+import os
+import time
+import tempfile
+import tracemalloc
+from chatmessage import ChatMessages
+from standinserver import StandinServer, ToolLoopResponses
+from batch import BatchRunner
+from benchmarks import baseline_chatmessage
+
+
+def build_history(n_messages=500, system_content_list=[], tokens_thr=None, chat_messages_class=ChatMessages):
+    """
+    Create a ChatMessages object with a long conversation history, used as the input of the benchmarks.
+    :param n_messages: Number of history messages to create, alternating user questions and SQL-like results.
+    :param system_content_list: External documents used as system messages.
+    :param tokens_thr: Maximum token count threshold of the ChatMessages object.
+    :param chat_messages_class: The class of the object, ChatMessages or the ChatMessages class of benchmarks.baseline_chatmessage.
+    :return: A ChatMessages object with n_messages history messages.
+    """
+    msg = chat_messages_class(system_content_list=list(system_content_list), question='Hello', tokens_thr=tokens_thr)
+    for i in range(n_messages - 1):
+        if i % 2 == 0:
+            msg.messages_append({"role": "user", "content": "How many records are there in user_demographics for tenure %d?" % i})
+        else:
+            msg.messages_append({"role": "function", "name": "sql_inter", "content": str([[i, "Female", 0, "Yes", "No"]] * 20)})
+    return msg
+
+
+def benchmark_token_cache(n_messages=500, rounds=50, baseline=baseline_chatmessage):
+    """
+    Compare the cached token accounting of ChatMessages with the previous ChatMessages, which re-encoded messages on every
+    copy, pop and system message change. Both run the same copy / add / delete / pop rounds on the same conversation.
+    :param n_messages: Number of history messages of the benchmarked conversation.
+    :param rounds: Number of copy / add / delete / pop rounds to time.
+    :param baseline: Optional parameter, the module of the previous implementation. Defaults to benchmarks.baseline_chatmessage.
+    :return: A dictionary with the elapsed seconds of both implementations and the speedup.
+    """
+    with open('telco_data_dictionary.md', 'r', encoding='utf-8') as f:
+        data_dictionary = f.read()
+
+    def measure(msg):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            new_msg = msg.copy()
+            new_msg.add_system_messages(data_dictionary)
+            new_msg.delete_system_messages()
+            new_msg.messages_pop(manual=True, index=0)
+        return time.perf_counter() - start
+
+    # Previous implementation: every operation re-encodes the content it touches
+    reencode_time = measure(build_history(n_messages=n_messages, system_content_list=[data_dictionary], chat_messages_class=baseline.ChatMessages))
+    # Current implementation: token counts are cached per message and updated by arithmetic
+    cached_time = measure(build_history(n_messages=n_messages, system_content_list=[data_dictionary]))
+
+    result = {"messages": n_messages,
+              "rounds": rounds,
+              "reencode_seconds": reencode_time,
+              "cached_seconds": cached_time,
+              "speedup": reencode_time / cached_time if cached_time > 0 else float('inf')}
+    print("Token cache benchmark: %s" % result)
+    return result
+
+
+def benchmark_copy_memory(n_tokens=100000, copies=20, baseline=baseline_chatmessage):
+    """
+    Compare the time and memory of ChatMessages.copy(), which forks a structurally shared history,
+    with the copy() of the previous ChatMessages, which deep-copied both history_messages and messages on every copy.
+    :param n_tokens: Approximate size of the copied conversation in tokens.
+    :param copies: Number of copies kept alive at the same time, like the debug and task decomposition agents do.
+    :param baseline: Optional parameter, the module of the previous implementation. Defaults to benchmarks.baseline_chatmessage.
+    :return: A dictionary with the elapsed seconds and allocated bytes of both implementations.
+    """
+    def build(chat_messages_class):
+        msg = build_history(n_messages=2, system_content_list=["You are a data analyst."], chat_messages_class=chat_messages_class)
+        while msg.tokens_count < n_tokens:
+            msg.messages_append({"role": "function", "name": "sql_inter", "content": str([["7590-VHVEG", "Female", 0, "Yes", "No"]] * 50)})
+        return msg
+
+    def measure(msg):
+        tracemalloc.start()
+        start = time.perf_counter()
+        kept = [msg.copy() for _ in range(copies)]
+        elapsed = time.perf_counter() - start
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del kept
+        return elapsed, allocated
+
+    # Previous implementation: deep copy of history_messages and of the combined messages list
+    deepcopy_time, deepcopy_bytes = measure(build(baseline.ChatMessages))
+    # Current implementation: O(1) fork of the shared history
+    msg = build(ChatMessages)
+    fork_time, fork_bytes = measure(msg)
+
+    result = {"tokens": msg.tokens_count,
+              "messages": len(msg.history_messages),
+              "copies": copies,
+              "deepcopy_seconds": deepcopy_time,
+              "deepcopy_bytes": deepcopy_bytes,
+              "fork_seconds": fork_time,
+              "fork_bytes": fork_bytes}
+    print("Copy memory benchmark: %s" % result)
+    return result
+
+
+def benchmark_message_memory(n_messages=10000, baseline=baseline_chatmessage):
+    """
+    Compare the memory of a session stored as Message records with the previous ChatMessages, where every message dict was kept
+    in both the messages and history_messages lists. Both implementations build the same conversation of n_messages messages.
+    :param n_messages: Number of messages of the session.
+    :param baseline: Optional parameter, the module of the previous implementation. Defaults to benchmarks.baseline_chatmessage.
+    :return: A dictionary with the allocated bytes of both implementations.
+    """
+    system_content_list = ["You are a data analyst."]
+
+    def measure(chat_messages_class):
+        # A first small session loads the encoder, which is not part of the storage of the messages
+        build_history(n_messages=2, system_content_list=system_content_list, chat_messages_class=chat_messages_class)
+        tracemalloc.start()
+        kept = build_history(n_messages=n_messages, system_content_list=system_content_list, chat_messages_class=chat_messages_class)
+        allocated = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del kept
+        return allocated
+
+    dict_bytes = measure(baseline.ChatMessages)
+    record_bytes = measure(ChatMessages)
+    result = {"messages": n_messages,
+              "dict_bytes": dict_bytes,
+              "record_bytes": record_bytes,
+              "bytes_saved_per_message": (dict_bytes - record_bytes) / n_messages}
+    print("Message memory benchmark: %s" % result)
+    return result
+
+
+def benchmark_throughput(mategen, n_questions=100, workers_list=(1, 4, 16), latency=0.5, jitter=0.1, responses=None, **server_options):
+    """
+    Measure the throughput of the whole MateGen loop offline: a batch of questions is answered against a local StandinServer,
+    once for each number of workers. Each question takes one external function call and two model calls unless other responses are given.
+    :param mategen: Required parameter, the MateGen object whose configuration the sessions use, e.g. MateGen(api_key, available_functions=af).
+    :param n_questions: Number of questions of each batch.
+    :param workers_list: Numbers of workers to compare.
+    :param latency: Mean latency of the stand-in model, in seconds.
+    :param jitter: Variation of the latency, in seconds.
+    :param responses: Responses of the stand-in server, defaults to ToolLoopResponses().
+    :param server_options: Other StandinServer parameters, e.g. rate_limit_rate=0.05.
+    :return: A list of dictionaries with the questions per second and the mean latency of each number of workers.
+    """
+    questions = [{"id": str(i), "question": "Question %d: how many users have a tenure of %d months?" % (i, i)} for i in range(n_questions)]
+    results = []
+    with StandinServer(responses=responses if responses is not None else ToolLoopResponses(),
+                       latency=latency, jitter=jitter, **server_options) as server:
+        for workers in workers_list:
+            with tempfile.TemporaryDirectory() as directory:
+                runner = BatchRunner(mategen, os.path.join(directory, "results.jsonl"), workers=workers)
+                stats = runner.run(questions)
+            result = {"workers": workers,
+                      "questions": n_questions,
+                      "answered": stats["answered"],
+                      "errors": stats["errors"],
+                      "elapsed": stats["elapsed"],
+                      "questions_per_second": n_questions / stats["elapsed"] if stats["elapsed"] > 0 else float('inf')}
+            print("Throughput benchmark: %s" % result)
+            results.append(result)
+        print("Stand-in server: %s" % server.stats)
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_token_cache()
+    benchmark_copy_memory()
+    benchmark_message_memory()
@@ -0,0 +1,220 @@
+import time
+import threading
+
+# Price of the Chat models in US dollars per 1000 prompt and completion tokens
+# Model names are matched by their longest registered prefix, like MODEL_REGISTRY of tokenizer.py
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+    "gpt-3.5-turbo-1106": (0.001, 0.002),
+    "gpt-3.5-turbo-0125": (0.0005, 0.0015),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-4-1106": (0.01, 0.03),
+    "gpt-4-0125": (0.01, 0.03),
+    "gpt-4-turbo": (0.01, 0.03),
+    "gpt-4o": (0.005, 0.015),
+}
+
+# Price used for models missing from MODEL_PRICES
+DEFAULT_MODEL_PRICE = (0.03, 0.06)
+
+# Degradation levels of the governor, each one including the previous ones
+LEVEL_NORMAL = 0
+# Enhanced mode (task decomposition and deep debug) is turned off
+LEVEL_NO_ENHANCED = 1
+# The model calls use the fallback model
+LEVEL_FALLBACK_MODEL = 2
+# No more model calls are made
+LEVEL_STOPPED = 3
+
+LEVEL_NAMES = {LEVEL_NORMAL: "normal",
+               LEVEL_NO_ENHANCED: "no_enhanced",
+               LEVEL_FALLBACK_MODEL: "fallback_model",
+               LEVEL_STOPPED: "stopped"}
+
+
+def get_model_price(model):
+    """
+    Return the (prompt, completion) price per 1000 tokens of a model, found by the longest registered prefix of the model name.
+    """
+    best_prefix = None
+    for prefix in MODEL_PRICES:
+        if model.startswith(prefix) and (best_prefix is None or len(prefix) > len(best_prefix)):
+            best_prefix = prefix
+    if best_prefix is None:
+        return DEFAULT_MODEL_PRICE
+    return MODEL_PRICES[best_prefix]
+
+
+def call_cost(model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = get_model_price(model)
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+class Budget():
+    """
+    The Budget class holds the limits of a session or of a turn. A limit set to None is not enforced.
+    """
+
+    def __init__(self, max_tokens=None, max_model_calls=None, max_seconds=None, max_cost=None):
+        """
+        :param max_tokens: Optional parameter, the maximum number of prompt and completion tokens.
+        :param max_model_calls: Optional parameter, the maximum number of model calls.
+        :param max_seconds: Optional parameter, the maximum wall-clock time spent answering, in seconds.
+        :param max_cost: Optional parameter, the maximum cost of the model calls in US dollars, estimated with MODEL_PRICES.
+        """
+        self.max_tokens = max_tokens
+        self.max_model_calls = max_model_calls
+        self.max_seconds = max_seconds
+        self.max_cost = max_cost
+
+    def fraction_used(self, usage, seconds, prompt_tokens=0):
+        """
+        Return the largest fraction of a limit used, counting the prompt_tokens of the next call.
+        """
+        fractions = [0.0]
+        if self.max_tokens:
+            fractions.append((usage["tokens"] + prompt_tokens) / self.max_tokens)
+        if self.max_model_calls:
+            fractions.append(usage["model_calls"] / self.max_model_calls)
+        if self.max_seconds:
+            fractions.append(seconds / self.max_seconds)
+        if self.max_cost:
+            fractions.append(usage["cost"] / self.max_cost)
+        return max(fractions)
+
+    def to_dict(self):
+        return {"max_tokens": self.max_tokens,
+                "max_model_calls": self.max_model_calls,
+                "max_seconds": self.max_seconds,
+                "max_cost": self.max_cost}
+
+
+def new_usage():
+    return {"tokens": 0, "prompt_tokens": 0, "completion_tokens": 0, "model_calls": 0, "cost": 0.0}
+
+
+class BudgetGovernor():
+    """
+    The BudgetGovernor class enforces the budgets of a session and of its current turn on tokens, model calls, wall-clock time and cost.
+    Before each model call, get_gpt_response asks the governor for the degradation level, which rises with the largest fraction of a budget used:
+    from no_enhanced_at, enhanced mode is turned off; from fallback_at, the calls use the cheaper fallback_model; at the limit, no more calls are made and the turn stops.
+    The usage counters are updated after each call and can be read while a turn runs, from several threads.
+    """
+
+    def __init__(self,
+                 session_budget=None,
+                 turn_budget=None,
+                 fallback_model="gpt-3.5-turbo-0613",
+                 no_enhanced_at=0.5,
+                 fallback_at=0.8):
+        """
+        :param session_budget: Optional parameter, a Budget object limiting all turns of the session together.
+        :param turn_budget: Optional parameter, a Budget object limiting each turn.
+        :param fallback_model: Optional parameter, the cheaper model used once a budget reaches fallback_at.
+        :param no_enhanced_at: Optional parameter, the fraction of a budget from which enhanced mode is turned off.
+        :param fallback_at: Optional parameter, the fraction of a budget from which the fallback model is used.
+        """
+        self.session_budget = session_budget if session_budget is not None else Budget()
+        self.turn_budget = turn_budget if turn_budget is not None else Budget()
+        self.fallback_model = fallback_model
+        self.no_enhanced_at = no_enhanced_at
+        self.fallback_at = fallback_at
+        self._lock = threading.Lock()
+        self.session_usage = new_usage()
+        self.turn_usage = new_usage()
+        # Wall-clock time of the finished turns, and start of the current turn
+        self.session_seconds = 0.0
+        self._turn_start = None
+        # Highest degradation level reached in the current turn, and the number of turns degraded or stopped
+        self.turn_level = LEVEL_NORMAL
+        self.degraded_turns = 0
+        self.stopped_turns = 0
+
+    def new_session(self):
+        """
+        Return a governor with the same budgets and no usage, for another session.
+        """
+        return BudgetGovernor(session_budget=self.session_budget,
+                              turn_budget=self.turn_budget,
+                              fallback_model=self.fallback_model,
+                              no_enhanced_at=self.no_enhanced_at,
+                              fallback_at=self.fallback_at)
+
+    def start_turn(self):
+        with self._lock:
+            self.turn_usage = new_usage()
+            self.turn_level = LEVEL_NORMAL
+            self._turn_start = time.perf_counter()
+
+    def end_turn(self):
+        with self._lock:
+            if self._turn_start is not None:
+                self.session_seconds += time.perf_counter() - self._turn_start
+                self._turn_start = None
+            if self.turn_level == LEVEL_STOPPED:
+                self.stopped_turns += 1
+            elif self.turn_level > LEVEL_NORMAL:
+                self.degraded_turns += 1
+
+    def _turn_seconds(self):
+        return time.perf_counter() - self._turn_start if self._turn_start is not None else 0.0
+
+    def level(self, prompt_tokens=0):
+        """
+        Return the degradation level for the next model call, counting its prompt_tokens.
+        """
+        with self._lock:
+            turn_seconds = self._turn_seconds()
+            fraction = max(self.session_budget.fraction_used(self.session_usage, self.session_seconds + turn_seconds, prompt_tokens),
+                           self.turn_budget.fraction_used(self.turn_usage, turn_seconds, prompt_tokens))
+            if fraction >= 1:
+                level = LEVEL_STOPPED
+            elif fraction >= self.fallback_at:
+                level = LEVEL_FALLBACK_MODEL
+            elif fraction >= self.no_enhanced_at:
+                level = LEVEL_NO_ENHANCED
+            else:
+                level = LEVEL_NORMAL
+            self.turn_level = max(self.turn_level, level)
+            return level
+
+    def model_for(self, model, level):
+        """
+        Return the model of the next call at a degradation level.
+        """
+        if level >= LEVEL_FALLBACK_MODEL and self.fallback_model:
+            return self.fallback_model
+        return model
+
+    def record_call(self, model, prompt_tokens, completion_tokens):
+        """
+        Count a model call and its tokens in the usage of the session and of the turn.
+        """
+        cost = call_cost(model, prompt_tokens, completion_tokens)
+        with self._lock:
+            for usage in (self.session_usage, self.turn_usage):
+                usage["tokens"] += prompt_tokens + completion_tokens
+                usage["prompt_tokens"] += prompt_tokens
+                usage["completion_tokens"] += completion_tokens
+                usage["model_calls"] += 1
+                usage["cost"] += cost
+
+    def report(self):
+        """
+        Return the live usage of the session and of the current turn, with the budgets and the current degradation level.
+        """
+        with self._lock:
+            turn_seconds = self._turn_seconds()
+            return {"session": dict(self.session_usage, seconds=self.session_seconds + turn_seconds),
+                    "turn": dict(self.turn_usage, seconds=turn_seconds),
+                    "session_budget": self.session_budget.to_dict(),
+                    "turn_budget": self.turn_budget.to_dict(),
+                    "turn_level": LEVEL_NAMES[self.turn_level],
+                    "degraded_turns": self.degraded_turns,
+                    "stopped_turns": self.stopped_turns}
+
+
+if __name__ == '__main__':
+    print("this file contains the token and cost budget governor of the agent")
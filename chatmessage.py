@@ -1,6 +1,180 @@
-import tiktoken
 import openai
 import copy
+import sys
+import threading
+from tokenizer import get_encoding, count_message_tokens
+
+
+class MessageLog():
+    """
+    The MessageLog class is a persistent, structurally shared sequence used by ChatMessages to store historical messages.
+    A MessageLog is a window [start, end) over a backing list that may be shared by several forks. Forking is O(1): the new log points to the same backing list.
+    Appending at the tip of the backing list and evicting the earliest item only move the window, so forks keep sharing their common prefix.
+    Any other write (appending behind another fork, replacing or deleting an item) first copies the window into a new backing list, i.e. copy on write.
+    Forks used by different threads, e.g. the sessions of a batch forked from one MateGen, append under the lock of their backing list,
+    so that only one of them appends at the tip and the others copy their window.
+    """
+
+    def __init__(self, items=()):
+        # Backing list, possibly shared with other forks
+        self._items = list(items)
+        # Window of the backing list that belongs to this log
+        self._start = 0
+        self._end = len(self._items)
+        # Whether the backing list may be shared with another fork
+        self._shared = False
+        # Lock of the backing list, shared by the forks using it
+        self._lock = threading.Lock()
+
+    def fork(self):
+        # Create a new log sharing the same backing list, without copying any item
+        new_log = MessageLog.__new__(MessageLog)
+        new_log._items = self._items
+        new_log._start = self._start
+        new_log._end = self._end
+        new_log._shared = True
+        new_log._lock = self._lock
+        self._shared = True
+        return new_log
+
+    def _copy_on_write(self):
+        # Give this log its own backing list before modifying existing items
+        if self._shared:
+            self._items = self._items[self._start:self._end]
+            self._start = 0
+            self._end = len(self._items)
+            self._shared = False
+            self._lock = threading.Lock()
+
+    def _index(self, index):
+        # Convert an index of the log into an index of the backing list
+        length = self._end - self._start
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("MessageLog index out of range")
+        return self._start + index
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __iter__(self):
+        for i in range(self._start, self._end):
+            yield self._items[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        return self._items[self._index(index)]
+
+    def __setitem__(self, index, value):
+        self._copy_on_write()
+        self._items[self._index(index)] = value
+
+    def __delitem__(self, index):
+        self._copy_on_write()
+        del self._items[self._index(index)]
+        self._end -= 1
+
+    def append(self, item):
+        # Only append in place when this log ends at the tip of the backing list,
+        # otherwise another fork has already appended behind it and the window is copied first
+        with self._lock:
+            if self._end != len(self._items):
+                self._shared = True
+                self._copy_on_write()
+            self._items.append(item)
+            self._end += 1
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def pop(self):
+        # Remove the latest item by shrinking the window
+        if self._end == self._start:
+            raise IndexError("pop from an empty MessageLog")
+        self._end -= 1
+        return self._items[self._end]
+
+    def popleft(self):
+        # Remove the earliest item by moving the start of the window, in O(1)
+        if self._end == self._start:
+            raise IndexError("pop from an empty MessageLog")
+        item = self._items[self._start]
+        self._start += 1
+        # Release the evicted prefix once it dominates the backing list, amortised O(1)
+        if self._start > 64 and self._start * 2 > self._end:
+            self._items = self._items[self._start:self._end]
+            self._end -= self._start
+            self._start = 0
+            self._shared = False
+            self._lock = threading.Lock()
+        return item
+
+
+class Message():
+    """
+    The Message class is the compact record in which ChatMessages stores each message once. It uses __slots__ instead of a per-instance dict,
+    interns the role string, and carries the token count of the message, computed once when the message enters a ChatMessages object.
+    Messages are immutable once stored, because they are shared between copies of a ChatMessages object. The OpenAI wire format
+    is only built by to_dict() when a request is sent. Read access with message["content"] or message.get("role") is supported like a dictionary.
+    """
+    __slots__ = ('role', 'content', 'name', 'function_call', 'tokens_count')
+
+    # Keys of the wire format, in the order they are sent
+    keys_order = ('role', 'content', 'name', 'function_call')
+
+    def __init__(self, role, content=None, name=None, function_call=None, tokens_count=0):
+        self.role = sys.intern(role)
+        self.content = content
+        self.name = name
+        self.function_call = function_call
+        self.tokens_count = tokens_count
+
+    @classmethod
+    def from_dict(cls, message, tokens_count=0):
+        # Create a Message from a message dictionary or an OpenAIObject returned by the Chat model
+        function_call = message.get("function_call")
+        if function_call is not None:
+            function_call = {"name": function_call["name"], "arguments": function_call["arguments"]}
+        return cls(role=message["role"],
+                   content=message.get("content"),
+                   name=message.get("name"),
+                   function_call=function_call,
+                   tokens_count=tokens_count)
+
+    def to_dict(self):
+        # Build the OpenAI wire format of the message, the content key is always sent, other keys only when set
+        message = {"role": self.role, "content": self.content}
+        if self.name is not None:
+            message["name"] = self.name
+        if self.function_call is not None:
+            message["function_call"] = dict(self.function_call)
+        return message
+
+    # A copy of a message is a new message dictionary, which can be modified and appended again
+    copy = to_dict
+
+    def get(self, key, default=None):
+        if key not in self.keys_order:
+            return default
+        value = getattr(self, key)
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        if key not in self.keys_order:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def keys(self):
+        return [key for key in self.keys_order if key in ('role', 'content') or getattr(self, key) is not None]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def __repr__(self):
+        return repr(self.to_dict())
 
 
 class ChatMessages():
@@ -8,45 +182,41 @@ class ChatMessages():
     The ChatMessages class is used to create message objects that the Chat model can receive and interpret. This object is a more advanced representation of the original messages object received by the Chat model. 
     The ChatMessages class takes a list of dictionaries as one of its attributes and can distinguish between system messages and historical conversation messages. 
     It can also automatically calculate the token count of the current conversation and delete the earliest messages when appending new ones, allowing for smoother input to the large model and meeting the requirements of multi-turn conversations.
+    Each message is stored once as a Message record carrying its token count. Historical messages are stored in a MessageLog, so the earliest turns are evicted in O(1)
+    and copies share the common history until one of them is modified. The messages list in the OpenAI wire format is only built when it is read, i.e. when a request is sent.
     """
 
     def __init__(self,
                  system_content_list=[],
                  question='Hello',
                  tokens_thr=None,
-                 project=None):
+                 project=None,
+                 model="gpt-3.5-turbo"):
 
         self.system_content_list = system_content_list
         # List of system message documents, equivalent to an external input document list
         system_messages = []
         # Historical conversation messages excluding system messages
         history_messages = []
-        # List used to store all messages
-        messages_all = []
-        # System message string
-        system_content = ''
-        # Historical message string, which is currently the user input
-        history_content = question
-        # Combined string of system messages and historical messages
-        content_all = ''
         # Number of system messages input into messages, initially 0
         num_of_system_messages = 0
         # Total token count of all information
         all_tokens_count = 0
+        # Token count of system messages, 0 when there are no external documents
+        system_tokens_count = 0
 
-        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        # Shared encoder of the model family, only loaded by the first ChatMessages object of the process
+        encoding = get_encoding(model)
 
         # Save external input documents as system messages sequentially
         if system_content_list != []:
             for content in system_content_list:
-                system_messages.append({"role": "system", "content": content})
-                # Concatenate all document content
-                system_content += content
-        
+                # Encode each document only once and keep its token count in the chat format
+                system_message = {"role": "system", "content": content}
+                system_messages.append(Message.from_dict(system_message, count_message_tokens(system_message, model)))
+
             # Calculate the number of tokens in system messages
-            system_tokens_count = len(encoding.encode(system_content))
-            # Append system messages to all messages
-            messages_all += system_messages
+            system_tokens_count = sum(message.tokens_count for message in system_messages)
             # Count the number of system messages
             num_of_system_messages = len(system_content_list)
         
@@ -57,7 +227,6 @@ class ChatMessages():
                     print("The number of tokens in system_messages exceeds the limit. The current system messages will not be input into the model. If necessary, please adjust the number of external documents.")
                     # Delete system messages
                     system_messages = []
-                    messages_all = []
                     # Reset the number of system messages
                     num_of_system_messages = 0
                     # Reset the system messages token count
@@ -66,14 +235,11 @@ class ChatMessages():
 
         all_tokens_count += system_tokens_count
 
-        # Create the initial user message
-        history_messages = [{"role": "user", "content": question}]
-        # Create the list of all messages
-        messages_all += history_messages
-        
-        # Calculate the number of tokens in the user's question
-        user_tokens_count = len(encoding.encode(question))
-        
+        # Create the initial user message, calculating the number of tokens in the user's question
+        user_message = {"role": "user", "content": question}
+        user_tokens_count = count_message_tokens(user_message, model)
+        history_messages = [Message.from_dict(user_message, user_tokens_count)]
+
         # Calculate the total number of tokens
         all_tokens_count += user_tokens_count
         
@@ -85,37 +251,107 @@ class ChatMessages():
                 # Clear both system and user messages
                 history_messages = []
                 system_messages = []
-                messages_all = []
                 num_of_system_messages = 0
                 all_tokens_count = 0
 
 
-        # All messages information
-        self.messages = messages_all
         # System messages information
         self.system_messages = system_messages
-        # User messages information
-        self.history_messages = history_messages
+        # User messages information, stored as a MessageLog so the earliest turns can be evicted in O(1) and copies share it
+        self.history_messages = MessageLog(history_messages)
         # Total token count of all content in messages
         self.tokens_count = all_tokens_count
+        # Messages in the wire format, built lazily by the messages property
+        self._messages = None
         # Number of system messages
         self.num_of_system_messages = num_of_system_messages
         # Maximum token count threshold
         self.tokens_thr = tokens_thr
         # Encoding method for token count calculation
-        self.encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+        self.encoding = encoding
+        # Model whose encoding is used
+        self.model = model
         # Project associated with the messages
         self.project = project
+        # Timings of the streamed model responses, shared by the copies of the conversation
+        self.response_timings = []
+
+    # All messages in the OpenAI wire format, the system messages followed by the history messages
+    # The list is only rebuilt when it is read after a change, i.e. when a request is sent
+    @property
+    def messages(self):
+        if self._messages is None:
+            self._messages = [message.to_dict() for message in self.system_messages]
+            self._messages += [message.to_dict() for message in self.history_messages]
+        return self._messages
+
+    # Calculate the token count of a single message in the chat format, used only when the message enters the object
+    def count_message_tokens(self, message):
+        return count_message_tokens(message, self.model)
+
+    # Create the Message record of a message dictionary, encoding it once
+    def make_message(self, message):
+        if isinstance(message, Message):
+            return message
+        return Message.from_dict(message, self.count_message_tokens(message))
+
+    # Replace the content of a history message
+    # Messages are shared between copies, so the message is replaced by a modified copy instead of being changed in place
+    def set_message_content(self, index, content):
+        new_message = self.history_messages[index].to_dict()
+        new_message["content"] = content
+        new_message = self.make_message(new_message)
+        self.tokens_count += new_message.tokens_count - self.history_messages[index].tokens_count
+        self.history_messages[index] = new_message
+        self._messages = None
+
+    # Evict the earliest turn of the history messages
+    def evict_oldest_turn(self):
+        # Drop the earliest message in O(1)
+        drop_message = self.history_messages.popleft()
+        self.tokens_count -= drop_message.tokens_count
+
+        # A function call and its function response are evicted together,
+        # so that no function message is left without the call that produced it, the latest message is always kept
+        while len(self.history_messages) > 1 and self.history_messages[0].role == "function":
+            self.tokens_count -= self.history_messages.popleft().tokens_count
+
+        self._messages = None
+        return drop_message
+
+    # Replace the n earliest history messages with a single summary message
+    def fold_history(self, n, summary_message):
+        summary_message = self.make_message(summary_message)
+        folded_tokens_count = sum(message.tokens_count for message in self.history_messages[:n])
+        # Folding is rare, so the history is rebuilt as a new MessageLog instead of being modified in place
+        self.history_messages = MessageLog([summary_message] + self.history_messages[n:])
+        self.tokens_count += summary_message.tokens_count - folded_tokens_count
+        self._messages = None
+        # Return the number of tokens saved by the summary
+        return folded_tokens_count - summary_message.tokens_count
+
+    # Evict the earliest turns until the messages fit in max_tokens, always keeping the latest message
+    def fit_to_budget(self, max_tokens):
+        while self.tokens_count > max_tokens and len(self.history_messages) > 1:
+            self.evict_oldest_turn()
+        return self.tokens_count <= max_tokens
 
     # Remove some conversation information
     def messages_pop(self, manual=False, index=None):
         def reduce_tokens(index):
-            drop_message = self.history_messages.pop(index)
-            self.tokens_count -= len(self.encoding.encode(str(drop_message)))
-    
+            # Use the cached token count instead of re-encoding the dropped message
+            if index == -1:
+                drop_message = self.history_messages.pop()
+            else:
+                drop_message = self.history_messages[index]
+                del self.history_messages[index]
+            self.tokens_count -= drop_message.tokens_count
+            self._messages = None
+
+        # Evict the earliest turns first, always keeping the latest message which starts the next request
         if self.tokens_thr is not None:
-            while self.tokens_count >= self.tokens_thr:
-                reduce_tokens(-1)
+            while self.tokens_count >= self.tokens_thr and len(self.history_messages) > 1:
+                self.evict_oldest_turn()
     
         if manual:
             if index is None:
@@ -124,104 +360,74 @@ class ChatMessages():
                 reduce_tokens(index)
             else:
                 raise ValueError("Invalid index value: {}".format(index))
-        
-        # Update messages
-        self.messages = self.system_messages + self.history_messages
 
     # Add some conversation information
     def messages_append(self, new_messages):
         
-        # If new_messages is a single dictionary or JSON-like dictionary
-        if isinstance(new_messages, dict) or isinstance(new_messages, openai.openai_object.OpenAIObject):
-            self.messages.append(new_messages)
-            self.tokens_count += len(self.encoding.encode(str(new_messages)))
+        # If new_messages is a single dictionary, JSON-like dictionary or Message
+        if isinstance(new_messages, (dict, Message)) or isinstance(new_messages, openai.openai_object.OpenAIObject):
+            # The new message is encoded once here and its token count is cached in the Message record
+            new_message = self.make_message(new_messages)
+            self.history_messages.append(new_message)
+            self.tokens_count += new_message.tokens_count
+            self._messages = None
     
         # If new_messages is also a ChatMessages object
         elif isinstance(new_messages, ChatMessages):
-            self.messages += new_messages.messages
+            # Reuse the Message records, and their token counts, of the other object
+            self.history_messages.extend(new_messages.system_messages)
+            self.history_messages.extend(new_messages.history_messages)
             self.tokens_count += new_messages.tokens_count
-    
-        # Update the history_messages
-        self.history_messages = self.messages[self.num_of_system_messages:]
+            self._messages = None
     
         # Perform pop if needed, which may delete some historical messages
         self.messages_pop()
 
     # Copy information
     def copy(self):
-        # Create a new ChatMessages object, copying all important attributes
-        system_content_str_list = [message['content'] for message in self.system_messages]
-        new_obj = ChatMessages(
-            system_content_list=copy.deepcopy(system_content_str_list),  # Use deep copy to duplicate system messages
-            question=self.history_messages[0]['content'] if self.history_messages else '',
-            tokens_thr=self.tokens_thr
-        )
-        # Copy any other necessary attributes
-        new_obj.history_messages = copy.deepcopy(self.history_messages)  # Use deep copy to duplicate historical messages
-        new_obj.messages = copy.deepcopy(self.messages)  # Use deep copy to duplicate all messages
-        new_obj.tokens_count = self.tokens_count
-        new_obj.num_of_system_messages = self.num_of_system_messages
+        # Create a new ChatMessages object without running the constructor, so no content is re-encoded
+        new_obj = copy.copy(self)
+        # The history is forked in O(1), both objects share it until one of them modifies it
+        new_obj.history_messages = self.history_messages.fork()
+        # System lists are never modified in place, so they can be shared as they are
+        new_obj._messages = None
         return new_obj
 
     # Add system messages
     def add_system_messages(self, new_system_content):
-        system_content_list = self.system_content_list
-        system_messages = []
-        
         # If input is a string, convert it to a list
         if type(new_system_content) == str:
             new_system_content = [new_system_content]
     
         # Extend the existing system content list with new content
-        system_content_list.extend(new_system_content)
-        
-        # Concatenate new system content to create a single string
-        new_system_content_str = ''
-        for content in new_system_content:
-            new_system_content_str += content
+        self.system_content_list = self.system_content_list + list(new_system_content)
         
-        # Calculate the number of tokens in the new system content
-        new_token_count = len(self.encoding.encode(str(new_system_content_str)))
-        self.tokens_count += new_token_count
-        
-        # Update system content list
-        self.system_content_list = system_content_list
-        
-        # Convert the system content list to system messages
-        for message in system_content_list:
-            system_messages.append({"role": "system", "content": message})
+        # Only the new documents are encoded, the existing system messages keep their cached token counts
+        # A new list is created instead of appending in place, because the system messages list is shared with copies
+        new_system_messages = [self.make_message({"role": "system", "content": content}) for content in new_system_content]
+        self.system_messages = self.system_messages + new_system_messages
+        self.tokens_count += sum(message.tokens_count for message in new_system_messages)
         
         # Update system messages and other attributes
-        self.system_messages = system_messages
-        self.num_of_system_messages = len(system_content_list)
-        self.messages = system_messages + self.history_messages
+        self.num_of_system_messages = len(self.system_messages)
+        self._messages = None
     
         # Execute pop to remove old messages if necessary
         self.messages_pop()
 
     # Delete system messages
     def delete_system_messages(self):
-        system_content_list = self.system_content_list
-        
-        if system_content_list != []:
-            # Concatenate all system content into a single string
-            system_content_str = ''
-            for content in system_content_list:
-                system_content_str += content
-            
-            # Calculate the number of tokens in the system content to be deleted
-            delete_token_count = len(self.encoding.encode(str(system_content_str)))
-            
-            # Update the total token count by subtracting the deleted tokens
-            self.tokens_count -= delete_token_count
+        if self.system_messages != []:
+            # Update the total token count by subtracting the cached tokens of the system messages
+            self.tokens_count -= sum(message.tokens_count for message in self.system_messages)
             
             # Reset system message related attributes
             self.num_of_system_messages = 0
             self.system_content_list = []
             self.system_messages = []
             
-            # Update the messages to only include history messages
-            self.messages = self.history_messages
+            # The messages now only include history messages
+            self._messages = None
 
     # Clear function messages from conversation messages
     def delete_function_messages(self):
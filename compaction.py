@@ -0,0 +1,203 @@
+import threading
+from chatmessage import ChatMessages
+from tokenizer import count_message_tokens
+from response import get_gpt_response
+from interaction import AutoPolicy
+from outputsink import DEFAULT_OUTPUT_SINK, ERROR
+from tracing import Trace, append_trace
+
+# Name given to the running summary message, used to recognise it at the start of the history messages
+SUMMARY_MESSAGE_NAME = "conversation_summary"
+
+SUMMARY_PROMPT = "You are summarizing the earlier part of a data analysis conversation so that it can be continued without the original messages. \
+Keep every concrete result: table names, row counts, SQL and Python results, variable names created in the Python environment, \
+findings and decisions. Drop greetings and repeated content. If a previous summary is given, merge it with the new messages into one summary."
+
+
+def is_summary_message(message):
+    """
+    Check whether a message is the running summary message created by ConversationCompactor.
+    """
+    return message.get("role") == "system" and message.get("name") == SUMMARY_MESSAGE_NAME
+
+
+def messages_to_transcript(messages):
+    """
+    Convert a list of messages into a plain text transcript that can be summarized by the Chat model.
+    :param messages: Required parameter, a list of message dictionaries.
+    :return: The transcript as a string, one message per paragraph.
+    """
+    lines = []
+    for message in messages:
+        if message.get("function_call"):
+            function_call = message["function_call"]
+            lines.append("assistant called %s with arguments: %s" % (function_call["name"], function_call["arguments"]))
+        elif message.get("role") == "function":
+            lines.append("result of %s: %s" % (message.get("name"), message.get("content")))
+        else:
+            lines.append("%s: %s" % (message.get("role"), message.get("content")))
+    return "\n\n".join(lines)
+
+
+class ConversationCompactor():
+    """
+    The ConversationCompactor class folds the earliest turns of a ChatMessages object into a running summary message once the conversation
+    reaches a high-water mark of its token threshold, instead of letting ChatMessages drop them. Earlier analysis results are kept in the summary,
+    so the model does not need to re-run SQL or Python code to recover them.
+    The summary is created by a background thread between turns: schedule() is called after a turn is answered, and apply() before the next
+    question is sent. apply() never waits for the background thread, an unfinished summary is simply applied at a later turn.
+    The summary is requested with get_gpt_response like the questions of the session, so it waits for the shared rate limiter, is retried after a rate limit error,
+    counts against the budgets of the session and is reported through its output sink and traced with its turns.
+    """
+
+    def __init__(self,
+                 model='gpt-3.5-turbo-0613',
+                 high_water_ratio=0.75,
+                 keep_recent=6,
+                 output_sink=None,
+                 budget_governor=None,
+                 metrics=None,
+                 trace_path=None):
+        """
+        :param model: Optional parameter, the Chat model used to write the summaries.
+        :param high_water_ratio: Optional parameter, the fraction of tokens_thr at which the earliest turns are folded into the summary.
+        :param keep_recent: Optional parameter, the number of latest history messages that are always kept verbatim.
+        :param output_sink: Optional parameter, the output sink of the session, receiving the errors of the summaries. Defaults to None, indicating DEFAULT_OUTPUT_SINK.
+        :param budget_governor: Optional parameter, the BudgetGovernor of the session, the summaries count against its budgets. Defaults to None, indicating no budget.
+        :param metrics: Optional parameter, the TraceMetrics of the session, each summary is traced and added to it. Defaults to None, indicating no tracing.
+        :param trace_path: Optional parameter, the JSONL file to which the trace of each summary is appended when tracing.
+        """
+        self.model = model
+        self.high_water_ratio = high_water_ratio
+        self.keep_recent = keep_recent
+        self.output_sink = output_sink if output_sink is not None else DEFAULT_OUTPUT_SINK
+        self.budget_governor = budget_governor
+        self.metrics = metrics
+        self.trace_path = trace_path
+        # Background summarization thread, its result and its trace
+        self._thread = None
+        self._result = None
+        self._trace = None
+        # Session statistics
+        self.stats = {"summaries": 0,
+                      "failed_summaries": 0,
+                      "folded_messages": 0,
+                      "tokens_saved": 0,
+                      "summary_tokens_used": 0,
+                      "folded_function_results": 0}
+
+    def needs_compaction(self, messages):
+        """
+        Check whether a ChatMessages object has reached the high-water mark.
+        """
+        if messages.tokens_thr is None:
+            return False
+        return messages.tokens_count >= messages.tokens_thr * self.high_water_ratio
+
+    def _fold_count(self, messages):
+        # Number of earliest history messages to fold, keeping the latest keep_recent messages verbatim
+        n = len(messages.history_messages) - self.keep_recent
+        # A function call and its function response are folded together
+        while 0 < n < len(messages.history_messages) and messages.history_messages[n].get("role") == "function":
+            n -= 1
+        return n
+
+    def schedule(self, messages):
+        """
+        Start summarizing the earliest turns of messages in a background thread, if the high-water mark is reached and no summary is running.
+        The thread works on an O(1) copy of messages, so the conversation can continue meanwhile.
+        :param messages: Required parameter, a ChatMessages type object.
+        :return: True if a background summary was started.
+        """
+        if self._thread is not None or not self.needs_compaction(messages):
+            return False
+
+        n = self._fold_count(messages)
+        # Folding a single message (e.g. only the previous summary) does not save anything
+        if n < 2:
+            return False
+
+        snapshot = messages.copy()
+        folded_messages = snapshot.history_messages[:n]
+        self._trace = Trace(model=self.model, stage="compaction") if self.metrics is not None else None
+        self._thread = threading.Thread(target=self._summarize, args=(folded_messages,), daemon=True)
+        self._thread.start()
+        return True
+
+    def _summarize(self, folded_messages):
+        # Runs in the background thread, the result is stored and applied by the session thread
+        previous_summary = ''
+        new_messages = folded_messages
+        if is_summary_message(folded_messages[0]):
+            previous_summary = folded_messages[0]["content"]
+            new_messages = folded_messages[1:]
+
+        user_content = "Previous summary:\n%s\n\nNew messages:\n%s" % (previous_summary, messages_to_transcript(new_messages))
+        summary_messages = ChatMessages(system_content_list=[SUMMARY_PROMPT], question=user_content, model=self.model)
+        try:
+            # No question can be asked from the background thread, a connection error is retried after a backoff
+            response_message = get_gpt_response(model=self.model,
+                                                messages=summary_messages,
+                                                interaction_policy=AutoPolicy(),
+                                                output_sink=self.output_sink,
+                                                trace=self._trace,
+                                                budget_governor=self.budget_governor)
+        except Exception as e:
+            response_message = None
+            self.output_sink.text("Unable to summarize the earlier conversation, it will be retried at a later turn: %s" % e, ERROR)
+        if response_message is None or not response_message.get("content"):
+            self._result = (folded_messages, None, 0)
+        else:
+            tokens_used = summary_messages.tokens_count + count_message_tokens(response_message, self.model)
+            self._result = (folded_messages, response_message["content"], tokens_used)
+
+    def apply(self, messages):
+        """
+        Replace the summarized turns of messages with the running summary message, if the background summary is finished.
+        The summary is discarded when the summarized turns are no longer at the start of the history, e.g. because they were evicted meanwhile.
+        :param messages: Required parameter, a ChatMessages type object, modified in place.
+        :return: The number of tokens saved, 0 if nothing was applied.
+        """
+        if self._thread is None or self._thread.is_alive():
+            return 0
+        self._thread = None
+        folded_messages, summary, summary_tokens_used = self._result
+        self._result = None
+        self.record_trace()
+        self.stats["summary_tokens_used"] += summary_tokens_used
+
+        if summary is None:
+            self.stats["failed_summaries"] += 1
+            return 0
+
+        # Messages are shared between copies, so the summarized turns can be recognised by identity
+        n = len(folded_messages)
+        history_prefix = messages.history_messages[:n]
+        if len(history_prefix) < n or any(a is not b for a, b in zip(history_prefix, folded_messages)):
+            return 0
+
+        summary_message = {"role": "system", "name": SUMMARY_MESSAGE_NAME,
+                           "content": "Summary of the earlier conversation:\n" + summary}
+        tokens_saved = messages.fold_history(n, summary_message)
+
+        # Each folded function result is kept in the summary instead of being dropped
+        self.stats["summaries"] += 1
+        self.stats["folded_messages"] += n
+        self.stats["tokens_saved"] += tokens_saved
+        self.stats["folded_function_results"] += sum(1 for message in folded_messages if message.get("role") == "function")
+        return tokens_saved
+
+    def record_trace(self):
+        # The trace of the finished summary is added to the metrics from the session thread, like the traces of the turns
+        trace = self._trace
+        self._trace = None
+        if trace is None:
+            return
+        trace.finish()
+        self.metrics.observe(trace)
+        if self.trace_path is not None:
+            append_trace(self.trace_path, trace)
+
+
+if __name__ == '__main__':
+    print("this file contains the ConversationCompactor class")
@@ -0,0 +1,298 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import deque
+from contextlib import contextmanager
+import pymysql
+
+# Connection settings of the MySQL database used by the external functions, the password is read from the MYSQL_PW environment variable
+MYSQL_SETTINGS = {"host": "localhost", "user": "root", "db": "telco_db", "charset": "utf8"}
+
+# Default number of connections of the shared pool, and the seconds a caller waits for a free connection
+DEFAULT_POOL_SIZE = 8
+DEFAULT_POOL_TIMEOUT = 30.0
+# A connection older than DEFAULT_RECYCLE seconds is replaced, one unused for DEFAULT_IDLE_TIMEOUT seconds is closed
+# MySQL closes connections idle for wait_timeout (8 hours by default), both values are well below it
+DEFAULT_RECYCLE = 3600.0
+DEFAULT_IDLE_TIMEOUT = 300.0
+# COM_RESET_CONNECTION command of the MySQL protocol (MySQL 5.7.3 and later), pymysql has no method sending it
+COM_RESET_CONNECTION = 0x1F
+
+
+def mysql_connect():
+    """
+    Open a connection to the MySQL database of the external functions, with the settings of MYSQL_SETTINGS.
+    """
+    return pymysql.connect(passwd=os.getenv('MYSQL_PW'), **MYSQL_SETTINGS)
+
+
+def sqlite_connector(path):
+    """
+    Return a function opening connections to a SQLite database file, a local stand-in for the MySQL database, e.g. configure_pool(sqlite_connector("telco.db")).
+    The connections can be used from the worker threads of the pool.
+    """
+    def connect():
+        return sqlite3.connect(path, check_same_thread=False)
+
+    return connect
+
+
+def reset_session(connection):
+    """
+    Reset the session state a borrower can leave on a connection, before the connection is given to the next borrower. The open transaction is rolled back.
+    A pymysql connection is reset with COM_RESET_CONNECTION, which drops the temporary tables, the user variables and the SET SESSION values,
+    then the database, character set, sql_mode, init_command and autocommit mode it was opened with are applied again, undoing a USE.
+    A SQLite connection drops its temporary tables. An exception means the session could not be reset, the connection is then closed.
+    """
+    connection.rollback()
+    if isinstance(connection, pymysql.connections.Connection):
+        connection._execute_command(COM_RESET_CONNECTION, b"")
+        connection._read_ok_packet()
+        connection.set_character_set(connection.charset, connection.collation)
+        if connection.db:
+            connection.select_db(connection.db)
+        cursor = connection.cursor()
+        try:
+            if connection.sql_mode is not None:
+                cursor.execute("SET sql_mode=%s", (connection.sql_mode,))
+            if connection.init_command is not None:
+                cursor.execute(connection.init_command)
+        finally:
+            cursor.close()
+        if connection.autocommit_mode is not None:
+            connection.autocommit(connection.autocommit_mode)
+    elif isinstance(connection, sqlite3.Connection):
+        names = [row[0] for row in connection.execute("SELECT name FROM sqlite_temp_master WHERE type = 'table'")]
+        for name in names:
+            connection.execute('DROP TABLE temp."%s"' % name.replace('"', '""'))
+
+
+class PooledConnection():
+    """
+    A connection of the pool with the times at which it was opened and last returned.
+    """
+    __slots__ = ('connection', 'created', 'last_used')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.monotonic()
+        self.last_used = self.created
+
+
+def close_quietly(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+class ConnectionPool():
+    """
+    The ConnectionPool class keeps database connections open between the calls of the external functions, instead of opening a connection per query.
+    It is thread-safe and shared by every session of the process, e.g. the workers of a batch and the parallel calls of multi_function_call.
+    A borrowed connection is checked with a ping first, and replaced if the check fails or if it is older than recycle seconds;
+    connections unused for idle_timeout seconds are closed. A returned connection is reset with reset_session, so no transaction, snapshot,
+    temporary table, variable or USE of one caller is carried to the next caller.
+    At most size connections are open, further callers wait for a connection to be returned.
+    """
+
+    def __init__(self,
+                 connect=mysql_connect,
+                 size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_POOL_TIMEOUT,
+                 recycle=DEFAULT_RECYCLE,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 health_check=True,
+                 reset=reset_session):
+        """
+        :param connect: Optional parameter, a function opening a new DB-API connection. Defaults to mysql_connect.
+        :param size: Optional parameter, the maximum number of open connections.
+        :param timeout: Optional parameter, the number of seconds a caller waits for a free connection before TimeoutError is raised, None to wait indefinitely.
+        :param recycle: Optional parameter, the number of seconds after which a connection is closed and replaced, None to keep connections indefinitely.
+        :param idle_timeout: Optional parameter, the number of seconds after which an unused connection is closed, None to keep idle connections.
+        :param health_check: Optional parameter, whether a connection is checked with a ping before it is borrowed. Default is True.
+        :param reset: Optional parameter, the function resetting the session of a returned connection. Defaults to reset_session.
+        """
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.reset = reset
+        # Returned connections, the most recently used one last
+        self._idle = deque()
+        self._open_count = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self.stats = {"opened": 0, "reused": 0, "recycled": 0, "expired": 0, "failed_checks": 0,
+                      "waits": 0, "wait_time": 0.0, "in_use": 0}
+
+    def _count(self, key):
+        with self._condition:
+            self.stats[key] += 1
+
+    def _expired(self, pooled, now):
+        return self.recycle is not None and now - pooled.created >= self.recycle
+
+    def _close_idle_connections(self, now):
+        # The least recently used connections are at the left of the deque
+        while self._idle and self.idle_timeout is not None and now - self._idle[0].last_used >= self.idle_timeout:
+            close_quietly(self._idle.popleft().connection)
+            self._open_count -= 1
+            self.stats["expired"] += 1
+
+    def is_alive(self, connection):
+        """
+        Check that a connection still works: pymysql connections are pinged, other connections run SELECT 1.
+        """
+        try:
+            if hasattr(connection, "ping"):
+                connection.ping(reconnect=False)
+            else:
+                connection.cursor().execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        """
+        Borrow a connection, waiting for one to be returned if size connections are in use. The connection must be given back with release().
+        """
+        deadline = time.monotonic() + self.timeout if self.timeout is not None else None
+        waited = None
+        with self._condition:
+            while True:
+                if self._closed:
+                    raise RuntimeError("The connection pool is closed")
+                now = time.monotonic()
+                self._close_idle_connections(now)
+                if self._idle:
+                    pooled = self._idle.pop()
+                    break
+                if self._open_count < self.size:
+                    # Reserve the place of the new connection, it is opened outside the lock
+                    self._open_count += 1
+                    pooled = None
+                    break
+                if waited is None:
+                    waited = now
+                    self.stats["waits"] += 1
+                remaining = deadline - now if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("No database connection was returned to the pool within %s seconds" % self.timeout)
+                self._condition.wait(remaining)
+            if waited is not None:
+                self.stats["wait_time"] += time.monotonic() - waited
+            self.stats["in_use"] += 1
+
+        try:
+            if pooled is not None:
+                if self._expired(pooled, time.monotonic()):
+                    close_quietly(pooled.connection)
+                    self._count("recycled")
+                    pooled = None
+                elif self.health_check and not self.is_alive(pooled.connection):
+                    close_quietly(pooled.connection)
+                    self._count("failed_checks")
+                    pooled = None
+                else:
+                    self._count("reused")
+            if pooled is None:
+                pooled = PooledConnection(self.connect())
+                self._count("opened")
+        except BaseException:
+            # The place of the connection is given back if no connection could be opened
+            with self._condition:
+                self._open_count -= 1
+                self.stats["in_use"] -= 1
+                self._condition.notify()
+            raise
+        return pooled
+
+    def release(self, pooled, discard=False):
+        """
+        Give a borrowed connection back to the pool. The session of the connection is reset,
+        and the connection is closed instead if discard is True, if the reset fails or if the pool is closed.
+        """
+        if not discard:
+            try:
+                self.reset(pooled.connection)
+            except Exception:
+                discard = True
+        with self._condition:
+            self.stats["in_use"] -= 1
+            if discard or self._closed:
+                close_quietly(pooled.connection)
+                self._open_count -= 1
+            else:
+                pooled.last_used = time.monotonic()
+                self._idle.append(pooled)
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a with block:
+
+            with get_pool().connection() as connection:
+                df = pd.read_sql(sql_query, connection)
+        """
+        pooled = self.acquire()
+        try:
+            yield pooled.connection
+        finally:
+            self.release(pooled)
+
+    def close(self):
+        """
+        Close the idle connections, the borrowed connections are closed when they are returned.
+        """
+        with self._condition:
+            self._closed = True
+            while self._idle:
+                close_quietly(self._idle.pop().connection)
+                self._open_count -= 1
+            self._condition.notify_all()
+
+    def report(self):
+        with self._condition:
+            return dict(self.stats, open=self._open_count, idle=len(self._idle), size=self.size)
+
+
+# Process-wide pool shared by the database functions, created on first use
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the connection pool shared by sql_inter, extract_data and every session of the process, created with the default settings on first use.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+def configure_pool(connect=mysql_connect, **options):
+    """
+    Replace the shared connection pool, e.g. to change its size for a batch or to use a SQLite stand-in database. The connections of the previous pool are closed.
+    :param connect: Optional parameter, the function opening new connections, e.g. sqlite_connector(path). Defaults to mysql_connect.
+    :param options: Optional parameters of ConnectionPool: size, timeout, recycle, idle_timeout, health_check and reset.
+    :return: The new pool.
+    """
+    global _pool
+    with _pool_lock:
+        previous = _pool
+        _pool = ConnectionPool(connect=connect, **options)
+    if previous is not None:
+        previous.close()
+    return _pool
+
+
+if __name__ == '__main__':
+    print("this file contains the database connection pool of the external functions")
@@ -0,0 +1,99 @@
+import copy
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Default number of candidate fixes requested at once in fast debug mode
+DEFAULT_DEBUG_CANDIDATES = 3
+
+FAST_DEBUG_PROMPT = 'Your code has errors. Please modify the code according to the error information and re-execute.'
+
+# Thread pool running the candidate fixes, each in its own copy of the namespace
+CANDIDATE_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="mategen-debug")
+
+# Types copied into the namespace of a candidate, so that a candidate changing a table in place does not change the tables of the conversation
+COPIED_TYPES = (list, dict, set)
+COPIED_MODULES = ("pandas", "numpy")
+
+
+def isolated_namespace(g):
+    """
+    Create a copy of the namespace in which the external functions run. Tables, arrays and containers are copied, modules and functions are shared.
+    :param g: Required parameter, the namespace dictionary.
+    :return: The copied namespace.
+    """
+    namespace = {}
+    for name, value in g.items():
+        if isinstance(value, COPIED_TYPES) or type(value).__module__.split('.')[0] in COPIED_MODULES:
+            try:
+                value = value.copy()
+            except Exception:
+                value = copy.copy(value)
+        namespace[name] = value
+    return namespace
+
+
+def merge_namespace(g, namespace):
+    """
+    Apply the namespace of the accepted candidate to the namespace of the conversation.
+    """
+    for name, value in namespace.items():
+        if name not in g or g[name] is not value:
+            g[name] = value
+
+
+def run_candidate(functions_dic, function_call_message, namespace):
+    # Same error handling as function_to_call, an error is returned as the content of the function message
+    function_name = function_call_message["function_call"]["name"]
+    try:
+        function_args = json.loads(function_call_message["function_call"]["arguments"])
+        function_args['g'] = namespace
+        function_response = functions_dic[function_name](**function_args)
+    except Exception as e:
+        function_response = "The function encountered an error as follows:" + str(e)
+    return {"role": "function", "name": function_name, "content": function_response}
+
+
+def run_candidates(functions_dic, candidates, g, executor=CANDIDATE_EXECUTOR):
+    """
+    Run candidate fixes at the same time, each in an isolated copy of the namespace, and accept the first one that runs without error.
+    The namespace of the accepted candidate is applied to g, the other candidates keep running in their own copies and are discarded.
+    :param functions_dic: Required parameter, the dictionary of the external functions by name.
+    :param candidates: Required parameter, a list of function call messages.
+    :param g: Required parameter, the namespace of the conversation.
+    :param executor: Optional parameter, the thread pool running the candidates.
+    :return: A tuple of the accepted function call message and its function response message, or None if every candidate failed.
+    """
+    futures = {}
+    for candidate in candidates:
+        namespace = isolated_namespace(g)
+        futures[executor.submit(run_candidate, functions_dic, candidate, namespace)] = (candidate, namespace)
+
+    for future in as_completed(futures):
+        function_response_message = future.result()
+        if "error" not in str(function_response_message["content"]):
+            candidate, namespace = futures[future]
+            merge_namespace(g, namespace)
+            return candidate, function_response_message
+    return None
+
+
+def candidate_messages(response):
+    """
+    Return the function call messages among the choices of a response requested with n > 1, without duplicates.
+    """
+    candidates = []
+    seen = set()
+    for choice in response["choices"]:
+        message = choice["message"]
+        function_call = message.get("function_call")
+        if not function_call:
+            continue
+        key = (function_call["name"], function_call["arguments"])
+        if key not in seen:
+            seen.add(key)
+            candidates.append(message)
+    return candidates
+
+
+if __name__ == '__main__':
+    print("this file contains functions to sample and run candidate fixes in parallel")
@@ -0,0 +1,110 @@
+import asyncio
+import functools
+
+
+class Call():
+    """
+    A blocking operation requested by a step of the conversation engine: a model call, a wait of the rate limiter, a lookup of the response cache,
+    a decision of the interaction policy or an external function. The steps yield Call objects instead of calling the functions themselves,
+    so the same steps are run by run_steps, which calls function, and by arun_steps, which awaits async_function,
+    or runs function in executor (None for the default executor of the event loop) when there is no asynchronous counterpart.
+    """
+    __slots__ = ('function', 'args', 'kwargs', 'async_function', 'executor')
+
+    def __init__(self, function, *args, async_function=None, executor=None, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.async_function = async_function
+        self.executor = executor
+
+
+class Spawn():
+    """
+    Start other steps in the background, e.g. the speculative task decomposition request. The result of the yield is a handle for Join,
+    with a cancel() method: run_steps submits the steps to executor and returns the future, arun_steps starts a task of the event loop.
+    """
+    __slots__ = ('steps', 'executor')
+
+    def __init__(self, steps, executor):
+        self.steps = steps
+        self.executor = executor
+
+
+class Join():
+    """
+    Wait for the steps started by Spawn, the result of the yield is their result.
+    """
+    __slots__ = ('handle',)
+
+    def __init__(self, handle):
+        self.handle = handle
+
+
+def perform(effect):
+    if isinstance(effect, Call):
+        return effect.function(*effect.args, **effect.kwargs)
+    if isinstance(effect, Spawn):
+        return effect.executor.submit(run_steps, effect.steps)
+    if isinstance(effect, Join):
+        return effect.handle.result()
+    raise TypeError("Unknown operation %r" % (effect,))
+
+
+async def aperform(effect):
+    if isinstance(effect, Call):
+        if effect.async_function is not None:
+            return await effect.async_function(*effect.args, **effect.kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(effect.executor, functools.partial(effect.function, *effect.args, **effect.kwargs))
+    if isinstance(effect, Spawn):
+        return asyncio.ensure_future(arun_steps(effect.steps))
+    if isinstance(effect, Join):
+        return await effect.handle
+    raise TypeError("Unknown operation %r" % (effect,))
+
+
+def run_steps(steps):
+    """
+    Run a generator of steps in the current thread, performing each operation it yields and sending back the result,
+    or raising the exception of the operation inside the generator.
+    :param steps: Required parameter, a generator yielding Call, Spawn and Join objects, e.g. chat_response_steps(...).
+    :return: The value returned by the generator.
+    """
+    value = None
+    error = None
+    while True:
+        try:
+            effect = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value = None
+        error = None
+        try:
+            value = perform(effect)
+        except BaseException as e:
+            error = e
+
+
+async def arun_steps(steps):
+    """
+    Asynchronous counterpart of run_steps: the operations are awaited, so the event loop serves other sessions while one session waits.
+    A cancellation of the task is raised inside the generator like any other exception of an operation.
+    """
+    value = None
+    error = None
+    while True:
+        try:
+            effect = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value = None
+        error = None
+        try:
+            value = await aperform(effect)
+        except BaseException as e:
+            error = e
+
+
+if __name__ == '__main__':
+    print("this file contains the operations of the conversation engine and the functions running them")
@@ -0,0 +1,302 @@
+import os
+import sys
+import time
+import tempfile
+import decimal
+import threading
+from collections import deque
+import pandas as pd
+import pymysql
+from pandas.api.types import union_categoricals
+from dbpool import get_pool
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Default number of rows fetched from the server at a time in streaming mode
+DEFAULT_CHUNK_ROWS = 50000
+# A text column becomes categorical if its first chunk has at most this share of distinct values
+CATEGORICAL_RATIO = 0.5
+
+# Settings of extract_data, changed with configure_extraction
+# streaming: read the result with a server-side cursor chunk by chunk instead of pd.read_sql
+# downcast_floats: store floats and DECIMAL values as float32, which loses precision beyond about 7 significant digits
+# spill_dir: directory of the Parquet files written instead of building the DataFrame in memory, None to build it in memory,
+# in which case the chunks and the concatenated DataFrame are held at once at the end of the extraction
+EXTRACTION_SETTINGS = {"streaming": False,
+                       "chunk_rows": DEFAULT_CHUNK_ROWS,
+                       "downcast_floats": False,
+                       "categorical_ratio": CATEGORICAL_RATIO,
+                       "spill_dir": None}
+
+# Statistics of the latest streamed extractions of the process
+_history = deque(maxlen=100)
+_history_lock = threading.Lock()
+
+
+def configure_extraction(**settings):
+    """
+    Change the settings of extract_data, e.g. configure_extraction(streaming=True, chunk_rows=100000) before extracting production-size tables.
+    :param settings: Optional parameters: streaming, chunk_rows, downcast_floats, categorical_ratio and spill_dir, see EXTRACTION_SETTINGS.
+    :return: The settings in use.
+    """
+    unknown = set(settings) - set(EXTRACTION_SETTINGS)
+    if unknown:
+        raise ValueError("Unknown extraction settings: %s" % ", ".join(sorted(unknown)))
+    EXTRACTION_SETTINGS.update(settings)
+    return dict(EXTRACTION_SETTINGS)
+
+
+def extraction_report():
+    """
+    Return the statistics of the latest streamed extractions: rows, chunks, seconds, rows per second, DataFrame size,
+    the peak memory of the process and how much the extraction raised it.
+    """
+    with _history_lock:
+        return list(_history)
+
+
+def process_peak_rss_bytes():
+    # Peak resident memory of the whole process since it started, ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def server_side_cursor(connection):
+    """
+    Open a cursor that fetches the rows from the server as they are read instead of all at once: SSCursor for pymysql connections.
+    Other DB-API cursors, e.g. of the SQLite stand-in, already fetch the rows with fetchmany.
+    """
+    if isinstance(connection, pymysql.connections.Connection):
+        return connection.cursor(pymysql.cursors.SSCursor)
+    return connection.cursor()
+
+
+def fetch_chunks(cursor, chunk_rows):
+    """
+    Read the rows of an executed cursor chunk by chunk, as lists of at most chunk_rows rows.
+    """
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            break
+        yield rows
+
+
+def column_kinds(columns, rows, kinds=None, categorical_ratio=CATEGORICAL_RATIO):
+    """
+    Decide how each column is stored from the first chunk in which it has values: "integer" for integers, "float" for floats, "decimal" for DECIMAL values,
+    "category" for repetitive text, "other" for any other values, and None while the column only held NULL.
+    The same decision is applied to every later chunk, so that the chunks can be concatenated.
+    :param columns: Required parameter, the names of the columns.
+    :param rows: Required parameter, the rows of the chunk.
+    :param kinds: Optional parameter, the kinds decided from the earlier chunks, only the columns without a kind are decided again.
+    :return: The list of the kinds of the columns, in the order of columns.
+    """
+    kinds = list(kinds) if kinds is not None else [None] * len(columns)
+    for position in range(len(columns)):
+        if kinds[position] is not None:
+            continue
+        values = [row[position] for row in rows]
+        first = next((value for value in values if value is not None), None)
+        if first is None:
+            continue
+        # bool is a subclass of int, MySQL returns TINYINT(1) as int anyway
+        if isinstance(first, bool):
+            kinds[position] = "other"
+        elif isinstance(first, int):
+            kinds[position] = "integer"
+        elif isinstance(first, float):
+            kinds[position] = "float"
+        elif isinstance(first, decimal.Decimal):
+            kinds[position] = "decimal"
+        elif isinstance(first, str) and pd.Series(values).nunique() <= categorical_ratio * len(values):
+            kinds[position] = "category"
+        else:
+            kinds[position] = "other"
+    return kinds
+
+
+def build_column(values, kind, compact=True, downcast_floats=False):
+    """
+    Create the Series of one column of a chunk without losing values: integers use the nullable Int64 dtype when the chunk has NULL,
+    instead of the floats pd.DataFrame.from_records would create, and DECIMAL values stay Decimal objects.
+    If compact is True, integers are stored in the smallest integer type holding them and repetitive text as categories.
+    Floats are stored as float32 and DECIMAL values as float32 only if downcast_floats is True, both lose precision.
+    """
+    try:
+        if kind == "integer":
+            series = pd.Series(pd.array(values, dtype="Int64"))
+            if compact:
+                if not series.hasnans:
+                    series = series.astype("int64")
+                series = pd.to_numeric(series, downcast="integer")
+            return series
+        if kind == "float" or (kind == "decimal" and downcast_floats):
+            series = pd.Series(values, dtype="float64")
+            return pd.to_numeric(series, downcast="float") if downcast_floats else series
+        if kind == "category" and compact:
+            return pd.Series(values, dtype="category")
+        if kind in ("decimal", None):
+            return pd.Series(values, dtype=object)
+    except (TypeError, ValueError, OverflowError):
+        # Values not matching the kind of the column, e.g. an unsigned BIGINT above the Int64 range, are kept as they are
+        return pd.Series(values, dtype=object)
+    return pd.Series(values)
+
+
+def build_frame(columns, rows, kinds, compact=True, downcast_floats=False):
+    """
+    Create the DataFrame of a chunk, column by column with build_column. Columns with the same name, e.g. of a join, are kept.
+    """
+    df = pd.DataFrame({position: build_column([row[position] for row in rows], kinds[position], compact, downcast_floats)
+                       for position in range(len(columns))})
+    df.columns = columns
+    return df
+
+
+def concat_chunks(chunks, kinds):
+    """
+    Concatenate the chunks into one DataFrame. The categories of each categorical column are unified first,
+    otherwise pandas would convert the column back to objects.
+    """
+    if not chunks:
+        return pd.DataFrame()
+    for position, kind in enumerate(kinds):
+        series_list = [chunk.iloc[:, position] for chunk in chunks]
+        if kind == "category" and all(isinstance(series.dtype, pd.CategoricalDtype) for series in series_list):
+            categories = union_categoricals(series_list).categories
+            for chunk, series in zip(chunks, series_list):
+                chunk.isetitem(position, series.cat.set_categories(categories))
+    return pd.concat(chunks, ignore_index=True)
+
+
+class ParquetSpill():
+    """
+    Writes the chunks of an extraction to a Parquet file as they arrive, so the result never has to fit in memory. The schema is taken from the first chunk.
+    Requires pyarrow.
+    """
+
+    def __init__(self, path):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.writer = None
+        self.schema = None
+
+    def write(self, df):
+        if self.writer is None:
+            table = self.pa.Table.from_pandas(df, preserve_index=False)
+            # A column without values in the first chunk is stored as text
+            self.schema = self.pa.schema([field.with_type(self.pa.string()) if self.pa.types.is_null(field.type) else field
+                                          for field in table.schema])
+            self.writer = self.pq.ParquetWriter(self.path, self.schema)
+        for field in self.schema:
+            if self.pa.types.is_string(field.type) and not pd.api.types.is_string_dtype(df[field.name]):
+                df[field.name] = df[field.name].map(lambda value: None if value is None or value is pd.NA else str(value)).astype(object)
+        self.writer.write_table(self.pa.Table.from_pandas(df, schema=self.schema, preserve_index=False, safe=False))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def stream_extract(sql_query, chunk_rows=None, spill_path=None, downcast_floats=None, categorical_ratio=None):
+    """
+    Read the result of a query chunk by chunk with a server-side cursor, so that only one chunk of raw rows and Python objects is held at a time,
+    instead of the whole result at once as pd.read_sql does. The memory is bounded only with spill_path: without it the compact chunks are kept
+    and concatenated at the end, so the peak is about twice the size of the resulting DataFrame.
+    :param sql_query: Required parameter, the SQL query.
+    :param chunk_rows: Optional parameter, the number of rows fetched at a time. Defaults to EXTRACTION_SETTINGS["chunk_rows"].
+    :param spill_path: Optional parameter, a Parquet file to which the chunks are written instead of building a DataFrame. Defaults to None.
+    :param downcast_floats: Optional parameter, whether floats and DECIMAL values are stored as float32, losing precision. Defaults to EXTRACTION_SETTINGS["downcast_floats"].
+    :param categorical_ratio: Optional parameter, the share of distinct values below which text becomes categorical. Defaults to EXTRACTION_SETTINGS["categorical_ratio"].
+    :return: A tuple of the DataFrame (None when spilling) and the statistics of the extraction.
+    """
+    chunk_rows = chunk_rows or EXTRACTION_SETTINGS["chunk_rows"]
+    downcast_floats = EXTRACTION_SETTINGS["downcast_floats"] if downcast_floats is None else downcast_floats
+    categorical_ratio = EXTRACTION_SETTINGS["categorical_ratio"] if categorical_ratio is None else categorical_ratio
+    stats = {"query": sql_query, "rows": 0, "chunks": 0, "spill_path": spill_path}
+    spill = ParquetSpill(spill_path) if spill_path is not None else None
+    chunks = []
+    kinds = None
+
+    start_time = time.perf_counter()
+    start_peak = process_peak_rss_bytes()
+    pool = get_pool()
+    pooled = pool.acquire()
+    try:
+        cursor = server_side_cursor(pooled.connection)
+        cursor.execute(sql_query)
+        columns = [description[0] for description in cursor.description]
+        for rows in fetch_chunks(cursor, chunk_rows):
+            stats["rows"] += len(rows)
+            stats["chunks"] += 1
+            kinds = column_kinds(columns, rows, kinds, categorical_ratio)
+            # The Parquet schema is fixed by the first chunk, so the spilled chunks keep 64-bit integers and text instead of categories
+            df = build_frame(columns, rows, kinds, compact=spill is None, downcast_floats=downcast_floats)
+            rows = None
+            if spill is not None:
+                spill.write(df)
+            else:
+                chunks.append(df)
+        cursor.close()
+    except BaseException:
+        # An unread server-side cursor would be drained row by row before the connection could be reused, the connection is closed instead
+        pool.release(pooled, discard=True)
+        raise
+    else:
+        pool.release(pooled)
+    finally:
+        if spill is not None:
+            spill.close()
+
+    result = None
+    if spill is None:
+        result = concat_chunks(chunks, kinds or [])
+        chunks = None
+        stats["memory_bytes"] = int(result.memory_usage(deep=True).sum())
+    stats["seconds"] = time.perf_counter() - start_time
+    stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] > 0 else None
+    # ru_maxrss only gives the peak of the whole process, the growth of that peak during the extraction is a lower bound of the memory it used
+    stats["process_peak_rss_bytes"] = process_peak_rss_bytes()
+    stats["peak_rss_growth_bytes"] = stats["process_peak_rss_bytes"] - start_peak if start_peak is not None else None
+    with _history_lock:
+        _history.append(stats)
+    return result, stats
+
+
+def extract_streaming(sql_query, df_name, g):
+    """
+    Streaming mode of extract_data: the table is read chunk by chunk into g[df_name], or written to a Parquet file of spill_dir whose path is stored in g[df_name].
+    Each spill file gets a unique name, so sessions and batch workers using the same df_name do not overwrite each other's files.
+    Without spill_dir the peak memory is about twice the size of the DataFrame, see stream_extract.
+    :return: The message returned to the model, with the number of rows, the memory used and the rows read per second.
+    """
+    spill_dir = EXTRACTION_SETTINGS["spill_dir"]
+    if spill_dir is not None:
+        os.makedirs(spill_dir, exist_ok=True)
+        descriptor, spill_path = tempfile.mkstemp(prefix="%s-" % df_name, suffix=".parquet", dir=spill_dir)
+        os.close(descriptor)
+        try:
+            _, stats = stream_extract(sql_query, spill_path=spill_path)
+        except BaseException:
+            os.remove(spill_path)
+            raise
+        g[df_name] = spill_path
+        return ("The result has %d rows and was written to the Parquet file %s, stored in the %s variable; read the columns you need with pd.read_parquet(%s, columns=[...]). "
+                "Read %.0f rows per second." % (stats["rows"], spill_path, df_name, df_name, stats["rows_per_second"] or 0))
+
+    g[df_name], stats = stream_extract(sql_query)
+    return ("Successfully completed the creation of the %s variable: %d rows, %.1f MB in memory, read %.0f rows per second."
+            % (df_name, stats["rows"], stats["memory_bytes"] / 2 ** 20, stats["rows_per_second"] or 0))
+
+
+if __name__ == '__main__':
+    print("this file contains the streaming extraction of large tables")
@@ -0,0 +1,131 @@
+# Decisions returned by an interaction policy
+APPROVE = "approve"
+MODIFY = "modify"
+NEW_QUESTION = "new_question"
+EXIT = "exit"
+WAIT = "wait"
+SWITCH_MODEL = "switch_model"
+
+
+class InteractionPolicy():
+    """
+    The InteractionPolicy class takes the decisions of a conversation that need a human: approving code before it runs, reviewing an answer or a task decomposition,
+    rephrasing an unclear question and handling a connection error. This default policy asks the user with input(), with the prompts of the interactive agent.
+    Subclasses, e.g. AutoPolicy, take the decisions without a human, so the agent can run unattended.
+    """
+
+    def review_code(self, code):
+        """
+        Decide whether code written by the model runs, in developer mode.
+        :param code: The code as markdown.
+        :return: A tuple (APPROVE, None) or (MODIFY, feedback for the model).
+        """
+        user_input = input("Run code directly (1) or provide feedback and let the model modify the code before running it (2)?")
+        if user_input == '1':
+            return APPROVE, None
+        return MODIFY, input("Okay, please provide modification feedback:")
+
+    def review_text(self, answer):
+        """
+        Decide what happens with an answer of the model, in developer mode.
+        :param answer: The text of the answer.
+        :return: A tuple (APPROVE, None) to record the answer, (MODIFY, feedback), (NEW_QUESTION, question) or (EXIT, None).
+        """
+        user_input = input("Would you like to record the answer (1),\
+        provide modification feedback (2),\
+        ask a new question (3),\
+        or exit the conversation (4)?")
+        return self._review_choice(user_input)
+
+    def review_task_decomposition(self, plan):
+        """
+        Decide whether the task decomposition of the model is executed, in enhanced mode.
+        :param plan: The text of the task decomposition.
+        :return: A tuple (APPROVE, None) to execute the plan, (MODIFY, feedback), (NEW_QUESTION, question) or (EXIT, None).
+        """
+        user_input = input("Would you like to execute the task according to this process (1),\
+        provide modification feedback on the current process (2),\
+        ask a new question (3),\
+        or exit the conversation (4)?")
+        return self._review_choice(user_input)
+
+    def _review_choice(self, user_input):
+        if user_input == '1':
+            return APPROVE, None
+        if user_input == '2':
+            return MODIFY, input("Okay, enter your modification feedback for the model's result:")
+        if user_input == '3':
+            return NEW_QUESTION, input("Okay, please ask a new question:")
+        return EXIT, None
+
+    def rephrase_question(self, suggestion):
+        """
+        Ask for a clearer question after the model could not answer, in enhanced mode.
+        :param suggestion: The model's suggestion on how to rephrase the question.
+        :return: The new question, or None to exit the conversation.
+        """
+        user_input = input("Please re-enter your question, enter 'exit' to exit the current conversation")
+        if user_input == "exit":
+            return None
+        return user_input
+
+    def connection_error(self, error):
+        """
+        Decide how to continue after a connection error, in developer mode.
+        :param error: The exception raised by the request.
+        :return: A tuple (WAIT, None) to retry after a backoff, (SWITCH_MODEL, model name) or (EXIT, None) to raise the error.
+        """
+        user_input = input("Please choose to wait and retry (1), change model (2), or exit with an error (3)")
+        if user_input == '1':
+            return WAIT, None
+        if user_input == '2':
+            return SWITCH_MODEL, input("Okay, please enter the new model name")
+        return EXIT, None
+
+    def next_question(self):
+        """
+        Ask for the next question of a multi-round conversation.
+        :return: The next question, or None to end the conversation.
+        """
+        user_input = input(" Do you have any other questions? (Enter 'exit' to end the conversation) ")
+        if user_input == "exit":
+            return None
+        return user_input
+
+
+class AutoPolicy(InteractionPolicy):
+    """
+    The AutoPolicy class takes every decision without a human: code is run, answers are recorded, task decompositions are executed,
+    a connection error is retried after a backoff and an unclear question ends the conversation.
+    The next questions of a multi-round conversation are taken from an optional iterable of questions.
+    """
+
+    def __init__(self, questions=None):
+        self.questions = iter(questions) if questions is not None else None
+
+    def review_code(self, code):
+        return APPROVE, None
+
+    def review_text(self, answer):
+        return APPROVE, None
+
+    def review_task_decomposition(self, plan):
+        return APPROVE, None
+
+    def rephrase_question(self, suggestion):
+        return None
+
+    def connection_error(self, error):
+        return WAIT, None
+
+    def next_question(self):
+        if self.questions is None:
+            return None
+        return next(self.questions, None)
+
+
+DEFAULT_INTERACTION_POLICY = InteractionPolicy()
+
+
+if __name__ == '__main__':
+    print("this file contains the interaction policies of the agent")
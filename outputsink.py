@@ -0,0 +1,150 @@
+import sys
+import json
+import time
+import threading
+from IPython.display import display, Markdown
+from streaming import MarkdownStreamSink
+
+# Kinds of output, so that a consumer of the output can tell the answers apart from code, debugging and status messages
+ANSWER = "answer"
+CODE = "code"
+DEBUG = "debug"
+ERROR = "error"
+STATUS = "status"
+
+
+class NotebookSink():
+    """
+    The NotebookSink class shows the output of a conversation in a notebook: status messages are printed and markdown is rendered with display(Markdown(...)).
+    This is the default output of the agent.
+    """
+
+    def text(self, content, kind=STATUS):
+        print(content)
+
+    def markdown(self, content, kind=STATUS):
+        display(Markdown(content))
+
+    def stream(self, header="Model's Answer:\n"):
+        """
+        Return the object rendering the text deltas of a streamed answer, with write(delta) and close() methods, or None to render nothing.
+        """
+        return MarkdownStreamSink(header=header)
+
+
+class TextStreamWriter():
+    """
+    Writes the text deltas of a streamed answer to a text file as they arrive, the header is written before the first delta.
+    """
+
+    def __init__(self, file, header):
+        self.file = file
+        self.header = header
+        self.started = False
+
+    def write(self, delta):
+        if not self.started:
+            print(self.header, file=self.file)
+            self.started = True
+        self.file.write(delta)
+        self.file.flush()
+
+    def close(self):
+        if self.started:
+            self.file.write('\n')
+            self.file.flush()
+
+
+class TextSink():
+    """
+    The TextSink class writes the output of a conversation as plain text, e.g. to the console of a script or to a log file. Markdown is written as it is.
+    """
+
+    def __init__(self, file=None):
+        """
+        :param file: Optional parameter, a text file object, None for sys.stdout.
+        """
+        self.file = file
+
+    def text(self, content, kind=STATUS):
+        print(content, file=self.file or sys.stdout)
+
+    def markdown(self, content, kind=STATUS):
+        print(content, file=self.file or sys.stdout)
+
+    def stream(self, header="Model's Answer:\n"):
+        return TextStreamWriter(self.file or sys.stdout, header)
+
+
+class JSONStreamWriter():
+    """
+    Collects the text deltas of a streamed answer and emits the complete answer as one event when the stream is closed.
+    """
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.content = ''
+
+    def write(self, delta):
+        self.content += delta
+
+    def close(self):
+        if self.content:
+            self.sink.emit("markdown", self.content, ANSWER)
+
+
+class JSONSink():
+    """
+    The JSONSink class records the output of a conversation as events {"time", "type", "kind", "content"}, for a worker or a service consuming the agent's output.
+    The events are kept in self.events, and also written as JSON lines to a file if one is given.
+    """
+
+    def __init__(self, file=None, keep_events=True):
+        """
+        :param file: Optional parameter, a text file object to which each event is written as one JSON line.
+        :param keep_events: Optional parameter, whether the events are kept in self.events.
+        """
+        self.file = file
+        self.keep_events = keep_events
+        self.events = []
+        self._lock = threading.Lock()
+
+    def emit(self, type, content, kind):
+        event = {"time": time.time(), "type": type, "kind": kind, "content": content}
+        with self._lock:
+            if self.keep_events:
+                self.events.append(event)
+            if self.file is not None:
+                self.file.write(json.dumps(event, ensure_ascii=False, default=str) + '\n')
+                self.file.flush()
+
+    def text(self, content, kind=STATUS):
+        self.emit("text", content, kind)
+
+    def markdown(self, content, kind=STATUS):
+        self.emit("markdown", content, kind)
+
+    def stream(self, header="Model's Answer:\n"):
+        return JSONStreamWriter(self)
+
+
+class SilentSink():
+    """
+    The SilentSink class drops every output, for unattended runs that only use the returned messages.
+    """
+
+    def text(self, content, kind=STATUS):
+        pass
+
+    def markdown(self, content, kind=STATUS):
+        pass
+
+    def stream(self, header="Model's Answer:\n"):
+        return None
+
+
+DEFAULT_OUTPUT_SINK = NotebookSink()
+
+
+if __name__ == '__main__':
+    print("this file contains the output sinks of the agent")
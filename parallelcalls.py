@@ -0,0 +1,243 @@
+import ast
+import copy
+import json
+import builtins
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Name of the function through which the model asks for several external function calls at once
+PARALLEL_FUNCTION_NAME = "multi_function_call"
+
+PARALLEL_FUNCTION_DESCRIPTION = {
+    "name": PARALLEL_FUNCTION_NAME,
+    "description": "Run several external function calls in one step, e.g. loading several tables with extract_data or running several independent sql_inter queries. "
+                   "Calls that do not depend on each other run at the same time, a call using a variable created by an earlier call of the list waits for it. "
+                   "The results of all calls are returned together, in the order of the calls.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "calls": {
+                "type": "array",
+                "description": "The external function calls, in the order in which they would be run one at a time.",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "name": {"type": "string", "description": "The name of the external function, e.g. extract_data."},
+                        "arguments": {"type": "object", "description": "The arguments of the external function, e.g. sql_query and df_name."}
+                    },
+                    "required": ["name", "arguments"]
+                }
+            }
+        },
+        "required": ["calls"]
+    }
+}
+
+# External functions running Python code in the shared namespace, and the argument holding the code
+PYTHON_FUNCTIONS = {"python_inter": "py_code", "fig_inter": "py_code"}
+# External functions whose only effect on the namespace is creating the variable named by an argument
+VARIABLE_FUNCTIONS = {"extract_data": "df_name"}
+# External functions that do not use the namespace
+STATELESS_FUNCTIONS = {"sql_inter"}
+# External functions that must run alone, e.g. because matplotlib keeps global state
+EXCLUSIVE_FUNCTIONS = {"fig_inter"}
+
+# Thread pool running the calls of a multi_function_call, separate from the pool running the external functions of the async engine,
+# so that a multi_function_call running in that pool can always start its calls
+PARALLEL_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="mategen-parallel")
+
+BUILTIN_NAMES = set(dir(builtins))
+
+
+def python_names(py_code):
+    """
+    Find the variables a piece of Python code reads and writes in the namespace.
+    Assignments, augmented assignments, del, imports, function and class definitions and item or attribute assignments (df['x'] = ..., df.x = ...) count as writes.
+    :param py_code: Required parameter, the Python code as a string.
+    :return: A tuple of the set of names read and the set of names written. SyntaxError is raised for code that cannot be parsed.
+    """
+    tree = ast.parse(py_code)
+    reads = set()
+    writes = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if isinstance(node.ctx, ast.Load):
+                reads.add(node.id)
+            else:
+                writes.add(node.id)
+        elif isinstance(node, (ast.Attribute, ast.Subscript)) and not isinstance(node.ctx, ast.Load):
+            # df['x'] = ... changes df
+            base = node.value
+            while isinstance(base, (ast.Attribute, ast.Subscript)):
+                base = base.value
+            if isinstance(base, ast.Name):
+                writes.add(base.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            writes.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                writes.add((alias.asname or alias.name).split('.')[0])
+    return reads - BUILTIN_NAMES, writes
+
+
+class PlannedCall():
+    """
+    The PlannedCall class describes one call of a multi_function_call: the variables of the namespace it reads and writes,
+    and the earlier calls of the list it has to wait for.
+    """
+    __slots__ = ('index', 'name', 'arguments', 'reads', 'writes', 'is_python', 'exclusive', 'depends_on')
+
+    def __init__(self, index, name, arguments):
+        self.index = index
+        self.name = name
+        self.arguments = arguments
+        self.reads = set()
+        self.writes = set()
+        self.is_python = name in PYTHON_FUNCTIONS
+        self.exclusive = name in EXCLUSIVE_FUNCTIONS
+        self.depends_on = set()
+
+        if self.is_python:
+            try:
+                self.reads, self.writes = python_names(arguments.get(PYTHON_FUNCTIONS[name], ''))
+            except SyntaxError:
+                # The error is reported when the call runs, meanwhile nothing is known about the code
+                self.exclusive = True
+        elif name in VARIABLE_FUNCTIONS:
+            self.writes = {arguments.get(VARIABLE_FUNCTIONS[name])}
+        elif name not in STATELESS_FUNCTIONS:
+            # Nothing is known about other functions, they run alone
+            self.exclusive = True
+
+    def conflicts_with(self, other):
+        # Two calls have to keep their order if one uses a variable the other writes
+        if self.writes & (other.reads | other.writes) or other.writes & self.reads:
+            return True
+        if self.exclusive or other.exclusive:
+            return True
+        # Python code runs with exec in one shared namespace, and python_inter reports every variable created while it runs,
+        # so a Python call never runs at the same time as another Python call or a call creating a variable
+        if self.is_python and (other.is_python or other.writes):
+            return True
+        if other.is_python and self.writes:
+            return True
+        return False
+
+
+def plan_calls(calls):
+    """
+    Create the PlannedCall objects of a list of calls, each depending on the earlier calls it conflicts with.
+    :param calls: Required parameter, a list of dictionaries with the name and the arguments of each call.
+    :return: A list of PlannedCall objects, in the order of calls.
+    """
+    planned_calls = []
+    for index, call in enumerate(calls):
+        arguments = call.get("arguments") or {}
+        if isinstance(arguments, str):
+            arguments = json.loads(arguments)
+        planned_call = PlannedCall(index, call.get("name"), arguments)
+        planned_call.depends_on = {earlier.index for earlier in planned_calls if planned_call.conflicts_with(earlier)}
+        planned_calls.append(planned_call)
+    return planned_calls
+
+
+def run_planned_call(functions_dic, planned_call, g):
+    # Same error handling as function_to_call, an error is returned as the result of the call, with True as the failure flag
+    try:
+        function = functions_dic[planned_call.name]
+        return function(**planned_call.arguments, g=g), False
+    except Exception as e:
+        return "The function encountered an error as follows:" + str(e), True
+
+
+def run_calls(functions_dic, calls, g, executor=PARALLEL_EXECUTOR):
+    """
+    Run a list of external function calls in a thread pool. A call starts as soon as the earlier calls it depends on are finished,
+    a call depending on a failed call is skipped.
+    :param functions_dic: Required parameter, the dictionary of the external functions by name.
+    :param calls: Required parameter, a list of dictionaries with the name and the arguments of each call.
+    :param g: Required parameter, the namespace in which the external functions create their variables.
+    :param executor: Optional parameter, the thread pool running the calls.
+    :return: The list of the results of the calls, in the order of calls.
+    """
+    planned_calls = plan_calls(calls)
+    results = [None] * len(planned_calls)
+    failed = set()
+    finished = set()
+    pending = list(planned_calls)
+    running = {}
+
+    while pending or running:
+        # Start every call whose dependencies are finished
+        for planned_call in [planned_call for planned_call in pending if planned_call.depends_on <= finished]:
+            pending.remove(planned_call)
+            failed_dependencies = planned_call.depends_on & failed
+            if failed_dependencies:
+                results[planned_call.index] = "Skipped because call %d returned an error." % (min(failed_dependencies) + 1)
+                failed.add(planned_call.index)
+                finished.add(planned_call.index)
+            else:
+                running[executor.submit(run_planned_call, functions_dic, planned_call, g)] = planned_call
+        if not running:
+            continue
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            planned_call = running.pop(future)
+            result, call_failed = future.result()
+            results[planned_call.index] = result
+            if call_failed:
+                failed.add(planned_call.index)
+            finished.add(planned_call.index)
+
+    return results
+
+
+def make_parallel_function(functions_dic):
+    """
+    Create the multi_function_call external function running calls of the functions in functions_dic.
+    """
+    def multi_function_call(calls, g='globals()'):
+        results = run_calls(functions_dic, calls, g)
+        return json.dumps([{"name": call.get("name"), "result": result} for call, result in zip(calls, results)],
+                          ensure_ascii=False, default=str)
+
+    return multi_function_call
+
+
+def add_parallel_function(available_functions):
+    """
+    Let the model of a conversation ask for several external function calls at once, by adding the multi_function_call function
+    to a copy of an AvailableFunctions object. The object given is left unchanged, so that the sessions sharing it keep their functions.
+    :return: The copy with multi_function_call, or the object itself if it is None or already has multi_function_call.
+    """
+    if available_functions is None or PARALLEL_FUNCTION_NAME in available_functions.functions_dic:
+        return available_functions
+    parallel_functions = copy.copy(available_functions)
+    parallel_functions.functions_list = list(available_functions.functions_list)
+    parallel_functions.functions_dic = dict(available_functions.functions_dic)
+    parallel_functions.functions_dic[PARALLEL_FUNCTION_NAME] = make_parallel_function(dict(available_functions.functions_dic))
+    parallel_functions.functions = available_functions.functions + [PARALLEL_FUNCTION_DESCRIPTION]
+    return parallel_functions
+
+
+def calls_to_markdown(calls):
+    """
+    Convert the calls of a multi_function_call into markdown, printing the code of each call.
+    """
+    blocks = []
+    for index, call in enumerate(calls):
+        arguments = call.get("arguments") or {}
+        if isinstance(arguments, str):
+            arguments = json.loads(arguments)
+        blocks.append("**%d. %s**" % (index + 1, call.get("name")))
+        if arguments.get('sql_query'):
+            blocks.append(f"```sql\n{arguments['sql_query']}\n```")
+        if arguments.get('py_code'):
+            blocks.append(f"```python\n{arguments['py_code']}\n```")
+        if arguments.get('df_name'):
+            blocks.append("saved as `%s`" % arguments['df_name'])
+    return "\n\n".join(blocks)
+
+
+if __name__ == '__main__':
+    print("this file contains functions to run independent external function calls concurrently")
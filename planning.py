@@ -80,25 +80,26 @@ def modify_prompt(messages, action='add', enable_md_output=True, enable_COT=True
     # Markdown output prompt template
     md_prompt = "Please format all responses in markdown."
 
+    # The last message is shared with copies of messages, so its content is replaced through set_message_content
+    content = messages.history_messages[-1]["content"]
+
     # If adding prompts
     if action == 'add':
         if enable_COT:
-            messages.messages[-1]["content"] += cot_prompt
-            messages.history_messages[-1]["content"] += cot_prompt
+            content += cot_prompt
 
         if enable_md_output:
-            messages.messages[-1]["content"] += md_prompt
-            messages.history_messages[-1]["content"] += md_prompt
+            content += md_prompt
 
     # If removing specified prompts
     elif action == 'remove':
         if enable_md_output:
-            messages.messages[-1]["content"] = messages.messages[-1]["content"].replace(md_prompt, "")
-            messages.history_messages[-1]["content"] = messages.history_messages[-1]["content"].replace(md_prompt, "")
+            content = content.replace(md_prompt, "")
 
         if enable_COT:
-            messages.messages[-1]["content"] = messages.messages[-1]["content"].replace(cot_prompt, "")
-            messages.history_messages[-1]["content"] = messages.history_messages[-1]["content"].replace(cot_prompt, "")
+            content = content.replace(cot_prompt, "")
+
+    messages.set_message_content(-1, content)
 
     return messages
 
@@ -0,0 +1,366 @@
+import re
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from dbpool import get_pool
+
+# Tokens of a SQL statement: comments, string literals, quoted identifiers, numbers, words, whitespace and single characters
+# MySQL executable comments /*! ... */ are kept, they are part of the statement
+SQL_TOKEN = re.compile(r"(?P<comment>--[^\n]*|#[^\n]*|/\*(?!!).*?\*/)"
+                       r"|(?P<string>'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\")"
+                       r"|(?P<identifier>`(?:[^`]|``)*`)"
+                       r"|(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)"
+                       r"|(?P<word>[A-Za-z_][\w$]*)"
+                       r"|(?P<space>\s+)"
+                       r"|(?P<other>.)", re.DOTALL)
+
+# Keywords written in lower case by normalize_sql, identifiers keep their case since MySQL table names can be case-sensitive
+SQL_KEYWORDS = {"select", "from", "where", "and", "or", "not", "in", "is", "null", "as", "on", "join", "inner", "left", "right", "outer", "cross",
+                "group", "by", "order", "having", "limit", "offset", "asc", "desc", "distinct", "union", "all", "case", "when", "then", "else", "end",
+                "between", "like", "exists", "with", "count", "sum", "avg", "min", "max", "round", "show", "tables", "describe", "explain",
+                "insert", "into", "values", "update", "set", "delete", "replace", "create", "drop", "alter", "rename", "truncate", "table",
+                "database", "index", "view", "load", "data", "for", "lock", "share", "mode", "true", "false", "cast", "if", "ifnull", "coalesce"}
+
+# Statements whose result can be cached, and statements changing the definition of the tables
+READ_STATEMENTS = {"select", "show", "describe", "desc", "explain"}
+SCHEMA_STATEMENTS = {"create", "drop", "alter", "rename", "truncate"}
+# Statements that can follow the common table expressions of a WITH clause, and the ones among them changing tables
+CTE_STATEMENTS = {"select", "insert", "update", "delete", "replace"}
+CTE_WRITE_STATEMENTS = {"insert", "update", "delete", "replace"}
+# Functions whose result changes between two runs of the same query, such queries are not cached
+NONDETERMINISTIC_FUNCTIONS = {"now", "rand", "random", "uuid", "uuid_short", "sysdate", "curdate", "curtime", "current_date", "current_time",
+                              "current_timestamp", "localtime", "localtimestamp", "unix_timestamp", "utc_date", "utc_time", "utc_timestamp",
+                              "connection_id", "last_insert_id", "found_rows", "row_count", "sleep", "get_lock"}
+
+# Words written in lower case by normalize_sql
+LOWER_CASE_WORDS = SQL_KEYWORDS | NONDETERMINISTIC_FUNCTIONS
+
+# Words after which a table name follows
+TABLE_PREFIXES = {"from", "join", "update", "into", "table", "describe", "desc"}
+
+DEFAULT_QUERY_CACHE_ENTRIES = 1000
+# Seconds during which the versions of the tables read from the server are trusted without asking the server again
+DEFAULT_VERSION_CHECK_INTERVAL = 5.0
+# MySQL errors of a missing table: ER_NO_SUCH_TABLE and ER_UNKNOWN_TABLE
+MISSING_TABLE_ERRORS = {1146, 1109}
+
+
+def sql_tokens(sql):
+    """
+    Split a SQL statement into normalized tokens: comments and whitespace are dropped, keywords are written in lower case,
+    string literals use single quotes and plain quoted identifiers lose their backticks.
+    """
+    tokens = []
+    for match in SQL_TOKEN.finditer(sql):
+        kind = match.lastgroup
+        text = match.group()
+        if kind in ("comment", "space"):
+            continue
+        if kind == "string" and text[0] == '"':
+            text = "'%s'" % text[1:-1].replace('""', '"').replace("'", "''")
+        elif kind == "identifier" and re.fullmatch(r"`[A-Za-z_]\w*`", text):
+            text = text[1:-1]
+        elif kind == "number" and text.isdigit():
+            text = str(int(text))
+        elif kind == "word" and text.lower() in LOWER_CASE_WORDS:
+            text = text.lower()
+        tokens.append(text)
+    # A trailing semicolon does not change the statement
+    while tokens and tokens[-1] == ";":
+        tokens.pop()
+    return tokens
+
+
+def normalize_sql(sql):
+    """
+    Return the normalized text of a SQL statement, the same for statements differing only in whitespace, comments, keyword case and quoting,
+    e.g. "SELECT COUNT(*) FROM user_demographics;" and "select count( * )\nfrom `user_demographics`".
+    """
+    return " ".join(sql_tokens(sql))
+
+
+def _is_name(token):
+    return (token[0].isalpha() or token[0] in "_`") and token not in SQL_KEYWORDS
+
+
+def _table_name(token):
+    return token[1:-1].replace("``", "`") if token.startswith("`") else token
+
+
+def statement_keyword(tokens):
+    """
+    Return the keyword deciding what a normalized statement does: its first word, or for a WITH statement the first statement keyword
+    after the common table expressions, e.g. "update" for WITH ids AS (SELECT ...) UPDATE ...
+    The common table expressions are in parentheses, so the keyword is the first of CTE_STATEMENTS outside any parentheses.
+    """
+    if not tokens:
+        return ""
+    first = tokens[0].lower()
+    if first != "with":
+        return first
+    depth = 0
+    for token in tokens[1:]:
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif depth == 0 and token in CTE_STATEMENTS:
+            return token
+    return first
+
+
+def referenced_tables(tokens):
+    """
+    Return the names of the tables read or written by a normalized statement: the names after FROM, JOIN, UPDATE, INTO, TABLE and DESCRIBE,
+    including the comma-separated tables of a FROM clause. A database prefix is kept, e.g. telco_db.user_demographics.
+    The names are in lower case, so that the versions of Users and users are the same: a needless invalidation on a server with
+    case-sensitive table names is better than a stale result.
+    """
+    tables = set()
+    index = 0
+    while index < len(tokens):
+        if tokens[index] not in TABLE_PREFIXES:
+            index += 1
+            continue
+        index += 1
+        while index < len(tokens):
+            token = tokens[index]
+            if not _is_name(token):
+                break
+            name = _table_name(token)
+            if index + 2 < len(tokens) and tokens[index + 1] == ".":
+                name = "%s.%s" % (name, _table_name(tokens[index + 2]))
+                index += 2
+            tables.add(name.lower())
+            index += 1
+            # Skip an alias, then continue with the next table of a comma-separated list
+            if index < len(tokens) and tokens[index] == "as":
+                index += 1
+            if index < len(tokens) and _is_name(tokens[index]):
+                index += 1
+            if index < len(tokens) and tokens[index] == ",":
+                index += 1
+                continue
+            break
+    return tables
+
+
+class QueryTicket():
+    """
+    The lookup of one statement in the QueryCache: its normalized text, the tables it uses and their versions before the statement runs,
+    and the cached result if there is one.
+    """
+    __slots__ = ('key', 'kind', 'tables', 'versions', 'result')
+
+    def __init__(self, key, kind, tables, versions=None, result=None):
+        self.key = key
+        # "read" for a cacheable query, "write" for a statement changing tables, "uncached" for any other statement
+        self.kind = kind
+        self.tables = tables
+        self.versions = versions
+        self.result = result
+
+
+class QueryCache():
+    """
+    The QueryCache class keeps the results of sql_inter read queries by normalized SQL text, so that a query asked again in a later turn or by another session
+    is answered from memory. An entry is only used while the tables it read have the version they had when it was stored:
+    a write through sql_inter increments the version of the tables it changes (a schema change increments all versions), and writes by other clients are detected
+    with the UPDATE_TIME and CREATE_TIME of the tables in information_schema, read again at most every version_check_interval seconds.
+    UPDATE_TIME of InnoDB tables can stay NULL or lag behind the writes, so results of tables written by other clients can be stale; the cache is opt-in for that reason.
+    Write statements, including WITH ... UPDATE/DELETE/INSERT/REPLACE, and queries calling nondeterministic functions such as NOW() or RAND() are never cached.
+    """
+
+    def __init__(self,
+                 max_entries=DEFAULT_QUERY_CACHE_ENTRIES,
+                 ttl=None,
+                 version_check_interval=DEFAULT_VERSION_CHECK_INTERVAL,
+                 server_versions=True):
+        """
+        :param max_entries: Optional parameter, the number of results kept, the least recently used results are evicted first.
+        :param ttl: Optional parameter, the number of seconds a result stays valid whatever the table versions, None means no limit.
+        :param version_check_interval: Optional parameter, the number of seconds the server versions of a table are trusted, 0 to ask the server at every lookup.
+        :param server_versions: Optional parameter, whether the versions of the tables are also read from information_schema, to detect writes by other clients.
+        Defaults to True, it is turned off automatically if the database has no information_schema, e.g. the SQLite stand-in.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_check_interval = version_check_interval
+        self.server_versions = server_versions
+        # normalized SQL -> (created_at, versions, result)
+        self._entries = OrderedDict()
+        # Versions of the tables written through the cache, and the version of the whole schema
+        self._local_versions = {}
+        self._schema_version = 0
+        # table -> (checked_at, server version)
+        self._server_versions = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "uncached": 0, "writes": 0, "evictions": 0, "hit_time": 0.0}
+
+    def read_server_versions(self, tables):
+        """
+        Read the UPDATE_TIME and CREATE_TIME of tables from information_schema. MySQL 8 caches these values, the cache is disabled for the session first.
+        :return: A dictionary of the versions of the tables, or None if the database has no information_schema, e.g. the SQLite stand-in.
+        Any other error, e.g. a lost connection, is raised.
+        """
+        names = [table.split(".")[-1] for table in tables]
+        with get_pool().connection() as connection:
+            if isinstance(connection, sqlite3.Connection):
+                return None
+            cursor = connection.cursor()
+            try:
+                try:
+                    cursor.execute("SET SESSION information_schema_stats_expiry = 0")
+                except Exception:
+                    # MySQL 5.7 has no such variable and does not cache the values
+                    pass
+                try:
+                    cursor.execute("SELECT TABLE_NAME, UPDATE_TIME, CREATE_TIME FROM information_schema.TABLES "
+                                   "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN (%s)" % ", ".join(["%s"] * len(names)), names)
+                except Exception as error:
+                    if error.args and error.args[0] in MISSING_TABLE_ERRORS:
+                        return None
+                    raise
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+        found = {row[0].lower(): (row[1], row[2]) for row in rows}
+        return {table: found.get(table.split(".")[-1]) for table in tables}
+
+    def _current_versions(self, tables):
+        # Versions of the tables, asking the server for the ones not checked within version_check_interval,
+        # None if the server could not be asked, the query then runs without the cache and the versions are read again at the next lookup
+        now = time.monotonic()
+        if self.server_versions:
+            with self._lock:
+                outdated = [table for table in tables
+                            if table not in self._server_versions or now - self._server_versions[table][0] >= self.version_check_interval]
+            if outdated:
+                try:
+                    server_versions = self.read_server_versions(outdated)
+                except Exception:
+                    return None
+                if server_versions is None:
+                    # No information_schema, e.g. the SQLite stand-in, only the writes through the cache are tracked
+                    self.server_versions = False
+                else:
+                    with self._lock:
+                        for table, version in server_versions.items():
+                            self._server_versions[table] = (now, version)
+        with self._lock:
+            return (self._schema_version,
+                    tuple((table,
+                           self._local_versions.get(table, 0),
+                           self._server_versions[table][1] if self.server_versions and table in self._server_versions else None)
+                          for table in sorted(tables)))
+
+    def lookup(self, sql):
+        """
+        Look up a statement before it runs.
+        :return: A QueryTicket, whose result is the cached result of the query if it is cached with the current table versions, or None.
+        """
+        start_time = time.perf_counter()
+        tokens = sql_tokens(sql)
+        key = " ".join(tokens)
+        first = statement_keyword(tokens)
+        tables = referenced_tables(tokens)
+
+        # A WITH statement changing a table in its statement or in a common table expression, or whose statement is not recognized, is handled as a write
+        if tokens and tokens[0] == "with" and (first == "with" or CTE_WRITE_STATEMENTS.intersection(tokens)):
+            first = "update"
+        if first not in READ_STATEMENTS and (first in SCHEMA_STATEMENTS or tables):
+            return QueryTicket(key, "write", tables)
+        # SELECT ... INTO and locking reads change state or hold locks, queries with nondeterministic functions give a new result each time
+        if first not in READ_STATEMENTS or "into" in tokens or ("for" in tokens and "update" in tokens) or ("lock" in tokens and "share" in tokens) \
+                or NONDETERMINISTIC_FUNCTIONS.intersection(tokens):
+            with self._lock:
+                self.stats["uncached"] += 1
+            return QueryTicket(key, "uncached", tables)
+
+        versions = self._current_versions(tables)
+        if versions is None:
+            with self._lock:
+                self.stats["uncached"] += 1
+            return QueryTicket(key, "uncached", tables)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created_at, entry_versions, result = entry
+                if entry_versions == versions and (self.ttl is None or time.monotonic() - created_at <= self.ttl):
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    self.stats["hit_time"] += time.perf_counter() - start_time
+                    return QueryTicket(key, "read", tables, versions, result)
+                del self._entries[key]
+                self.stats["stale"] += 1
+            self.stats["misses"] += 1
+        return QueryTicket(key, "read", tables, versions)
+
+    def store(self, ticket, result):
+        """
+        Record a statement that ran: the result of a read query is stored with the table versions seen before it ran,
+        a write increments the versions of the tables it changed, or of every table for a schema change.
+        """
+        with self._lock:
+            if ticket.kind == "read":
+                self._entries[ticket.key] = (time.monotonic(), ticket.versions, result)
+                self._entries.move_to_end(ticket.key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.stats["evictions"] += 1
+            elif ticket.kind == "write":
+                self.stats["writes"] += 1
+                first = ticket.key.split(" ", 1)[0].lower()
+                if first in SCHEMA_STATEMENTS:
+                    self._schema_version += 1
+                for table in ticket.tables:
+                    self._local_versions[table] = self._local_versions.get(table, 0) + 1
+                    # The server version of a written table is read again at the next lookup
+                    self._server_versions.pop(table, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._server_versions.clear()
+
+    def report(self):
+        """
+        Return the statistics of the cache: hits, misses, stale entries, uncached statements, writes, hit rate and mean hit latency.
+        """
+        with self._lock:
+            report = dict(self.stats, entries=len(self._entries))
+        lookups = report["hits"] + report["misses"]
+        report["hit_rate"] = report["hits"] / lookups if lookups else 0.0
+        report["mean_hit_time"] = report["hit_time"] / report["hits"] if report["hits"] else None
+        return report
+
+
+# Process-wide query cache of sql_inter, None until it is enabled with configure_query_cache
+_query_cache = None
+_query_cache_lock = threading.Lock()
+
+
+def get_query_cache():
+    """
+    Return the query cache shared by every session of the process, or None if it was not enabled with configure_query_cache().
+    """
+    return _query_cache
+
+
+def configure_query_cache(enabled=True, **options):
+    """
+    Enable or replace the shared query cache of sql_inter, e.g. to change its size or version_check_interval, or disable it.
+    The cache is off until this function is called: a lookup can read information_schema, and writes by other clients are only seen through UPDATE_TIME.
+    :param enabled: Optional parameter, whether sql_inter caches the results of read queries. Default is True.
+    :param options: Optional parameters of QueryCache: max_entries, ttl, version_check_interval and server_versions.
+    :return: The new cache, or None if it is disabled.
+    """
+    global _query_cache
+    with _query_cache_lock:
+        _query_cache = QueryCache(**options) if enabled else None
+    return _query_cache
+
+
+if __name__ == '__main__':
+    print("this file contains the query result cache of sql_inter")
@@ -0,0 +1,199 @@
+import time
+import random
+import asyncio
+import threading
+
+# Default requests per minute and tokens per minute of each model family, matched by the longest prefix of the model name
+# These are conservative account limits, adjust them with set_rate_limits to the limits of your OpenAI account
+RATE_LIMITS = {
+    "gpt-3.5-turbo": {"requests_per_minute": 3500, "tokens_per_minute": 90000},
+    "gpt-4": {"requests_per_minute": 500, "tokens_per_minute": 10000},
+    "gpt-4-1106": {"requests_per_minute": 500, "tokens_per_minute": 150000},
+    "gpt-4-turbo": {"requests_per_minute": 500, "tokens_per_minute": 150000},
+    "gpt-4o": {"requests_per_minute": 500, "tokens_per_minute": 150000},
+}
+DEFAULT_RATE_LIMIT = {"requests_per_minute": 500, "tokens_per_minute": 40000}
+
+# Exponential backoff: the delay doubles from BACKOFF_BASE seconds with each attempt, up to BACKOFF_CAP seconds
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+
+
+class TokenBucket():
+    """
+    A token bucket holding at most one minute of budget, refilled continuously. Capacity is reserved rather than waited for:
+    a reservation may take the bucket below zero, and the caller is told how long to wait until its share is refilled.
+    Later callers therefore queue behind earlier ones in arrival order, instead of all retrying at the same moment.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        # Refill the bucket for the time elapsed since the last reservation, then take the amount
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class RateLimiter():
+    """
+    The RateLimiter class tracks the requests and tokens per minute sent to one model by every session of the process.
+    A caller first reserves a request and its tokens with reserve() and waits the returned delay. When the API reports a rate limit, pause()
+    holds back every caller of the model until the Retry-After time, so queued callers are released gradually instead of all at once.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens_count=0):
+        """
+        Reserve one request of tokens_count tokens.
+        :return: The number of seconds the caller has to wait before sending the request.
+        """
+        with self._lock:
+            now = time.monotonic()
+            return max(self.paused_until - now,
+                       self.requests.reserve(1, now),
+                       self.tokens.reserve(tokens_count, now),
+                       0.0)
+
+    def release(self, tokens_count=0):
+        """
+        Give back a reservation of one request of tokens_count tokens whose request was discarded, e.g. a cancelled speculative request.
+        """
+        with self._lock:
+            self.requests.tokens = min(self.requests.capacity, self.requests.tokens + 1)
+            self.tokens.tokens = min(self.tokens.capacity, self.tokens.tokens + tokens_count)
+
+    def pause(self, delay):
+        """
+        Hold back every caller of the model for delay seconds, e.g. after a rate limit error.
+        """
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+
+# Process-wide registry of rate limiters, keyed by model name
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limit(model):
+    """
+    Return the requests and tokens per minute of a model, found by the longest prefix of the model name in RATE_LIMITS.
+    """
+    best_prefix = None
+    for prefix in RATE_LIMITS:
+        if model.startswith(prefix) and (best_prefix is None or len(prefix) > len(best_prefix)):
+            best_prefix = prefix
+    return RATE_LIMITS[best_prefix] if best_prefix is not None else DEFAULT_RATE_LIMIT
+
+
+def set_rate_limits(model, requests_per_minute, tokens_per_minute):
+    """
+    Set the requests and tokens per minute of a model (or model prefix), replacing the limiter already in use for it.
+    """
+    RATE_LIMITS[model] = {"requests_per_minute": requests_per_minute, "tokens_per_minute": tokens_per_minute}
+    with _limiters_lock:
+        for name in list(_limiters):
+            if name.startswith(model):
+                del _limiters[name]
+
+
+def get_rate_limiter(model):
+    """
+    Return the process-wide RateLimiter of a model, created on first use.
+    """
+    limiter = _limiters.get(model)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(model)
+            if limiter is None:
+                limit = get_rate_limit(model)
+                limiter = RateLimiter(limit["requests_per_minute"], limit["tokens_per_minute"])
+                _limiters[model] = limiter
+    return limiter
+
+
+def acquire(model, tokens_count=0):
+    """
+    Wait until a request of tokens_count tokens can be sent to the model without exceeding its rate limits.
+    :return: The number of seconds waited.
+    """
+    delay = get_rate_limiter(model).reserve(tokens_count)
+    if delay > 0:
+        time.sleep(delay)
+    return delay
+
+
+async def aacquire(model, tokens_count=0):
+    """
+    Asynchronous counterpart of acquire, waiting without blocking the event loop.
+    """
+    delay = get_rate_limiter(model).reserve(tokens_count)
+    if delay > 0:
+        await asyncio.sleep(delay)
+    return delay
+
+
+def release(model, tokens_count=0):
+    """
+    Give back to the rate limiter of the model a reservation made by acquire or aacquire for a request whose response was discarded.
+    """
+    get_rate_limiter(model).release(tokens_count)
+
+
+def get_retry_after(error):
+    """
+    Return the number of seconds the API asked to wait before retrying, from the Retry-After headers of an OpenAI error, or None.
+    """
+    headers = getattr(error, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """
+    Exponential backoff with jitter: a random delay between half and all of min(cap, base * 2 ** attempt) seconds,
+    so that sessions throttled at the same time do not all retry in the same second.
+    """
+    delay = min(cap, base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def register_retry(model, error, attempt):
+    """
+    Record a failed request to a model and hold back every caller of the model before the next attempt.
+    The Retry-After time of the error is honoured when present, with a little jitter, otherwise exponential backoff with jitter is used.
+    :param model: Name of the Chat model.
+    :param error: The exception raised by the request.
+    :param attempt: Number of previous failed attempts of this request, starting at 0.
+    :return: The number of seconds before the next attempt.
+    """
+    retry_after = get_retry_after(error)
+    if retry_after is not None:
+        delay = retry_after * random.uniform(1.0, 1.1)
+    else:
+        delay = backoff_delay(attempt)
+    get_rate_limiter(model).pause(delay)
+    return delay
+
+
+if __name__ == '__main__':
+    print("this file contains the shared rate limiter of the Chat models")
@@ -2,41 +2,69 @@ from planning import *
 import openai
 import time
 import json
-from IPython.display import display, Code, Markdown
-from openai.error import APIConnectionError
+from concurrent.futures import ThreadPoolExecutor
+from openai.error import APIConnectionError, RateLimitError, OpenAIError
 from gptLearning import *
-
-
-def function_to_call(available_functions, function_call_message):
+from tokenizer import get_prompt_budget, count_message_tokens
+from streaming import stream_chat_completion, astream_chat_completion
+from ratelimit import acquire, aacquire, register_retry, release
+from effects import Call, Spawn, Join, run_steps
+from turnstate import *
+from responsecache import request_fingerprint
+from parallelcalls import calls_to_markdown
+from debugsampling import FAST_DEBUG_PROMPT, candidate_messages, run_candidates
+from interaction import *
+from outputsink import *
+from tracing import NULL_TRACE
+from budget import LEVEL_NO_ENHANCED, LEVEL_STOPPED
+from toolresult import DEFAULT_RESULT_TOKENS, compact_tool_result
+
+
+def function_to_call(available_functions, function_call_message, namespace=None, trace=None, max_result_tokens=DEFAULT_RESULT_TOKENS):
     """
     Based on a function call message `function_call_message`, return a message with the function's execution result `function_response_messages`.
     :param available_functions: Required parameter, an AvailableFunctions object that describes the basic information of the current external functions.
     :param function_call_message: Required parameter, a message representing an external function call.
+    :param namespace: Optional parameter, the dictionary in which the external function creates its variables. Defaults to None, indicating the globals of this module.
+    :param trace: Optional parameter, a Trace object in which the call is recorded as a function_call span containing a tool span. Defaults to None, indicating no tracing.
+    :param max_result_tokens: Optional parameter, the maximum number of tokens of the function's result, a longer result is cut in the middle. Defaults to DEFAULT_RESULT_TOKENS, None for no limit.
     :return: `function_response_messages`, a message consisting of the external function's execution result.
     """
 
+    if trace is None:
+        trace = NULL_TRACE
+
     # Get the name of the function to be called from the function call message
     function_name = function_call_message["function_call"]["name"]
+    arguments = function_call_message["function_call"]["arguments"]
 
-    # Get the corresponding external function object based on the function name
-    function_to_call = available_functions.functions_dic[function_name]
+    with trace.span("function_call", function=function_name, request_bytes=len(arguments)) as span:
+        # Get the corresponding external function object based on the function name
+        function_to_call = available_functions.functions_dic[function_name]
 
-    # Extract the function parameters from the function call message
-    # This includes the SQL or Python code written by the large model
-    function_args = json.loads(function_call_message["function_call"]["arguments"])
+        # Extract the function parameters from the function call message
+        # This includes the SQL or Python code written by the large model
+        function_args = json.loads(arguments)
 
-    # Pass the parameters to the external function and run it
-    try:
-        # Add the global variables from the current operation space to the external function
-        function_args['g'] = globals()
+        # Pass the parameters to the external function and run it
+        try:
+            # Add the global variables from the current operation space to the external function
+            function_args['g'] = namespace if namespace is not None else globals()
 
-        # Run the external function
-        function_response = function_to_call(**function_args)
+            # Run the external function
+            with trace.span("tool", function=function_name):
+                function_response = function_to_call(**function_args)
 
-    # If the external function encounters an error, extract the error message
-    except Exception as e:
-        function_response = "The function encountered an error as follows:" + str(e)
-        # print(function_response)
+        # If the external function encounters an error, extract the error message
+        except Exception as e:
+            function_response = "The function encountered an error as follows:" + str(e)
+            # print(function_response)
+
+        # The result is sent again with every later request, so it is compacted before it becomes a message
+        raw_bytes = len(str(function_response))
+        function_response = compact_tool_result(function_response, max_result_tokens)
+        if trace.enabled:
+            span.set(raw_response_bytes=raw_bytes, response_bytes=len(function_response), error="error" in function_response)
 
     # Create the function_response_messages
     # This message includes information about the successful execution or error of the external function
@@ -49,11 +77,173 @@ def function_to_call(available_functions, function_call_message):
 
     return function_response_messages
 
+# Thread pool sending the speculative task decomposition requests of enhanced mode, each session has at most one speculative request at a time,
+# so the pool is sized to the number of concurrent sessions with configure_speculation, e.g. by BatchRunner
+DEFAULT_SPECULATION_WORKERS = 8
+SPECULATION_WORKERS = DEFAULT_SPECULATION_WORKERS
+SPECULATION_EXECUTOR = ThreadPoolExecutor(max_workers=SPECULATION_WORKERS, thread_name_prefix="mategen-speculation")
+# Shared thread pool in which the asynchronous sessions run the blocking external functions (sql_inter, extract_data, python_inter, fig_inter),
+# so that a slow query of one session does not block the event loop serving the other sessions
+TOOL_EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix="mategen-tool")
+
+
+def chat_completion(**request):
+    """
+    Return the operation sending a request to the Chat model: openai.ChatCompletion.create, or acreate in an asynchronous session.
+    """
+    return Call(openai.ChatCompletion.create, async_function=openai.ChatCompletion.acreate, **request)
+
+
+def wait_rate_limit(model, tokens_count):
+    """
+    Return the operation waiting for the shared rate limiter of the model, so that concurrent sessions queue instead of being throttled by the API.
+    """
+    return Call(acquire, model, tokens_count, async_function=aacquire)
+
+
+def configure_speculation(max_workers=DEFAULT_SPECULATION_WORKERS):
+    """
+    Replace the thread pool sending the speculative task decomposition requests of the synchronous sessions, e.g. to serve more concurrent sessions
+    in enhanced mode. The requests already submitted finish in the previous pool.
+    :param max_workers: Optional parameter, the number of speculative requests sent at the same time, the number of concurrent sessions in enhanced mode.
+    :return: The new pool.
+    """
+    global SPECULATION_EXECUTOR, SPECULATION_WORKERS
+    previous = SPECULATION_EXECUTOR
+    SPECULATION_WORKERS = max_workers
+    SPECULATION_EXECUTOR = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mategen-speculation")
+    previous.shutdown(wait=False)
+    return SPECULATION_EXECUTOR
+
+
+class SpeculativeUsage():
+    """
+    The rate limiter reservations and the tokens of a speculative request. The tokens are recorded in the budget governor only if the response is used,
+    the reservations are given back to the rate limiter if the response is discarded.
+    """
+
+    def __init__(self):
+        # (model, tokens_count) of each reservation, and (model, prompt_tokens, completion_tokens) of each model call
+        self.reservations = []
+        self.calls = []
+
+    def record(self, budget_governor):
+        if budget_governor is not None:
+            for model, prompt_tokens, completion_tokens in self.calls:
+                budget_governor.record_call(model, prompt_tokens, completion_tokens)
+
+    def release(self):
+        for model, tokens_count in self.reservations:
+            release(model, tokens_count)
+
+
+def discard_speculation(handle, usage):
+    """
+    Cancel a speculative request whose response is not needed. A request that has not started is never sent; the reservations of a request
+    already on its way are given back to the rate limiter once it finishes, and its tokens are not recorded in the budget governor.
+    :param handle: Required parameter, the future or task returned by Spawn for the speculative request.
+    :param usage: Required parameter, the SpeculativeUsage object of the request.
+    """
+    handle.cancel()
+    handle.add_done_callback(lambda handle: usage.release())
+
+
+def speculative_task_decomposition_messages(messages):
+    """
+    Return the messages of the task decomposition request of enhanced mode, which get_chat_response sends when the first response is a function call.
+    get_gpt_response adds the task decomposition prompt itself in enhanced mode, so the prompt is added twice here and the speculative request is sent
+    without enhanced mode: the request is the same, but a connection error is retried instead of asking the user to rephrase from a background thread.
+    """
+    return add_task_decomposition_prompt(add_task_decomposition_prompt(messages))
+
+
+def store_cached_response(response_cache, cache_key, model, messages, response, latency):
+    """
+    Store the response message of a model call in the response cache, with the latency and the tokens a later hit saves.
+    The tokens are taken from the usage of the response, or counted when the response was streamed.
+    """
+    response_message = response["choices"][0]["message"]
+    usage = response.get("usage") or {}
+    tokens = usage.get("total_tokens") or messages.tokens_count + count_message_tokens(response_message, model)
+    response_cache.put(cache_key, model, response_message, latency=latency, tokens=tokens)
+
+
+def render_cached_response(response_message, output_sink=DEFAULT_OUTPUT_SINK):
+    """
+    In streaming mode the text of an answer is rendered while it arrives, a cached answer is rendered through the same stream of the output sink at once.
+    """
+    sink = output_sink.stream()
+    if sink is None:
+        return
+    if response_message.get("content"):
+        sink.write(response_message["content"])
+    sink.close()
+
+
+def response_tokens(response, messages, model):
+    """
+    Return the prompt and completion tokens of a model call, from the usage of the response, or counted when the response was streamed.
+    """
+    usage = response.get("usage") or {}
+    return (usage.get("prompt_tokens") or messages.tokens_count,
+            usage.get("completion_tokens") or sum(count_message_tokens(choice["message"], model) for choice in response["choices"]))
+
+
+def record_model_call(span, response, messages, model, attempts):
+    """
+    Record the attempts, the payload sizes and the tokens of a model call in its span, a cached response used no tokens.
+    """
+    response_message = response["choices"][0]["message"]
+    span.set(attempts=attempts,
+             request_bytes=len(json.dumps(messages.messages, ensure_ascii=False, default=str)),
+             response_bytes=len(json.dumps(response_message, ensure_ascii=False, default=str)))
+    if not span.attributes.get("cached"):
+        prompt_tokens, completion_tokens = response_tokens(response, messages, model)
+        span.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+
+def budget_model(budget_governor, model, prompt_tokens, output_sink):
+    """
+    Ask the budget governor which model the next call uses: the model itself, the fallback model once a budget runs low,
+    or None once a budget is used up and no more calls are made.
+    """
+    level = budget_governor.level(prompt_tokens)
+    if level == LEVEL_STOPPED:
+        output_sink.text("The token, model call, time or cost budget is used up, no more model calls are made.", ERROR)
+        return None
+    new_model = budget_governor.model_for(model, level)
+    if new_model != model:
+        output_sink.text("The budget is running low, switching from %s to %s." % (model, new_model))
+    return new_model
+
+
+def govern_turn(turn):
+    """
+    Check the budgets before a step of the session loop: enhanced mode is turned off once a budget runs low.
+    :return: True if a budget is used up and the session has to stop.
+    """
+    level = turn.governor.level()
+    if level >= LEVEL_NO_ENHANCED and turn.is_enhanced_mode:
+        turn.is_enhanced_mode = False
+        turn.sink.text("The budget is running low, enhanced mode is turned off for the rest of this question.")
+    if level == LEVEL_STOPPED:
+        turn.sink.text("The token, model call, time or cost budget is used up, the current conversation was stopped.", ERROR)
+        return True
+    return False
+
+
 def get_gpt_response(model,
                      messages,
                      available_functions=None,
                      is_developer_mode=False,
-                     is_enhanced_mode=False):
+                     is_enhanced_mode=False,
+                     is_streaming_mode=False,
+                     response_cache=None,
+                     bypass_cache=False,
+                     interaction_policy=None,
+                     output_sink=None,
+                     trace=None,
+                     budget_governor=None):
     """
     Responsible for calling the Chat model and obtaining the model's response function, and it allows for a temporary pause of 1 minute if a Rate limit issue occurs when calling the GPT model.\
     Additionally, for unclear questions, it will prompt the user to modify the input prompt to obtain better model results.
@@ -65,8 +255,60 @@ def get_gpt_response(model,
     When developer mode is enabled, prompt templates are automatically added, and user feedback is solicited before executing code and after returning results, with modifications made based on user feedback.
     :param is_enhanced_mode: Optional parameter indicating whether enhanced mode is enabled, default is False.\
     When enhanced mode is enabled, a complex task decomposition process is automatically initiated, and deep debugging is automatically performed during code debugging.
+    :param is_streaming_mode: Optional parameter indicating whether streaming mode is enabled, default is False.\
+    When streaming mode is enabled, the text of the model's responses is rendered as it arrives and the time to the first token is recorded.
+    :param response_cache: Optional parameter, a ResponseCache object. A request identical to a cached one is answered from the cache without calling the model.\
+    Defaults to None, indicating no cache.
+    :param bypass_cache: Optional parameter, if True the cache is not looked up, the new response is still stored. Default is False.
+    :param interaction_policy: Optional parameter, an InteractionPolicy object deciding how to rephrase an unclear question and how to handle a connection error.\
+    Defaults to None, indicating the console prompts of DEFAULT_INTERACTION_POLICY.
+    :param output_sink: Optional parameter, an output sink (NotebookSink, TextSink, JSONSink or SilentSink) receiving the output. Defaults to None, indicating DEFAULT_OUTPUT_SINK.
+    :param trace: Optional parameter, a Trace object in which the call is recorded as a model_call span with its tokens and payload sizes. Defaults to None, indicating no tracing.
+    :param budget_governor: Optional parameter, a BudgetGovernor object checked before each attempt: the fallback model is used once a budget runs low,\
+    and None is returned without calling the model once a budget is used up. Defaults to None, indicating no budget.
     :return: Returns the response message from the model.
     """
+    return run_steps(gpt_response_steps(model,
+                                        messages,
+                                        available_functions=available_functions,
+                                        is_developer_mode=is_developer_mode,
+                                        is_enhanced_mode=is_enhanced_mode,
+                                        is_streaming_mode=is_streaming_mode,
+                                        response_cache=response_cache,
+                                        bypass_cache=bypass_cache,
+                                        interaction_policy=interaction_policy,
+                                        output_sink=output_sink,
+                                        trace=trace,
+                                        budget_governor=budget_governor))
+
+
+def gpt_response_steps(model,
+                       messages,
+                       available_functions=None,
+                       is_developer_mode=False,
+                       is_enhanced_mode=False,
+                       is_streaming_mode=False,
+                       response_cache=None,
+                       bypass_cache=False,
+                       interaction_policy=None,
+                       output_sink=None,
+                       trace=None,
+                       budget_governor=None,
+                       speculative_usage=None):
+    """
+    Steps of get_gpt_response, a generator yielding the model calls, the waits of the rate limiter, the lookups of the response cache and the decisions\
+    of the interaction policy as effects.Call objects. The same steps are run by get_gpt_response and by asyncresponse.async_get_gpt_response.
+    The parameters are those of get_gpt_response, and speculative_usage, a SpeculativeUsage object in which the rate limiter reservations\
+    and the tokens of a speculative request are kept instead of recording the tokens in budget_governor.
+    """
+
+    if interaction_policy is None:
+        interaction_policy = DEFAULT_INTERACTION_POLICY
+    if output_sink is None:
+        output_sink = DEFAULT_OUTPUT_SINK
+    if trace is None:
+        trace = NULL_TRACE
+    span = trace.start_span("model_call", model=model, streaming=is_streaming_mode)
 
     # If developer mode is enabled, modify the prompt, adding prompts on the first run
     if is_developer_mode:
@@ -76,25 +318,97 @@ def get_gpt_response(model,
     if is_enhanced_mode:
         messages = add_task_decomposition_prompt(messages)
 
+    # Number of failed attempts of this request, used for the exponential backoff
+    attempt = 0
+    cached = False
+    # Whether the budget governor switched to the fallback model, whose context window may be smaller than the one of the session's model
+    degraded = False
     # To account for potential communication errors, loop to call the Chat model
     while True:
+        # Enforce the budgets of the session and the turn before each attempt
+        if budget_governor is not None:
+            budget_model_name = budget_model(budget_governor, model, messages.tokens_count, output_sink)
+            if budget_model_name is None:
+                span.end(error="budget exhausted")
+                return None
+            degraded = degraded or budget_model_name != model
+            model = budget_model_name
+            span.set(model=model)
+
+        # Trim the earliest turns so that the request fits in the context window of the current model,
+        # counting the function definitions and the reserved completion budget, instead of failing with a 400 error
+        functions = available_functions.functions if available_functions is not None else None
+        prompt_budget = get_prompt_budget(model, functions=functions)
+        if messages.tokens_thr is not None:
+            prompt_budget = min(prompt_budget, messages.tokens_thr)
+        # For the fallback model only the request is trimmed, the session keeps its history for the next turns on its own model
+        request_messages = messages.copy() if degraded else messages
+        if not request_messages.fit_to_budget(prompt_budget):
+            output_sink.text("The current message alone exceeds the context window of %s, the request may be rejected." % model, ERROR)
+
+        # Look up the response cache, a request identical to an earlier one is answered without calling the model
+        cache_key = None
+        if response_cache is not None:
+            cache_key = request_fingerprint(model, request_messages.messages, functions,
+                                            available_functions.function_call if available_functions is not None else None)
+            # The cache is a SQLite database, an asynchronous session reads and writes it in a worker thread
+            if bypass_cache:
+                yield Call(response_cache.record_bypass)
+            else:
+                cached_message = yield Call(response_cache.get, cache_key)
+                if cached_message is not None:
+                    if is_streaming_mode:
+                        render_cached_response(cached_message, output_sink)
+                    span.set(cached=True)
+                    cached = True
+                    response = {"choices": [{"message": cached_message}]}
+                    break
+
+        # Wait for the shared rate limiter of the model, so that concurrent sessions queue instead of being throttled by the API
+        yield wait_rate_limit(model, request_messages.tokens_count)
+        if speculative_usage is not None:
+            speculative_usage.reservations.append((model, request_messages.tokens_count))
+        start_time = time.perf_counter()
+
         try:
+            # If streaming mode is enabled, render the text as it arrives and assemble the complete message from the chunks
+            if is_streaming_mode:
+                request = {"model": model, "messages": request_messages.messages}
+                if available_functions is not None:
+                    request["functions"] = available_functions.functions
+                    request["function_call"] = available_functions.function_call
+                response_message, timing = yield Call(stream_chat_completion, sink=output_sink.stream(), async_function=astream_chat_completion, **request)
+                # Record the time to the first token, shared by all copies of the conversation
+                messages.response_timings.append(timing)
+                response = {"choices": [{"message": response_message}]}
+
             # If no external functions exist
-            if available_functions is None:
-                response = openai.ChatCompletion.create(
+            elif available_functions is None:
+                response = yield chat_completion(
                     model=model,
-                    messages=messages.messages)
+                    messages=request_messages.messages)
 
             # If external functions exist, obtain functions and function_call parameters from the AvailableFunctions object
             else:
-                response = openai.ChatCompletion.create(
+                response = yield chat_completion(
                     model=model,
-                    messages=messages.messages,
+                    messages=request_messages.messages,
                     functions=available_functions.functions,
                     function_call=available_functions.function_call
                 )
+
+            # Store the response for later identical requests
+            if cache_key is not None:
+                yield Call(store_cached_response, response_cache, cache_key, model, request_messages, response, time.perf_counter() - start_time)
             break  # Exit the loop if response is successfully obtained
 
+        # On a rate limit error, hold back every session using this model until the Retry-After time (or an exponential backoff),
+        # the waiting is done by acquire at the next attempt
+        except RateLimitError as e:
+            delay = register_retry(model, e, attempt)
+            attempt += 1
+            output_sink.text("Rate limit reached, retrying in %.1f seconds..." % delay)
+
         except APIConnectionError as e:
             # APIConnectionError usually indicates unclear user requirements causing failure to return results
             # If enhanced mode is enabled, prompt the user to rephrase their query
@@ -108,68 +422,75 @@ def get_gpt_response(model,
                 Please write a prompt to guide the user to rephrase their question." % question
                 # Modify msg_temp and rephrase the query
                 try:
-                    msg_temp.messages[-1]["content"] = new_prompt
+                    msg_temp.set_message_content(-1, new_prompt)
                     # Modify the user's question and ask again
-                    response = openai.ChatCompletion.create(
+                    yield wait_rate_limit(model, msg_temp.tokens_count)
+                    if speculative_usage is not None:
+                        speculative_usage.reservations.append((model, msg_temp.tokens_count))
+                    response = yield chat_completion(
                         model=model,
                         messages=msg_temp.messages)
 
                     # Print the GPT prompt modification suggestion
-                    display(Markdown(response["choices"][0]["message"]["content"]))
+                    suggestion = response["choices"][0]["message"]["content"]
+                    output_sink.markdown(suggestion)
                     # Guide the user to rephrase the question or exit
-                    user_input = input("Please re-enter your question, enter 'exit' to exit the current conversation")
-                    if user_input == "exit":
-                        print("The current model cannot return results, exiting")
+                    user_input = yield Call(interaction_policy.rephrase_question, suggestion)
+                    if user_input is None:
+                        output_sink.text("The current model cannot return results, exiting")
+                        span.end(error="exited after a connection error")
                         return None
                     else:
-                        # Modify the original question
-                        messages.history_messages[-1]["content"] = user_input
-
-                        # Re-ask the question
-                        response_message = get_gpt_response(model=model,
-                                                            messages=messages,
-                                                            available_functions=available_functions,
-                                                            is_developer_mode=is_developer_mode,
-                                                            is_enhanced_mode=is_enhanced_mode)
-
-                        return response_message
-                # If a connection error occurs while prompting the user to modify the query, pause for 1 minute and continue the while loop
-                except APIConnectionError as e:
-                    print(f"Encountered a connection issue: {str(e)}")
-                    print("Due to rate limit, pausing for 1 minute and will continue running after 1 minute...")
-                    time.sleep(60)  # Wait for 1 minute
-                    print("Waited 60 seconds, starting a new round of questions and answers...")
+                        # Modify the original question and ask it again in the next iteration of the loop
+                        messages.set_message_content(-1, user_input)
+                # If a connection error occurs while prompting the user to modify the query, back off and continue the while loop
+                except (APIConnectionError, RateLimitError) as e:
+                    output_sink.text(f"Encountered a connection issue: {str(e)}", ERROR)
+                    delay = register_retry(model, e, attempt)
+                    attempt += 1
+                    output_sink.text("Due to rate limit, pausing for %.1f seconds before a new round of questions and answers..." % delay)
 
             # If enhanced mode is not enabled
             else:
                 # Print the core error information
-                print(f"Encountered a connection issue: {str(e)}")
+                output_sink.text(f"Encountered a connection issue: {str(e)}", ERROR)
                 # If developer mode is enabled
                 if is_developer_mode:
                     # Choose to wait, change model, or exit with an error
-                    user_input = input("Please choose to wait 1 minute (1), change model (2), or exit with an error (3)")
-                    if user_input == '1':
-                        print("Okay, will wait 1 minute before continuing...")
-                        time.sleep(60)  # Wait for 1 minute
-                        print("Waited 60 seconds, starting a new round of questions and answers...")
-                    elif user_input == '2':
-                        model = input("Okay, please enter the new model name")
+                    decision, new_model = yield Call(interaction_policy.connection_error, e)
+                    if decision == WAIT:
+                        delay = register_retry(model, e, attempt)
+                        attempt += 1
+                        output_sink.text("Okay, will wait %.1f seconds before continuing..." % delay)
+                    elif decision == SWITCH_MODEL:
+                        model = new_model
                     else:
                         # if modify:
                         #     messages = modify_prompt(messages, action='remove', enable_md_output=md_output,
                         #                              enable_COT=COT)
+                        span.end(error="%s: %s" % (type(e).__name__, e))
                         raise e  # If the user chooses to exit, restore prompts and raise the exception
                 # If not in developer mode
                 else:
-                    print("Due to rate limit, pausing for 1 minute and will continue running after 1 minute...")
-                    time.sleep(60)  # Wait for 1 minute
-                    print("Waited 60 seconds, starting a new round of questions and answers...")
+                    delay = register_retry(model, e, attempt)
+                    attempt += 1
+                    output_sink.text("Due to rate limit, pausing for %.1f seconds before a new round of questions and answers..." % delay)
+
+    response_message = response["choices"][0]["message"]
+    if budget_governor is not None and not cached:
+        if speculative_usage is not None:
+            speculative_usage.calls.append((model,) + response_tokens(response, request_messages, model))
+        else:
+            budget_governor.record_call(model, *response_tokens(response, request_messages, model))
+    if trace.enabled:
+        record_model_call(span, response, request_messages, model, attempt + 1)
+    span.end()
 
     # Restore the original message object
     if is_developer_mode:
         messages = modify_prompt(messages, action='remove')
 
-    return response["choices"][0]["message"]
+    return response_message
 
 
 
@@ -178,14 +499,27 @@ def get_chat_response(model,
                       available_functions=None,
                       is_developer_mode=False,
                       is_enhanced_mode=False,
+                      is_streaming_mode=False,
                       delete_some_messages=False,
-                      is_task_decomposition=False):
+                      is_task_decomposition=False,
+                      max_steps=MAX_TURN_STEPS,
+                      turn_record=None,
+                      response_cache=None,
+                      bypass_cache=False,
+                      debug_candidates=0,
+                      interaction_policy=None,
+                      output_sink=None,
+                      namespace=None,
+                      trace=None,
+                      budget_governor=None,
+                      max_result_tokens=DEFAULT_RESULT_TOKENS):
     """
-    Responsible for executing a complete conversation session. Note that a conversation may involve multiple calls to the large model, 
+    Responsible for executing a complete conversation session. Note that a conversation may involve multiple calls to the large model,
     and this function serves as the main function to complete one conversation session.\
     The last message in the input messages must be a message that can initiate a conversation.\
-    This function calls get_gpt_response to obtain the model's output results and then processes the output based on whether it is text or code results,\
-    by flexibly calling different functions for post-processing.\
+    The session runs as a loop over the states of a TurnState object: get_response_message obtains the model's output, which is then reviewed by\
+    is_text_response_valid or is_code_response_valid and check_get_final_function_response. Each of these step functions sets the next state instead of\
+    calling the next step, so a session with many external function calls does not grow the call stack, and stops after max_steps steps.
     :param model: Required parameter indicating the name of the large model to be called.
     :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
     :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.\
@@ -194,107 +528,292 @@ def get_chat_response(model,
     When developer mode is enabled, prompt templates are automatically added, and user feedback is solicited before executing code and after returning results, with modifications made based on user feedback.
     :param is_enhanced_mode: Optional parameter indicating whether enhanced mode is enabled, default is False.\
     When enhanced mode is enabled, a complex task decomposition process is automatically initiated, and deep debugging is automatically performed during code debugging.
+    :param is_streaming_mode: Optional parameter indicating whether streaming mode is enabled, default is False.\
+    When streaming mode is enabled, the text of the model's responses is rendered as it arrives and the time to the first token is recorded.
     :param delete_some_messages: Optional parameter indicating whether to delete several intermediate messages when concatenating messages, default is False.
-    :param is_task_decomposition: Optional parameter indicating whether the current task is task decomposition review, default is False.
+    :param is_task_decomposition: Optional parameter indicating whether the current task is a review of task decomposition results, default is False.
+    :param max_steps: Optional parameter, the maximum number of steps (model calls, reviews and external function calls) of the session, default is MAX_TURN_STEPS.
+    :param turn_record: Optional parameter, a TurnRecord object in which the steps of the session are recorded for inspection. Defaults to None, indicating a new record.
+    :param response_cache: Optional parameter, a ResponseCache object answering repeated requests without calling the model. Defaults to None, indicating no cache.
+    :param bypass_cache: Optional parameter, if True the cache is not looked up during this session, the new responses are still stored. Default is False.
+    :param debug_candidates: Optional parameter, the number of candidate fixes requested at once when an external function fails (fast debug mode).\
+    The candidates run in parallel and the first one running without error is accepted, the debug agent is only used if all of them fail. Default is 0, indicating the debug agent only.
+    :param interaction_policy: Optional parameter, an InteractionPolicy object taking the decisions of the session (approving code, reviewing answers and task decompositions,\
+    handling connection errors). Defaults to None, indicating the console prompts of DEFAULT_INTERACTION_POLICY. AutoPolicy runs the session without a human.
+    :param output_sink: Optional parameter, an output sink (NotebookSink, TextSink, JSONSink or SilentSink) receiving the code, answers and status messages of the session.\
+    Defaults to None, indicating DEFAULT_OUTPUT_SINK, which renders in the notebook.
+    :param namespace: Optional parameter, the dictionary in which the external functions of the session create and read their variables, so that concurrent sessions do not share tables.\
+    Defaults to None, indicating the globals of this module.
+    :param trace: Optional parameter, a Trace object in which the session is recorded: a turn span, and spans around each model call, external function call,\
+    tool and debug round. Defaults to None, indicating no tracing.
+    :param budget_governor: Optional parameter, a BudgetGovernor object enforcing the token, model call, time and cost budgets of the session and the turn.\
+    When a budget runs low, enhanced mode is turned off, then the fallback model is used, and the session stops once a budget is used up. Defaults to None, indicating no budget.
+    :param max_result_tokens: Optional parameter, the maximum number of tokens of the result of an external function: DataFrames are summarized, long collections and SQL results\
+    are truncated with their counts, and a longer result is cut in the middle. Defaults to DEFAULT_RESULT_TOKENS, None for no limit.
     :return: Messages concatenating the final results of this Q&A session.
     """
+    return run_steps(chat_response_steps(model,
+                                         messages,
+                                         available_functions=available_functions,
+                                         is_developer_mode=is_developer_mode,
+                                         is_enhanced_mode=is_enhanced_mode,
+                                         is_streaming_mode=is_streaming_mode,
+                                         delete_some_messages=delete_some_messages,
+                                         is_task_decomposition=is_task_decomposition,
+                                         max_steps=max_steps,
+                                         turn_record=turn_record,
+                                         response_cache=response_cache,
+                                         bypass_cache=bypass_cache,
+                                         debug_candidates=debug_candidates,
+                                         interaction_policy=interaction_policy,
+                                         output_sink=output_sink,
+                                         namespace=namespace,
+                                         trace=trace,
+                                         budget_governor=budget_governor,
+                                         max_result_tokens=max_result_tokens))
+
+
+def chat_response_steps(model,
+                        messages,
+                        available_functions=None,
+                        is_developer_mode=False,
+                        is_enhanced_mode=False,
+                        is_streaming_mode=False,
+                        delete_some_messages=False,
+                        is_task_decomposition=False,
+                        max_steps=MAX_TURN_STEPS,
+                        turn_record=None,
+                        response_cache=None,
+                        bypass_cache=False,
+                        debug_candidates=0,
+                        interaction_policy=None,
+                        output_sink=None,
+                        namespace=None,
+                        trace=None,
+                        budget_governor=None,
+                        max_result_tokens=DEFAULT_RESULT_TOKENS):
+    """
+    Steps of get_chat_response, a generator yielding the blocking operations of the session as effects.Call objects.\
+    The session loop and its step functions are shared by get_chat_response, which runs them with effects.run_steps,\
+    and asyncresponse.async_get_chat_response, which runs them with effects.arun_steps. The parameters are those of get_chat_response.
+    """
+
+    if turn_record is None:
+        turn_record = TurnRecord(max_steps=max_steps)
+    turn = TurnState(messages,
+                     is_enhanced_mode=is_enhanced_mode,
+                     is_task_decomposition=is_task_decomposition,
+                     delete_some_messages=delete_some_messages,
+                     record=turn_record,
+                     debug_candidates=debug_candidates,
+                     policy=interaction_policy if interaction_policy is not None else DEFAULT_INTERACTION_POLICY,
+                     sink=output_sink if output_sink is not None else DEFAULT_OUTPUT_SINK,
+                     namespace=namespace,
+                     trace=trace,
+                     governor=budget_governor,
+                     result_tokens=max_result_tokens)
+    turn.trace.start_span("turn", model=model)
+
+    while turn.state != STATE_DONE:
+        # Stop the session once the step budget is used up, the messages collected so far are kept
+        if turn.record.exhausted:
+            turn.record.stopped = True
+            turn.sink.text("The current conversation reached the maximum of %d steps and was stopped." % turn.record.max_steps, ERROR)
+            break
+        # Stop the session once a budget is used up, turn enhanced mode off once a budget runs low
+        if turn.governor is not None and govern_turn(turn):
+            turn.record.stopped = True
+            break
+
+        state = turn.start_step()
+        # Call the large model
+        if state == STATE_RESPOND:
+            yield from get_response_message(model=model,
+                                            turn=turn,
+                                            available_functions=available_functions,
+                                            is_developer_mode=is_developer_mode,
+                                            is_streaming_mode=is_streaming_mode,
+                                            response_cache=response_cache,
+                                            bypass_cache=bypass_cache)
+        # Review a text answer
+        elif state == STATE_REVIEW_TEXT:
+            yield from is_text_response_valid(model=model,
+                                              turn=turn,
+                                              is_developer_mode=is_developer_mode,
+                                              is_streaming_mode=is_streaming_mode)
+        # Review and run a function call
+        elif state == STATE_REVIEW_CODE:
+            yield from is_code_response_valid(model=model,
+                                              turn=turn,
+                                              available_functions=available_functions,
+                                              is_developer_mode=is_developer_mode)
+        # Review the result of the external function
+        elif state == STATE_CHECK_RESULT:
+            check_get_final_function_response(model=model,
+                                              turn=turn)
+        # Run several candidate fixes of a failed external function call in parallel
+        elif state == STATE_SAMPLE_FIXES:
+            yield from sample_candidate_fixes(model=model,
+                                              turn=turn,
+                                              available_functions=available_functions)
+
+        # When a sub-session of the debug agent is finished, continue with the next debug prompt
+        if turn.state == STATE_DONE and turn.debug_prompts:
+            send_debug_prompt(turn)
+        turn.end_step(state)
+
+    # A model call refused by the governor ends the session like a stop
+    if turn.governor is not None and turn.governor.turn_level == LEVEL_STOPPED:
+        turn.record.stopped = True
+    turn.finish()
+    turn.trace.finish(steps=len(turn.record), stopped=turn.record.stopped)
+    return turn.messages
+
+
+def get_response_message(model,
+                         turn,
+                         available_functions=None,
+                         is_developer_mode=False,
+                         is_streaming_mode=False,
+                         response_cache=None,
+                         bypass_cache=False):
+    """
+    Step of the session loop obtaining the model's response message, including the task decomposition request in enhanced mode.\
+    Like the other steps that wait for something, it is a generator run by chat_response_steps, yielding its blocking operations. The next state is STATE_REVIEW_TEXT for a text response and STATE_REVIEW_CODE for a function call.
+    :param model: Required parameter indicating the name of the large model to be called.
+    :param turn: Required parameter, the TurnState object of the current session.
+    :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.\
+    Defaults to None, indicating no external functions.
+    :param is_developer_mode: Indicates whether developer mode is enabled, default is False.
+    :param is_streaming_mode: Optional parameter indicating whether streaming mode is enabled, default is False.
+    :param response_cache: Optional parameter, a ResponseCache object answering repeated requests without calling the model.
+    :param bypass_cache: Optional parameter, if True the cache is not looked up. Default is False.
+    """
+
+    # In enhanced mode, the task decomposition request is sent at the same time as the first request instead of after it,
+    # its response is only used if the first response is a function call. Developer mode keeps the serial requests, since it asks the user about errors
+    speculative_response = None
+    if not turn.is_task_decomposition and turn.is_enhanced_mode and not is_developer_mode:
+        # Its tokens are recorded in the budget governor only if its response is used
+        speculative_usage = SpeculativeUsage()
+        speculative_response = yield Spawn(gpt_response_steps(model=model,
+                                                              messages=speculative_task_decomposition_messages(turn.messages),
+                                                              available_functions=available_functions,
+                                                              response_cache=response_cache,
+                                                              bypass_cache=bypass_cache,
+                                                              interaction_policy=turn.policy,
+                                                              output_sink=turn.sink,
+                                                              trace=turn.trace,
+                                                              budget_governor=turn.governor,
+                                                              speculative_usage=speculative_usage),
+                                           SPECULATION_EXECUTOR)
 
     # Only when modifying the complex task decomposition result will is_task_decomposition=True occur
     # When is_task_decomposition=True, response_message will not be recreated
-    if not is_task_decomposition:
+    if not turn.is_task_decomposition:
         # First obtain the result of a single large model call
         # At this point, response_message is the message returned by the large model call
-        response_message = get_gpt_response(model=model,
-                                            messages=messages,
-                                            available_functions=available_functions,
-                                            is_developer_mode=is_developer_mode,
-                                            is_enhanced_mode=is_enhanced_mode)
+        try:
+            turn.response_message = yield from gpt_response_steps(model=model,
+                                                                  messages=turn.messages,
+                                                                  available_functions=available_functions,
+                                                                  is_developer_mode=is_developer_mode,
+                                                                  is_enhanced_mode=turn.is_enhanced_mode,
+                                                                  is_streaming_mode=is_streaming_mode,
+                                                                  response_cache=response_cache,
+                                                                  bypass_cache=bypass_cache,
+                                                                  interaction_policy=turn.policy,
+                                                                  output_sink=turn.sink,
+                                                                  trace=turn.trace,
+                                                                  budget_governor=turn.governor)
+        except BaseException:
+            if speculative_response is not None:
+                discard_speculation(speculative_response, speculative_usage)
+            raise
+        # The user chose to exit instead of rephrasing the question
+        if turn.response_message is None:
+            if speculative_response is not None:
+                discard_speculation(speculative_response, speculative_usage)
+            turn.state = STATE_DONE
+            return
 
     # Complex condition check, if is_task_decomposition = True,
     # or if enhanced mode is enabled and the task involves function response
-    # (Note that when is_task_decomposition = True, there is no response_message object)
-    if is_task_decomposition or (is_enhanced_mode and response_message.get("function_call")):
+    # (Note that when is_task_decomposition = True, there is no new response_message object)
+    if turn.is_task_decomposition or (turn.is_enhanced_mode and turn.response_message.get("function_call")):
         # Set is_task_decomposition to True, indicating that the current task is task decomposition
-        is_task_decomposition = True
-        # In task decomposition, the task decomposition prompt is named text_response_messages
-        task_decomp_few_shot = add_task_decomposition_prompt(messages)
-        # print("Performing task decomposition, please wait...")
-        # Also update response_message; now response_message is the response after task decomposition
-        response_message = get_gpt_response(model=model,
-                                            messages=task_decomp_few_shot,
-                                            available_functions=available_functions,
-                                            is_developer_mode=is_developer_mode,
-                                            is_enhanced_mode=is_enhanced_mode)
+        turn.is_task_decomposition = True
+        # Use the response of the speculative task decomposition request, which is already on its way
+        if speculative_response is not None:
+            turn.response_message = yield Join(speculative_response)
+            speculative_usage.record(turn.governor)
+            # The speculative request is not streamed, its answer is rendered at once
+            if is_streaming_mode and turn.response_message is not None:
+                render_cached_response(turn.response_message, turn.sink)
+        else:
+            # In task decomposition, the task decomposition prompt is named text_response_messages
+            task_decomp_few_shot = add_task_decomposition_prompt(turn.messages)
+            # Also update response_message; now response_message is the response after task decomposition
+            turn.response_message = yield from gpt_response_steps(model=model,
+                                                                  messages=task_decomp_few_shot,
+                                                                  available_functions=available_functions,
+                                                                  is_developer_mode=is_developer_mode,
+                                                                  is_enhanced_mode=turn.is_enhanced_mode,
+                                                                  is_streaming_mode=is_streaming_mode,
+                                                                  response_cache=response_cache,
+                                                                  bypass_cache=bypass_cache,
+                                                                  interaction_policy=turn.policy,
+                                                                  output_sink=turn.sink,
+                                                                  trace=turn.trace,
+                                                                  budget_governor=turn.governor)
+        if turn.response_message is None:
+            turn.state = STATE_DONE
+            return
         # If the task decomposition prompt is ineffective, response_message might create another function call message
-        if response_message.get("function_call"):
-            print("The current task does not require decomposition and can be executed directly.")
+        if turn.response_message.get("function_call"):
+            turn.sink.text("The current task does not require decomposition and can be executed directly.")
+
+    # The first response is a text answer, the speculative task decomposition response is not needed.
+    # A request that has not started yet is cancelled (in an asynchronous session a request already sent is cancelled too),
+    # a request already sent by a synchronous session finishes in the background and its response is discarded
+    elif speculative_response is not None:
+        discard_speculation(speculative_response, speculative_usage)
 
     # If the current call is generated by modifying conversation requirements, delete several messages from the original messages
-    # Note that deleting intermediate messages must be done after creating the new response_message
-    if delete_some_messages:
-        for i in range(delete_some_messages):
-            messages.messages_pop(manual=True, index=-1)
+    # Note that deleting intermediate messages must be done after creating the new response_message, and only once
+    if turn.delete_some_messages:
+        for i in range(turn.delete_some_messages):
+            turn.messages.messages_pop(manual=True, index=-1)
+        turn.delete_some_messages = False
 
-    # Note that at this point, there will definitely be a response_message
     # Next, based on the type of response_message, execute different processes
-    # If it is a text response task (including both standard text responses and complex task decomposition reviews, the same code can be used for both)
-    if not response_message.get("function_call"):
-        # Save the message as text_answer_message
-        text_answer_message = response_message
-        # Review the text content using is_text_response_valid
-        messages = is_text_response_valid(model=model,
-                                          messages=messages,
-                                          text_answer_message=text_answer_message,
-                                          available_functions=available_functions,
-                                          is_developer_mode=is_developer_mode,
-                                          is_enhanced_mode=is_enhanced_mode,
-                                          delete_some_messages=delete_some_messages,
-                                          is_task_decomposition=is_task_decomposition)
-
-    # If it is a function response task
-    elif response_message.get("function_call"):
-        # Create a function_call_message to call the external function
-        # In the current Agent, function_call_message is a JSON object containing SQL code or Python code
-        function_call_message = response_message
-        # Pass function_call_message to the code review and execution function is_code_response_valid
-        # and finally obtain the Q&A result after the external function execution
-        messages = is_code_response_valid(model=model,
-                                          messages=messages,
-                                          function_call_message=function_call_message,
-                                          available_functions=available_functions,
-                                          is_developer_mode=is_developer_mode,
-                                          is_enhanced_mode=is_enhanced_mode,
-                                          delete_some_messages=delete_some_messages)
-
-    return messages
-
+    # A text response task (including both standard text responses and complex task decomposition reviews) is reviewed by is_text_response_valid
+    # A function response task is reviewed and executed by is_code_response_valid
+    if not turn.response_message.get("function_call"):
+        turn.state = STATE_REVIEW_TEXT
+    else:
+        turn.state = STATE_REVIEW_CODE
 
 
 def is_code_response_valid(model,
-                           messages,
-                           function_call_message,
+                           turn,
                            available_functions=None,
-                           is_developer_mode=False,
-                           is_enhanced_mode=False,
-                           delete_some_messages=False):
+                           is_developer_mode=False):
     """
-    Responsible for executing an external function call completely. The last message in the input `messages` must be a message containing a function call.\
+    Responsible for executing an external function call completely. turn.response_message must be a message containing a function call.\
     The function's final task is to pass the code from the function call message to the external function and complete the code execution, supporting both interactive and automated code execution modes.\
-    After obtaining a function message containing the result of the external function execution, it will be further processed by the check_get_final_function_response function,\
-    which will convert the function message into an assistant message and complete the conversation.
+    After obtaining a function message containing the result of the external function execution, the next state is STATE_CHECK_RESULT, in which check_get_final_function_response\
+    converts the function message into an assistant message and completes the conversation.
     :param model: Required parameter indicating the name of the large model to be called.
-    :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
-    :param function_call_message: Required parameter representing a message containing a function call created by the upper-level function.
+    :param turn: Required parameter, the TurnState object of the current session.
     :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.\
     Defaults to None, indicating no external functions.
     :param is_developer_mode: Indicates whether developer mode is enabled, default is False.\
     When developer mode is enabled, prompt templates are automatically added, and user feedback is solicited before executing code and after returning results, with modifications made based on user feedback.
-    :param is_enhanced_mode: Optional parameter indicating whether enhanced mode is enabled, default is False.\
-    When enhanced mode is enabled, a complex task decomposition process is automatically initiated, and deep debugging is automatically performed during code debugging.
-    :param delete_some_messages: Optional parameter indicating whether to delete several intermediate messages when concatenating messages, default is False.
-    :return: Message containing the latest result from the large model's response.
     """
 
+    function_call_message = turn.response_message
+
     # Prepare for printing and modifying code (adding image creation code for the family part)
     # Create a JSON string message object
     code_json_str = function_call_message["function_call"]["arguments"]
@@ -302,18 +821,10 @@ def is_code_response_valid(model,
     try:
         code_dict = json.loads(code_json_str)
     except Exception as e:
-        print("JSON parsing error, recreating code...")
-        # Recursively call the upper-level function get_chat_response and return the final message result
-        # Note that if the upper-level function creates another function_call_message
-        # it will call is_code_response_valid again without needing to be executed again in the current function
-        messages = get_chat_response(model=model,
-                                     messages=messages,
-                                     available_functions=available_functions,
-                                     is_developer_mode=is_developer_mode,
-                                     is_enhanced_mode=is_enhanced_mode,
-                                     delete_some_messages=delete_some_messages)
-
-        return messages
+        turn.sink.text("JSON parsing error, recreating code...", ERROR)
+        # Ask the model again, if it creates another function call message it will be reviewed again in the next step
+        turn.state = STATE_RESPOND
+        return
 
     # If JSON is successfully converted to a dictionary, continue executing the following code
     # Create a helper function convert_to_markdown to assist in printing code results
@@ -325,272 +836,350 @@ def is_code_response_valid(model,
     if code_dict.get('sql_query'):
         code = code_dict['sql_query']
         markdown_code = convert_to_markdown(code, 'sql')
-        print("The following code will be executed:")
+        turn.sink.text("The following code will be executed:", CODE)
 
     # If it's Python, print code in Python format in Markdown
     elif code_dict.get('py_code'):
         code = code_dict['py_code']
         markdown_code = convert_to_markdown(code, 'python')
-        print("The following code will be executed:")
+        turn.sink.text("The following code will be executed:", CODE)
+
+    # If it's a multi_function_call, print the code of each call
+    elif code_dict.get('calls'):
+        markdown_code = calls_to_markdown(code_dict['calls'])
+        turn.sink.text("The following calls will be executed, independent calls at the same time:", CODE)
 
     else:
         markdown_code = code_dict
 
-    display(Markdown(markdown_code))
+    turn.sink.markdown(markdown_code, CODE)
 
-    # If in developer mode, prompt the user to review the code before running it
+    # If in developer mode, ask the interaction policy to review the code before running it
     if is_developer_mode:
-        user_input = input("Run code directly (1) or provide feedback and let the model modify the code before running it (2)?")
-        if user_input == '1':
-            print("Okay, running the code, please wait...")
+        decision, modify_input = yield Call(turn.policy.review_code, markdown_code)
+        if decision == APPROVE:
+            turn.sink.text("Okay, running the code, please wait...")
 
         else:
-            modify_input = input("Okay, please provide modification feedback:")
             # Record the code currently created by the model
-            messages.messages_append(function_call_message)
+            turn.messages.messages_append(function_call_message)
             # Record the modification feedback
-            messages.messages_append({"role": "user", "content": modify_input})
+            turn.messages.messages_append({"role": "user", "content": modify_input})
 
-            # Call the get_chat_response function and retrieve the result again
+            # Ask the model again
             # Note that delete_some_messages=2 is required here to delete intermediate conversation results to save tokens
-            messages = get_chat_response(model=model,
-                                         messages=messages,
-                                         available_functions=available_functions,
-                                         is_developer_mode=is_developer_mode,
-                                         is_enhanced_mode=is_enhanced_mode,
-                                         delete_some_messages=2)
-
-            return messages
+            turn.delete_some_messages = 2
+            turn.state = STATE_RESPOND
+            return
 
-    # If not in developer mode, or if user_input == '1' in developer mode
+    # If not in developer mode, or if the code was approved in developer mode
     # Call the function_to_call function to get the final result of the external function execution
     # In the current Agent, the external function result is either SQL or Python execution result, or code execution error result
-    function_response_message = function_to_call(available_functions=available_functions,
-                                                 function_call_message=function_call_message)
-
-    # Pass function_response_message to check_get_final_function_response for review
-    messages = check_get_final_function_response(model=model,
-                                                 messages=messages,
-                                                 function_call_message=function_call_message,
-                                                 function_response_message=function_response_message,
-                                                 available_functions=available_functions,
-                                                 is_developer_mode=is_developer_mode,
-                                                 is_enhanced_mode=is_enhanced_mode,
-                                                 delete_some_messages=delete_some_messages)
+    turn.function_response_message = yield Call(function_to_call,
+                                                available_functions=available_functions,
+                                                function_call_message=function_call_message,
+                                                namespace=turn.namespace,
+                                                trace=turn.trace,
+                                                max_result_tokens=turn.result_tokens,
+                                                executor=TOOL_EXECUTOR)
 
-    return messages
+    # Review function_response_message with check_get_final_function_response in the next step
+    turn.state = STATE_CHECK_RESULT
 
 
 # Determine if the code output meets the requirements. Input is the function response message, output is a message based on the external function's execution result.
 def check_get_final_function_response(model,
-                                      messages,
-                                      function_call_message,
-                                      function_response_message,
-                                      available_functions=None,
-                                      is_developer_mode=False,
-                                      is_enhanced_mode=False,
-                                      delete_some_messages=False):
-    """
-    Responsible for reviewing the results of external function execution. If the function_response_message does not contain any error information,\
-    it will be appended to the message and passed to the get_chat_response function to obtain the next round of conversation results. If error information is present in the function_response_message,\
-    automatic debug mode will be enabled. This function will use a method similar to Autogen, replicating multiple Agents, and performing debugging through their interactions.
+                                      turn):
+    """
+    Responsible for reviewing the results of external function execution. If turn.function_response_message does not contain any error information,\
+    it will be appended to the message and the model is asked for the next round of conversation results. If error information is present in the function_response_message,\
+    automatic debug mode will be enabled. This function will use a method similar to Autogen, replicating multiple Agents, and performing debugging through their interactions.\
+    The debug prompts are sent one by one by the session loop, each one starting a sub-session of the debug agent.
     :param model: Required parameter indicating the name of the large model to be called.
-    :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
-    :param function_call_message: Required parameter representing a message containing a function call created by the upper-level function.
-    :param function_response_message: Required parameter representing a message containing the result of the external function's execution created by the upper-level function.
-    :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.\
-    Defaults to None, indicating no external functions.
-    :param is_developer_mode: Indicates whether developer mode is enabled, default is False.\
-    When developer mode is enabled, prompt templates are automatically added, and user feedback is solicited before executing code and after returning results, with modifications made based on user feedback.
-    :param is_enhanced_mode: Optional parameter indicating whether enhanced mode is enabled, default is False.\
-    When enhanced mode is enabled, a complex task decomposition process is automatically initiated, and deep debugging is automatically performed during code debugging.
-    :param delete_some_messages: Optional parameter indicating whether to delete several intermediate messages when concatenating messages, default is False.
-    :return: Message containing the latest result from the large model's response.
+    :param turn: Required parameter, the TurnState object of the current session.
     """
 
+    function_call_message = turn.response_message
+    function_response_message = turn.function_response_message
+    turn.function_response_message = None
+
     # Get the content of the external function's execution result
     fun_res_content = function_response_message["content"]
 
+    # The result ends the debug round started by the previous error
+    if turn.debug_span is not None:
+        turn.debug_span.end(fixed="error" not in fun_res_content)
+        turn.debug_span = None
+
     # If function_response contains errors
     if "error" in fun_res_content:
         # Print error information
-        print(fun_res_content)
+        turn.sink.text(fun_res_content, ERROR)
+
+        # Start measuring the time to a working fix
+        if turn.debug_started is None:
+            turn.debug_started = time.perf_counter()
+        turn.debug_rounds += 1
+
+        # In fast debug mode, first request several candidate fixes at once, the debug agent is only used if all of them fail
+        if turn.debug_candidates > 1 and not turn.sampling_failed:
+            turn.debug_span = turn.trace.start_span("debug_round", round=turn.debug_rounds, mode="parallel")
+            turn.function_response_message = function_response_message
+            turn.state = STATE_SAMPLE_FIXES
+            return
 
         # Choose efficient debug or deep debug based on whether enhanced mode is enabled
         # The difference between efficient debug and deep debug is only in the prompt content and process
         # Efficient debug includes only one prompt and requires only one large model call to complete automatic debugging
         # Deep debug includes three prompts and requires three large model calls for deep summarization and debugging
         # Create different prompts for efficient and deep debugging
-        if not is_enhanced_mode:
+        if not turn.is_enhanced_mode:
             # Execute efficient debug
-            display(Markdown("**Executing efficient debug, instantiating Efficient Debug Agent...**"))
+            turn.sink.markdown("**Executing efficient debug, instantiating Efficient Debug Agent...**", DEBUG)
             debug_prompt_list = ['Your code has errors. Please modify the code according to the error information and re-execute.']
 
         else:
             # Execute deep debug
-            display(Markdown(
-                "**Executing deep debug. This debugging process will automatically perform multiple rounds of conversation. Please be patient. Instantiating Deep Debug Agent...**"))
-            display(Markdown("**Instantiating deep debug Agent...**"))
+            turn.sink.markdown(
+                "**Executing deep debug. This debugging process will automatically perform multiple rounds of conversation. Please be patient. Instantiating Deep Debug Agent...**", DEBUG)
+            turn.sink.markdown("**Instantiating deep debug Agent...**", DEBUG)
             debug_prompt_list = ["The previous code execution resulted in an error. Where do you think the code was written incorrectly?",
                                  "Okay. Based on your analysis, theoretically, how should this error be resolved?",
                                  "Very well. Next, please write and run the corresponding code according to your logic."]
 
         # Copy the messages, equivalent to creating a new Agent for debugging
         # Note that at this point the last message in messages is a user message, not any function call-related message
-        msg_debug = messages.copy()
+        msg_debug = turn.messages.copy()
         # Append the function_call_message
         # The current function_call_message contains the erroneous code
         msg_debug.messages_append(function_call_message)
         # Append the function_response_message
         # The current function_response_message contains the error message of the code execution
         msg_debug.messages_append(function_response_message)
+        # The debug agent replaces the messages of the session, the sub-sessions of the debug agent run without enhanced mode
+        turn.messages = msg_debug
+        turn.is_enhanced_mode = False
 
-        # Sequentially input the debug prompts to guide the large model to complete the debugging
-        for debug_prompt in debug_prompt_list:
-            msg_debug.messages_append({"role": "user", "content": debug_prompt})
-            display(Markdown("**From Debug Agent:**"))
-            display(Markdown(debug_prompt))
-
-            # Call get_chat_response again. Under the current debug prompt, get_chat_response will return modification suggestions or modified code
-            # Print the prompt information
-            display(Markdown("**From MateGen:**"))
-            msg_debug = get_chat_response(model=model,
-                                          messages=msg_debug,
-                                          available_functions=available_functions,
-                                          is_developer_mode=is_developer_mode,
-                                          is_enhanced_mode=False,
-                                          delete_some_messages=delete_some_messages)
+        turn.debug_span = turn.trace.start_span("debug_round", round=turn.debug_rounds, mode="deep" if len(debug_prompt_list) > 1 else "efficient")
 
-        messages = msg_debug.copy()
+        # Prompts of an error found while debugging are sent before the remaining prompts of the current debug agent
+        turn.debug_prompts.extendleft(reversed(debug_prompt_list))
+        send_debug_prompt(turn)
 
     # If function message does not contain error information
     # Pass the function message to the model
     else:
-        print("External function execution complete. Parsing the results...")
-        messages.messages_append(function_call_message)
-        messages.messages_append(function_response_message)
-        messages = get_chat_response(model=model,
-                                     messages=messages,
-                                     available_functions=available_functions,
-                                     is_developer_mode=is_developer_mode,
-                                     is_enhanced_mode=is_enhanced_mode,
-                                     delete_some_messages=delete_some_messages)
+        # A debug run reached a working fix
+        if turn.debug_started is not None:
+            mode = "parallel+sequential" if turn.sampling_failed else "sequential"
+            turn.record.add_debug_timing(mode, time.perf_counter() - turn.debug_started, True)
+            turn.debug_started = None
+            turn.sampling_failed = False
+
+        turn.sink.text("External function execution complete. Parsing the results...")
+        turn.messages.messages_append(function_call_message)
+        turn.messages.messages_append(function_response_message)
+        turn.state = STATE_RESPOND
+
+
+def fast_debug_messages(turn):
+    """
+    Return the messages of the fast debug request: the messages of the session, the failed function call, its error and the debug prompt.
+    """
+    msg_debug = turn.messages.copy()
+    msg_debug.messages_append(turn.response_message)
+    msg_debug.messages_append(turn.function_response_message)
+    msg_debug.messages_append({"role": "user", "content": FAST_DEBUG_PROMPT})
+    return msg_debug
+
 
-    return messages
+def run_candidate_fixes(available_functions, candidates, namespace=None):
+    """
+    Run candidate fixes in parallel, each in an isolated copy of the namespace in which function_to_call runs the external functions.
+    """
+    return run_candidates(available_functions.functions_dic, candidates, namespace if namespace is not None else globals())
+
+
+def record_candidates_usage(span, response, msg_debug, model):
+    """
+    Record the tokens of the request sampling the candidate fixes in its span.
+    """
+    prompt_tokens, completion_tokens = response_tokens(response, msg_debug, model)
+    span.set(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+
+def accept_candidate_fix(turn, msg_debug, accepted, candidates_count):
+    """
+    Continue the session with the accepted candidate fix, or with the debug agent if no candidate ran without error.
+    """
+    if turn.debug_span is not None:
+        turn.debug_span.end(fixed=accepted is not None, candidates=candidates_count)
+        turn.debug_span = None
+
+    if accepted is None:
+        turn.sink.text("None of the %d candidate fixes ran without error, instantiating the debug agent..." % candidates_count, DEBUG)
+        turn.sampling_failed = True
+        # Review the original error again, now with the debug agent
+        turn.state = STATE_CHECK_RESULT
+        return
+
+    candidate, candidate_response = accepted
+    candidate_response["content"] = compact_tool_result(candidate_response["content"], turn.result_tokens)
+    turn.sink.markdown("**Accepted candidate fix:**", DEBUG)
+    turn.sink.markdown(calls_to_markdown([candidate["function_call"]]), CODE)
+    turn.sink.text("External function execution complete. Parsing the results...")
+    msg_debug.messages_append(candidate)
+    msg_debug.messages_append(candidate_response)
+    turn.messages = msg_debug
+    turn.is_enhanced_mode = False
+    turn.response_message = candidate
+    turn.function_response_message = None
+    turn.record.add_debug_timing("parallel", time.perf_counter() - turn.debug_started, True, candidates=candidates_count)
+    turn.debug_started = None
+    turn.state = STATE_RESPOND
+
+
+def sample_candidate_fixes(model,
+                           turn,
+                           available_functions=None):
+    """
+    Step of the session loop in fast debug mode: request turn.debug_candidates candidate fixes of the failed function call with one request (the n parameter),
+    run them in parallel, each in an isolated copy of the namespace, and accept the first one that runs without error.
+    If no candidate runs without error, the next state is STATE_CHECK_RESULT and the error is debugged by the debug agent.
+    :param model: Required parameter indicating the name of the large model to be called.
+    :param turn: Required parameter, the TurnState object of the current session.
+    :param available_functions: Required parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.
+    """
+    turn.sink.markdown("**Executing fast debug, sampling %d candidate fixes...**" % turn.debug_candidates, DEBUG)
+    msg_debug = fast_debug_messages(turn)
+
+    candidates = []
+    # No candidates are sampled once a budget is used up, the session loop then stops
+    if turn.governor is not None:
+        model = budget_model(turn.governor, model, msg_debug.tokens_count, turn.sink)
+    # The spans are ended explicitly rather than with trace.span, whose stack of open spans is per thread
+    # and would be shared with the other sessions of the event loop in an asynchronous session
+    if model is not None:
+        span = turn.trace.start_span("model_call", model=model, candidates=turn.debug_candidates)
+        try:
+            yield wait_rate_limit(model, msg_debug.tokens_count)
+            response = yield chat_completion(model=model,
+                                             messages=msg_debug.messages,
+                                             functions=available_functions.functions,
+                                             function_call=available_functions.function_call,
+                                             n=turn.debug_candidates)
+            candidates = candidate_messages(response)
+            if turn.governor is not None:
+                turn.governor.record_call(model, *response_tokens(response, msg_debug, model))
+            if turn.trace.enabled:
+                record_candidates_usage(span, response, msg_debug, model)
+        except OpenAIError as e:
+            span.set(error=str(e))
+            turn.sink.text("Unable to sample candidate fixes: %s" % e, ERROR)
+        span.end()
+
+    accepted = None
+    if candidates:
+        span = turn.trace.start_span("candidate_fixes", candidates=len(candidates))
+        accepted = yield Call(run_candidate_fixes, available_functions, candidates, turn.namespace, executor=TOOL_EXECUTOR)
+        span.end(fixed=accepted is not None)
+    accept_candidate_fix(turn, msg_debug, accepted, len(candidates))
+
+
+def send_debug_prompt(turn):
+    """
+    Append the next debug prompt of the debug agent to the messages of the session, the model's modification suggestions or modified code are obtained in the next step.
+    :param turn: Required parameter, the TurnState object of the current session, with at least one pending debug prompt.
+    """
+    debug_prompt = turn.debug_prompts.popleft()
+    turn.messages.messages_append({"role": "user", "content": debug_prompt})
+    turn.sink.markdown("**From Debug Agent:**", DEBUG)
+    turn.sink.markdown(debug_prompt, DEBUG)
+    # Print the prompt information
+    turn.sink.markdown("**From MateGen:**", DEBUG)
+    turn.state = STATE_RESPOND
 
 
 def is_text_response_valid(model,
-                           messages,
-                           text_answer_message,
-                           available_functions=None,
+                           turn,
                            is_developer_mode=False,
-                           is_enhanced_mode=False,
-                           delete_some_messages=False,
-                           is_task_decomposition=False):
+                           is_streaming_mode=False):
     """
     Responsible for reviewing the creation of text content. The running mode can be either fast mode or manual review mode. In fast mode, the model quickly creates text and saves it to the msg object.\
     In manual review mode, human confirmation is required before the function saves the text content created by the large model. During this process, the model can also be instructed to modify the text based on user input.
     :param model: Required parameter, indicating the name of the large model being called.
-    :param messages: Required parameter, a ChatMessages type object used to store conversation messages.
-    :param text_answer_message: Required parameter, representing a message containing text content created by the upper-level function.
-    :param available_functions: Optional parameter, an AvailableFunctions type object representing the basic information of external functions during the conversation.\
-    Defaults to None, indicating no external functions.
+    :param turn: Required parameter, the TurnState object of the current session, turn.response_message contains the text content created by the model.
     :param is_developer_mode: Indicates whether developer mode is enabled, default is False.\
     When developer mode is enabled, prompt templates are automatically added, and user feedback is solicited before executing code and after returning results, with modifications made based on user feedback.
-    :param is_enhanced_mode: Optional parameter indicating whether enhanced mode is enabled, default is False.\
-    When enhanced mode is enabled, a complex task decomposition process is automatically initiated, and deep debugging is automatically performed during code debugging.
-    :param delete_some_messages: Optional parameter indicating whether to delete several intermediate messages when concatenating messages, default is False.
-    :param is_task_decomposition: Optional parameter indicating whether the current task is a review of task decomposition results, default is False.
-    :return: Message containing the latest result from the large model's response.
+    :param is_streaming_mode: Optional parameter indicating whether streaming mode is enabled, default is False.\
+    When streaming mode is enabled, the text of the model's responses is rendered as it arrives and the time to the first token is recorded.
     """
 
+    text_answer_message = turn.response_message
+    # The session is finished unless the user asks for another response
+    turn.state = STATE_DONE
+
     # Retrieve and print the model's answer from text_answer_message
+    # In streaming mode, the answer has already been rendered while it arrived
     answer_content = text_answer_message["content"]
 
-    print("Model's Answer:\n")
-    display(Markdown(answer_content))
+    if not is_streaming_mode:
+        turn.sink.text("Model's Answer:\n", ANSWER)
+        turn.sink.markdown(answer_content, ANSWER)
 
-    # Create a variable user_input to record user feedback, default is None
-    user_input = None
+    # Create a variable decision to record the decision of the interaction policy, default is None
+    decision = None
 
     # If in developer mode or reviewing task decomposition results
     # If in developer mode but not task decomposition
-    if not is_task_decomposition and is_developer_mode:
-        user_input = input("Would you like to record the answer (1),\
-        provide modification feedback (2),\
-        ask a new question (3),\
-        or exit the conversation (4)?")
-        if user_input == '1':
+    if not turn.is_task_decomposition and is_developer_mode:
+        decision, new_user_content = yield Call(turn.policy.review_text, answer_content)
+        if decision == APPROVE:
             # If recording the answer, append it to the msg object
-            messages.messages_append(text_answer_message)
-            print("The conversation result has been saved.")
+            turn.messages.messages_append(text_answer_message)
+            turn.sink.text("The conversation result has been saved.")
 
     # If task decomposition
-    elif is_task_decomposition:
-        user_input = input("Would you like to execute the task according to this process (1),\
-        provide modification feedback on the current process (2),\
-        ask a new question (3),\
-        or exit the conversation (4)?")
-        if user_input == '1':
+    elif turn.is_task_decomposition:
+        decision, new_user_content = yield Call(turn.policy.review_task_decomposition, answer_content)
+        if decision == APPROVE:
             # In task decomposition, if choosing to execute the process
-            messages.messages_append(text_answer_message)
-            print("Okay, proceeding to execute the process step by step.")
-            messages.messages_append({"role": "user", "content": "Very well, please execute the process step by step."})
-            is_task_decomposition = False
-            is_enhanced_mode = False
-            messages = get_chat_response(model=model,
-                                         messages=messages,
-                                         available_functions=available_functions,
-                                         is_developer_mode=is_developer_mode,
-                                         is_enhanced_mode=is_enhanced_mode,
-                                         delete_some_messages=delete_some_messages,
-                                         is_task_decomposition=is_task_decomposition)
-
-    if user_input is not None:
-        if user_input == '1':
+            turn.messages.messages_append(text_answer_message)
+            turn.sink.text("Okay, proceeding to execute the process step by step.")
+            turn.messages.messages_append({"role": "user", "content": "Very well, please execute the process step by step."})
+            turn.is_task_decomposition = False
+            turn.is_enhanced_mode = False
+            turn.state = STATE_RESPOND
+
+    if decision is not None:
+        if decision == APPROVE:
             pass
-        elif user_input == '2':
-            new_user_content = input("Okay, enter your modification feedback for the model's result:")
-            print("Okay, making modifications.")
+        elif decision == MODIFY:
+            turn.sink.text("Okay, making modifications.")
             # Temporarily record the previous answer content in messages
-            messages.messages_append(text_answer_message)
+            turn.messages.messages_append(text_answer_message)
             # Record user modification feedback
-            messages.messages_append({"role": "user", "content": new_user_content})
+            turn.messages.messages_append({"role": "user", "content": new_user_content})
 
-            # Call the main function again for a response. To save tokens, the user modification feedback and the first version of the model's answer can be deleted
+            # Ask the model again. To save tokens, the user modification feedback and the first version of the model's answer can be deleted
             # Therefore, delete_some_messages=2 is set here
-            # Additionally, is_task_decomposition=is_task_decomposition is set here
-            # When modifying complex task decomposition results, is_task_decomposition=True will be automatically included
-            messages = get_chat_response(model=model,
-                                         messages=messages,
-                                         available_functions=available_functions,
-                                         is_developer_mode=is_developer_mode,
-                                         is_enhanced_mode=is_enhanced_mode,
-                                         delete_some_messages=2,
-                                         is_task_decomposition=is_task_decomposition)
+            # When modifying complex task decomposition results, turn.is_task_decomposition=True is kept
+            turn.delete_some_messages = 2
+            turn.state = STATE_RESPOND
 
-        elif user_input == '3':
-            new_user_content = input("Okay, please ask a new question:")
+        elif decision == NEW_QUESTION:
             # Modify the question
-            messages.messages[-1]["content"] = new_user_content
-            # Call the main function again for a response
-            messages = get_chat_response(model=model,
-                                         messages=messages,
-                                         available_functions=available_functions,
-                                         is_developer_mode=is_developer_mode,
-                                         is_enhanced_mode=is_enhanced_mode,
-                                         delete_some_messages=delete_some_messages,
-                                         is_task_decomposition=is_task_decomposition)
+            turn.messages.set_message_content(-1, new_user_content)
+            # Ask the model again
+            turn.state = STATE_RESPOND
 
         else:
-            print("Okay, exiting the current conversation.")
+            turn.sink.text("Okay, exiting the current conversation.")
 
     # If not in developer mode
     else:
         # Record the returned message
-        messages.messages_append(text_answer_message)
-
-    return messages
+        turn.messages.messages_append(text_answer_message)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,169 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def request_fingerprint(model, messages, functions=None, function_call=None):
+    """
+    Return a canonical hash of a Chat model request. The request is serialized as JSON with sorted keys and without whitespace,
+    so the same model, messages, functions and function_call always give the same key.
+    :param model: Required parameter, the name of the Chat model.
+    :param messages: Required parameter, the list of message dictionaries sent to the model.
+    :param functions: Optional parameter, the function definitions sent to the model.
+    :param function_call: Optional parameter, the function_call parameter sent to the model.
+    :return: The hex digest of the request.
+    """
+    request = {"model": model,
+               "messages": messages,
+               "functions": functions,
+               "function_call": function_call}
+    canonical = json.dumps(request, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache():
+    """
+    The ResponseCache class stores the response messages of the Chat model by request fingerprint, so that a question asked again about the same data
+    is answered without calling the model. Recent entries are kept in an in-memory LRU, all entries in a SQLite file on disk.
+    Entries expire after ttl seconds, and the least recently used entries are evicted once the disk cache exceeds max_disk_bytes.
+    """
+
+    def __init__(self,
+                 path="mategen_cache.sqlite",
+                 ttl=7 * 24 * 3600,
+                 max_memory_entries=256,
+                 max_disk_bytes=64 * 1024 * 1024):
+        """
+        :param path: Optional parameter, the SQLite file of the cache, ":memory:" keeps the cache in memory only.
+        :param ttl: Optional parameter, the number of seconds an entry stays valid, None means entries never expire.
+        :param max_memory_entries: Optional parameter, the number of entries kept in the in-memory LRU.
+        :param max_disk_bytes: Optional parameter, the maximum total size of the responses stored on disk.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        # key -> (created_at, message, latency, tokens)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                                 "key TEXT PRIMARY KEY, "
+                                 "model TEXT, "
+                                 "message TEXT, "
+                                 "latency REAL, "
+                                 "tokens INTEGER, "
+                                 "size INTEGER, "
+                                 "created_at REAL, "
+                                 "last_access REAL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._connection.commit()
+        # Session statistics
+        self.stats = {"hits": 0,
+                      "memory_hits": 0,
+                      "disk_hits": 0,
+                      "misses": 0,
+                      "bypassed": 0,
+                      "evictions": 0,
+                      "saved_latency": 0.0,
+                      "saved_tokens": 0}
+
+    def _expired(self, created_at, now):
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def get(self, key):
+        """
+        Look up a response message by request fingerprint.
+        :return: The cached response message dictionary, or None if the request is not cached or the entry expired.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and self._expired(entry[0], now):
+                del self._memory[key]
+                entry = None
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+            else:
+                row = self._connection.execute("SELECT created_at, message, latency, tokens FROM responses WHERE key = ?",
+                                               (key,)).fetchone()
+                if row is None:
+                    self.stats["misses"] += 1
+                    return None
+                if self._expired(row[0], now):
+                    self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._connection.commit()
+                    self.stats["misses"] += 1
+                    return None
+                self._connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                self._connection.commit()
+                entry = (row[0], json.loads(row[1]), row[2], row[3])
+                self._remember(key, entry)
+                self.stats["disk_hits"] += 1
+
+            created_at, message, latency, tokens = entry
+            self.stats["hits"] += 1
+            self.stats["saved_latency"] += latency or 0.0
+            self.stats["saved_tokens"] += tokens or 0
+            # A copy is returned, so that the cached message is not changed by the conversation
+            return dict(message)
+
+    def put(self, key, model, message, latency=0.0, tokens=0):
+        """
+        Store the response message of a request, with the latency and the number of tokens of the model call it saves when hit.
+        """
+        message = {name: message[name] for name in ("role", "content", "function_call") if message.get(name) is not None}
+        payload = json.dumps(message, ensure_ascii=False, default=str)
+        now = time.time()
+        with self._lock:
+            self._remember(key, (now, message, latency, tokens))
+            self._connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                     (key, model, payload, latency, tokens, len(payload), now, now))
+            self._evict(now)
+            self._connection.commit()
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, now):
+        # Remove expired entries, then the least recently used entries beyond max_disk_bytes
+        evictions = 0
+        if self.ttl is not None:
+            evictions += self._connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,)).rowcount
+        evictions += self._connection.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_access DESC, key) AS total FROM responses) "
+            "WHERE total > ?)", (self.max_disk_bytes,)).rowcount
+        self.stats["evictions"] += evictions
+
+    def record_bypass(self):
+        self.stats["bypassed"] += 1
+
+    def clear(self):
+        """
+        Remove every entry of the cache, in memory and on disk.
+        """
+        with self._lock:
+            self._memory.clear()
+            self._connection.execute("DELETE FROM responses")
+            self._connection.commit()
+
+    def report(self):
+        """
+        Return the cache statistics of the session, including the hit rate over the looked up requests.
+        """
+        stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+if __name__ == '__main__':
+    print("this file contains the ResponseCache class")
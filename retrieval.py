@@ -0,0 +1,122 @@
+import re
+import math
+from collections import Counter
+
+
+def tokenize(text):
+    """
+    Split a text into lowercase word terms used by the BM25 index. Identifiers such as user_demographics are also split into their parts.
+    """
+    terms = re.findall(r"\w+", text.lower())
+    parts = [part for term in terms if "_" in term for part in term.split("_") if part]
+    return terms + parts
+
+
+def chunk_document(content, max_chars=1500):
+    """
+    Split a markdown document into chunks. The document is first split at headings, and sections longer than max_chars are split at blank lines.
+    Each chunk keeps the heading of its section, so that a chunk still says which table or topic it describes.
+    :param content: Required parameter, the document as a string.
+    :param max_chars: Optional parameter, the maximum number of characters of a chunk (a single paragraph longer than this is kept whole).
+    :return: A list of chunk strings.
+    """
+    chunks = []
+    # Split the document at markdown headings, keeping each heading with its section
+    sections = re.split(r"\n(?=#{1,6} )", content)
+    for section in sections:
+        section = section.strip()
+        if not section:
+            continue
+        heading = section.splitlines()[0] if section.startswith('#') else ''
+
+        if len(section) <= max_chars:
+            chunks.append(section)
+            continue
+
+        # Split long sections at blank lines and merge paragraphs up to max_chars
+        current = ''
+        for paragraph in re.split(r"\n\s*\n", section):
+            if current and len(current) + len(paragraph) > max_chars:
+                chunks.append(current)
+                current = heading + '\n\n' if heading and not paragraph.startswith(heading) else ''
+            current += paragraph + '\n\n'
+        if current.strip() and current.strip() != heading:
+            chunks.append(current.strip())
+
+    return chunks
+
+
+class DocumentIndex():
+    """
+    The DocumentIndex class is a small local BM25 index over chunks of the external documents (e.g. the data dictionary) of a conversation.
+    Instead of sending every document as a whole system message, only the chunks most relevant to the current question are sent,
+    which reduces prompt tokens and keeps documents larger than tokens_thr usable.
+    """
+
+    def __init__(self, system_content_list=[], max_chars=1500, k1=1.5, b=0.75):
+        """
+        :param system_content_list: Optional parameter, the list of external documents to index.
+        :param max_chars: Optional parameter, the maximum number of characters of a chunk.
+        :param k1: Optional parameter, BM25 term frequency saturation.
+        :param b: Optional parameter, BM25 length normalisation.
+        """
+        self.max_chars = max_chars
+        self.k1 = k1
+        self.b = b
+        # Chunk strings and the term frequencies of each chunk
+        self.chunks = []
+        self.chunk_terms = []
+        self.chunk_lengths = []
+        # Number of chunks containing each term
+        self.document_frequency = Counter()
+        self.add_documents(system_content_list)
+
+    def add_documents(self, system_content_list):
+        """
+        Chunk and index additional documents.
+        """
+        if type(system_content_list) == str:
+            system_content_list = [system_content_list]
+
+        for content in system_content_list:
+            for chunk in chunk_document(content, max_chars=self.max_chars):
+                terms = Counter(tokenize(chunk))
+                self.chunks.append(chunk)
+                self.chunk_terms.append(terms)
+                self.chunk_lengths.append(sum(terms.values()))
+                self.document_frequency.update(terms.keys())
+
+    def search(self, query, top_k=3):
+        """
+        Return the chunks most relevant to a query, scored with BM25.
+        :param query: Required parameter, the current question of the user.
+        :param top_k: Optional parameter, the maximum number of chunks to return.
+        :return: A list of chunk strings, in the order they appear in the documents. Chunks without any query term are not returned.
+        """
+        if not self.chunks:
+            return []
+
+        n_chunks = len(self.chunks)
+        average_length = sum(self.chunk_lengths) / n_chunks
+        query_terms = set(tokenize(query))
+
+        scores = []
+        for i, terms in enumerate(self.chunk_terms):
+            score = 0.0
+            for term in query_terms:
+                tf = terms.get(term)
+                if not tf:
+                    continue
+                df = self.document_frequency[term]
+                idf = math.log(1 + (n_chunks - df + 0.5) / (df + 0.5))
+                score += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * self.chunk_lengths[i] / average_length))
+            if score > 0:
+                scores.append((score, i))
+
+        best = sorted(scores, reverse=True)[:top_k]
+        # Keep the original document order, which reads more naturally for the model
+        return [self.chunks[i] for _, i in sorted(best, key=lambda item: item[1])]
+
+
+if __name__ == '__main__':
+    print("this file contains the DocumentIndex class")
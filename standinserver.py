@@ -0,0 +1,294 @@
+import json
+import time
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import openai
+from responsecache import ResponseCache, request_fingerprint
+from tokenizer import count_message_tokens
+
+
+class ScriptedResponses():
+    """
+    The ScriptedResponses class returns a list of response messages in order, starting again from the first one after the last one.
+    An entry of the list is a message dictionary, e.g. {"role": "assistant", "content": "..."} or a message with a function_call,
+    or a function taking the request dictionary and returning a message dictionary.
+    """
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self._index = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, request):
+        with self._lock:
+            response = self.responses[self._index % len(self.responses)]
+            self._index += 1
+        return response(request) if callable(response) else response
+
+
+class ToolLoopResponses():
+    """
+    The ToolLoopResponses class answers like the model in a session with one external function call: a question is answered with a call of
+    function_name, and the result of the function with a text answer. It exercises the whole MateGen loop without a script per question.
+    """
+
+    def __init__(self, function_name="python_inter", arguments=None, answer="The analysis is complete."):
+        self.function_name = function_name
+        self.arguments = arguments if arguments is not None else {"py_code": "result = 1 + 1"}
+        self.answer = answer
+
+    def __call__(self, request):
+        messages = request.get("messages") or []
+        if request.get("functions") and messages and messages[-1].get("role") == "user":
+            return {"role": "assistant",
+                    "content": None,
+                    "function_call": {"name": self.function_name, "arguments": json.dumps(self.arguments)}}
+        return {"role": "assistant", "content": self.answer}
+
+
+class RecordedResponses():
+    """
+    The RecordedResponses class replays the responses recorded in a ResponseCache file (MateGen with is_cache_mode=True), by request fingerprint.
+    A request that was not recorded is answered by fallback.
+    """
+
+    def __init__(self, cache_path, fallback=None):
+        self.cache = ResponseCache(path=cache_path, ttl=None)
+        self.fallback = fallback if fallback is not None else ToolLoopResponses()
+
+    def __call__(self, request):
+        key = request_fingerprint(request.get("model"), request.get("messages"), request.get("functions"), request.get("function_call"))
+        message = self.cache.get(key)
+        return message if message is not None else self.fallback(request)
+
+
+class StandinRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves POST /v1/chat/completions like the OpenAI API, with the settings of the StandinServer object in self.server.standin.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        standin = self.server.standin
+        if self.path.rstrip('/').split('?')[0] not in ("/v1/chat/completions", "/chat/completions"):
+            self.send_json(404, {"error": {"message": "Unknown path %s" % self.path, "type": "invalid_request_error"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b'{}')
+
+        # Inject the configured errors, then wait for the simulated latency of the model
+        fault = standin.draw_fault()
+        if fault == "connection_error":
+            # Close the connection without a response, the client raises APIConnectionError
+            self.close_connection = True
+            return
+        time.sleep(standin.draw_latency())
+        if fault == "rate_limit":
+            self.send_json(429, {"error": {"message": "Rate limit reached (stand-in server).", "type": "requests", "code": "rate_limit_exceeded"}},
+                           headers={"Retry-After": str(standin.retry_after)})
+            return
+        if fault == "server_error":
+            self.send_json(500, {"error": {"message": "The server had an error (stand-in server).", "type": "server_error"}})
+            return
+
+        model = request.get("model", "gpt-3.5-turbo")
+        messages = [dict(standin.responses(request)) for _ in range(max(1, int(request.get("n") or 1)))]
+        if request.get("stream"):
+            self.send_stream(model, messages[0], standin.chunk_delay)
+        else:
+            self.send_json(200, completion(model, request, messages))
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_stream(self, model, message, chunk_delay):
+        # Server-sent events with the same chunks as the OpenAI API: the role, then the content or the function call arguments piece by piece
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.close_connection = True
+        self.end_headers()
+        for delta in stream_deltas(message):
+            chunk = {"id": "chatcmpl-standin", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            self.wfile.write(("data: %s\n\n" % json.dumps(chunk)).encode("utf-8"))
+            self.wfile.flush()
+            if chunk_delay:
+                time.sleep(chunk_delay)
+        finish_reason = "function_call" if message.get("function_call") else "stop"
+        chunk = {"id": "chatcmpl-standin", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                 "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]}
+        self.wfile.write(("data: %s\n\ndata: [DONE]\n\n" % json.dumps(chunk)).encode("utf-8"))
+        self.wfile.flush()
+
+
+def completion(model, request, messages):
+    """
+    Build the body of a ChatCompletion response with one choice per message, including the token usage counted with the tokenizer of the model.
+    """
+    prompt_tokens = sum(count_message_tokens(message, model) for message in request.get("messages") or [])
+    completion_tokens = sum(count_message_tokens(message, model) for message in messages)
+    choices = []
+    for index, message in enumerate(messages):
+        message.setdefault("role", "assistant")
+        message.setdefault("content", None)
+        choices.append({"index": index, "message": message, "finish_reason": "function_call" if message.get("function_call") else "stop"})
+    return {"id": "chatcmpl-standin",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": choices,
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}}
+
+
+def stream_deltas(message, piece_size=16):
+    # Split a message into the deltas of a streamed response
+    yield {"role": "assistant", "content": None if message.get("function_call") else ''}
+    if message.get("function_call"):
+        arguments = message["function_call"].get("arguments") or ''
+        yield {"function_call": {"name": message["function_call"]["name"], "arguments": ''}}
+        for start in range(0, len(arguments), piece_size):
+            yield {"function_call": {"arguments": arguments[start:start + piece_size]}}
+    else:
+        content = message.get("content") or ''
+        for start in range(0, len(content), piece_size):
+            yield {"content": content[start:start + piece_size]}
+
+
+class StandinServer():
+    """
+    The StandinServer class is a local stand-in for the OpenAI ChatCompletion API, so that the agent can be load-tested and profiled offline.
+    It answers with scripted, generated or recorded responses (function calls included, streamed or not, n choices), after a configurable latency with jitter,
+    and injects rate limit errors (429 with Retry-After), server errors and dropped connections at configurable rates.
+    The server runs in a background thread; used as a context manager it also points the openai client at itself, so that response.py, tool.auto_functions
+    and gptLearning.code_generate all call the stand-in server:
+
+        with StandinServer(latency=0.5, jitter=0.2, rate_limit_rate=0.05) as server:
+            mategen.chat("How many users are there?")
+    """
+
+    def __init__(self,
+                 responses=None,
+                 host="127.0.0.1",
+                 port=0,
+                 latency=0.0,
+                 jitter=0.0,
+                 chunk_delay=0.0,
+                 rate_limit_rate=0.0,
+                 server_error_rate=0.0,
+                 connection_error_rate=0.0,
+                 retry_after=1,
+                 seed=None):
+        """
+        :param responses: Optional parameter, a function taking the request dictionary and returning a response message, e.g. a ScriptedResponses,
+        ToolLoopResponses or RecordedResponses object, or a list of messages for ScriptedResponses. Defaults to None, indicating ToolLoopResponses().
+        :param host: Optional parameter, the address the server listens on.
+        :param port: Optional parameter, the port the server listens on, 0 for a free port.
+        :param latency: Optional parameter, the mean number of seconds before a response starts.
+        :param jitter: Optional parameter, the latency varies uniformly by up to jitter seconds around its mean.
+        :param chunk_delay: Optional parameter, the number of seconds between the chunks of a streamed response.
+        :param rate_limit_rate: Optional parameter, the fraction of requests answered with a 429 rate limit error.
+        :param server_error_rate: Optional parameter, the fraction of requests answered with a 500 error.
+        :param connection_error_rate: Optional parameter, the fraction of requests whose connection is closed without a response.
+        :param retry_after: Optional parameter, the Retry-After header of the rate limit errors, in seconds.
+        :param seed: Optional parameter, the seed of the latency and error draws, for reproducible runs.
+        """
+        if responses is None:
+            responses = ToolLoopResponses()
+        elif not callable(responses):
+            responses = ScriptedResponses(responses)
+        self.responses = responses
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_delay = chunk_delay
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.connection_error_rate = connection_error_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), StandinRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.standin = self
+        self._thread = None
+        self._previous_client = None
+        # Requests served and errors injected
+        self.stats = {"requests": 0, "rate_limit": 0, "server_error": 0, "connection_error": 0}
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return "http://%s:%d/v1" % (host, port)
+
+    def draw_fault(self):
+        # Decide whether the current request fails, and how
+        with self._lock:
+            self.stats["requests"] += 1
+            draw = self._random.random()
+            for fault, rate in (("rate_limit", self.rate_limit_rate),
+                                ("server_error", self.server_error_rate),
+                                ("connection_error", self.connection_error_rate)):
+                if draw < rate:
+                    self.stats[fault] += 1
+                    return fault
+                draw -= rate
+        return None
+
+    def draw_latency(self):
+        with self._lock:
+            return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def start(self):
+        """
+        Start serving in a background thread.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._httpd.serve_forever, name="mategen-standin", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving and close the socket of the server.
+        """
+        if self._thread is not None:
+            self._httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._httpd.server_close()
+
+    def __enter__(self):
+        self.start()
+        self._previous_client = point_openai_at(self.url)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        openai.api_base, openai.api_key = self._previous_client
+        self.stop()
+
+
+def point_openai_at(api_base, api_key=None):
+    """
+    Point the openai client, and so every model call of the agent, at another server implementing the OpenAI API, e.g. StandinServer().url.
+    :param api_base: Required parameter, the base URL of the API, e.g. http://127.0.0.1:8000/v1.
+    :param api_key: Optional parameter, the API key sent to the server. Defaults to None, indicating the current key, or a placeholder if none is set.
+    :return: The previous (api_base, api_key), to point the client back.
+    """
+    previous = (openai.api_base, openai.api_key)
+    openai.api_base = api_base
+    openai.api_key = api_key if api_key is not None else (openai.api_key or "standin")
+    return previous
+
+
+if __name__ == '__main__':
+    print("this file contains a local stand-in server for the OpenAI ChatCompletion API")
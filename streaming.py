@@ -0,0 +1,111 @@
+import time
+import openai
+from IPython.display import display, Markdown
+
+
+class MarkdownStreamSink():
+    """
+    The MarkdownStreamSink class renders the text deltas of a streamed model response as they arrive, through a single updatable display(Markdown(...)) output.
+    Updates are throttled to min_interval seconds, the complete text is always rendered when the stream is closed.
+    """
+
+    def __init__(self, header="Model's Answer:\n", min_interval=0.1):
+        self.header = header
+        self.min_interval = min_interval
+        self.text = ''
+        self.handle = None
+        self.last_update = 0
+
+    def write(self, delta):
+        # The header and the display output are only created once the first text arrives,
+        # so that a response containing only a function call renders nothing
+        if self.handle is None:
+            print(self.header)
+            self.handle = display(Markdown(''), display_id=True)
+        self.text += delta
+        now = time.perf_counter()
+        if now - self.last_update >= self.min_interval:
+            self._render()
+            self.last_update = now
+
+    def close(self):
+        if self.handle is not None:
+            self._render()
+
+    def _render(self):
+        # display returns None outside of IPython, in which case the text is shown once when the stream is closed
+        if self.handle is not None and hasattr(self.handle, "update"):
+            self.handle.update(Markdown(self.text))
+
+
+class StreamAssembler():
+    """
+    The StreamAssembler class rebuilds a complete response message from the chunks of a streamed ChatCompletion, including the arguments of a
+    streamed function_call, and records the time to the first token.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.role = "assistant"
+        self.content = ''
+        self.function_name = ''
+        self.function_arguments = ''
+        self.start_time = time.perf_counter()
+        self.time_to_first_token = None
+
+    def add_chunk(self, chunk):
+        if not chunk["choices"]:
+            return
+        delta = chunk["choices"][0].get("delta", {})
+        if self.time_to_first_token is None and (delta.get("content") or delta.get("function_call")):
+            self.time_to_first_token = time.perf_counter() - self.start_time
+        if delta.get("role"):
+            self.role = delta["role"]
+        if delta.get("content"):
+            self.content += delta["content"]
+            if self.sink is not None:
+                self.sink.write(delta["content"])
+        if delta.get("function_call"):
+            self.function_name += delta["function_call"].get("name") or ''
+            self.function_arguments += delta["function_call"].get("arguments") or ''
+
+    def message(self):
+        # Build the same message a non-streamed request returns, the function call is only handed over once its arguments are complete
+        if self.sink is not None:
+            self.sink.close()
+        message = {"role": self.role, "content": self.content or None}
+        if self.function_name:
+            message["function_call"] = {"name": self.function_name, "arguments": self.function_arguments}
+        return message
+
+    def timing(self, model):
+        return {"model": model,
+                "time_to_first_token": self.time_to_first_token,
+                "total_time": time.perf_counter() - self.start_time}
+
+
+def stream_chat_completion(sink=None, **request):
+    """
+    Call the Chat model with stream=True, render the text deltas through sink as they arrive, and assemble the complete response message.
+    :param sink: Optional parameter, an object with write(delta) and close() methods, e.g. a MarkdownStreamSink. None renders nothing.
+    :param request: The parameters of openai.ChatCompletion.create, such as model, messages, functions and function_call.
+    :return: A tuple of the response message and a timing dictionary with the time to the first token and the total time in seconds.
+    """
+    assembler = StreamAssembler(sink=sink)
+    for chunk in openai.ChatCompletion.create(stream=True, **request):
+        assembler.add_chunk(chunk)
+    return assembler.message(), assembler.timing(request.get("model"))
+
+
+async def astream_chat_completion(sink=None, **request):
+    """
+    Asynchronous counterpart of stream_chat_completion, using openai.ChatCompletion.acreate.
+    """
+    assembler = StreamAssembler(sink=sink)
+    async for chunk in await openai.ChatCompletion.acreate(stream=True, **request):
+        assembler.add_chunk(chunk)
+    return assembler.message(), assembler.timing(request.get("model"))
+
+
+if __name__ == '__main__':
+    print("this file contains functions to stream responses from llm")
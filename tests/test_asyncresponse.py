@@ -0,0 +1,75 @@
+import asyncio
+import threading
+from availablefunctions import AvailableFunctions
+from chatmessage import ChatMessages
+from interaction import AutoPolicy
+from outputsink import SilentSink
+from responsecache import ResponseCache
+from response import get_chat_response
+from asyncresponse import async_get_chat_response
+from standinserver import StandinServer, ToolLoopResponses
+
+
+def python_inter(py_code, g='globals()'):
+    exec(py_code, g)
+    return str(g.get("result"))
+
+
+def python_functions():
+    description = {"name": "python_inter", "description": "Run Python code",
+                   "parameters": {"type": "object", "properties": {"py_code": {"type": "string"}}, "required": ["py_code"]}}
+    return AvailableFunctions(functions_list=[python_inter], functions=[description])
+
+
+def session_arguments(**arguments):
+    return dict(model="gpt-3.5-turbo",
+                messages=ChatMessages(question="What is 1 + 1?"),
+                available_functions=python_functions(),
+                interaction_policy=AutoPolicy(),
+                output_sink=SilentSink(),
+                namespace={},
+                **arguments)
+
+
+class ThreadRecordingCache(ResponseCache):
+    """
+    A response cache recording the threads in which it is read and written.
+    """
+
+    def __init__(self):
+        super().__init__(path=":memory:")
+        self.threads = []
+
+    def get(self, key):
+        self.threads.append(threading.current_thread())
+        return super().get(key)
+
+    def put(self, key, model, message, latency=0.0, tokens=0):
+        self.threads.append(threading.current_thread())
+        super().put(key, model, message, latency=latency, tokens=tokens)
+
+
+def test_sync_and_async_sessions_run_the_same_steps():
+    with StandinServer(responses=[ToolLoopResponses()]) as server:
+        sync_messages = get_chat_response(**session_arguments())
+        sync_requests = server.stats["requests"]
+        async_messages = asyncio.run(async_get_chat_response(**session_arguments()))
+
+    assert [message["role"] for message in sync_messages.messages] == ["user", "assistant", "function", "assistant"]
+    assert async_messages.messages == sync_messages.messages
+    assert server.stats["requests"] == 2 * sync_requests == 4
+
+
+def test_async_sessions_use_the_response_cache_outside_the_event_loop():
+    cache = ThreadRecordingCache()
+
+    async def two_sessions():
+        loop_thread = threading.current_thread()
+        sessions = [async_get_chat_response(**session_arguments(response_cache=cache)) for _ in range(2)]
+        return loop_thread, await asyncio.gather(*sessions)
+
+    with StandinServer(responses=[ToolLoopResponses()]):
+        loop_thread, results = asyncio.run(two_sessions())
+
+    assert all(result.messages[-1]["content"] == "The analysis is complete." for result in results)
+    assert cache.threads and loop_thread not in cache.threads
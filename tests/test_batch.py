@@ -0,0 +1,63 @@
+import json
+from batch import BatchRunner, read_results, load_questions
+
+
+def write_lines(path, results, tail=b""):
+    with open(path, 'wb') as f:
+        for result in results:
+            f.write((json.dumps(result) + '\n').encode('utf-8'))
+        f.write(tail)
+
+
+def test_read_results_keeps_the_latest_result_of_each_question(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    write_lines(path, [{"id": "a", "status": "error"}, {"id": "b", "status": "ok"}, {"id": "a", "status": "ok"}])
+    results = read_results(path)
+    assert results == {"a": {"id": "a", "status": "ok"}, "b": {"id": "b", "status": "ok"}}
+
+
+def test_read_results_of_a_missing_file_is_empty(tmp_path):
+    assert read_results(str(tmp_path / "missing.jsonl")) == {}
+
+
+def test_a_line_cut_off_by_a_crash_is_truncated(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    complete = [{"id": "a", "status": "ok", "answer": "7043"}]
+    write_lines(path, complete, tail=b'{"id": "b", "status": "o')
+
+    assert read_results(path) == {"a": complete[0]}
+    assert (tmp_path / "results.jsonl").read_bytes() == (json.dumps(complete[0]) + '\n').encode('utf-8')
+
+    # A new result is appended after the last complete line
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({"id": "b", "status": "ok"}) + '\n')
+    assert set(read_results(path)) == {"a", "b"}
+
+
+def test_a_complete_json_line_without_a_newline_is_truncated(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    write_lines(path, [{"id": "a", "status": "ok"}], tail=b'{"id": "b", "status": "ok"}')
+    assert set(read_results(path)) == {"a"}
+    assert (tmp_path / "results.jsonl").read_bytes().endswith(b'"ok"}\n')
+
+
+def test_a_resumed_batch_skips_answered_questions_and_retries_errors(tmp_path):
+    path = str(tmp_path / "results.jsonl")
+    write_lines(path, [{"id": "0", "status": "ok"}, {"id": "1", "status": "error"}, {"id": "2", "status": "stopped"}])
+    questions = [{"id": str(i), "question": "Question %d" % i} for i in range(4)]
+
+    retrying = BatchRunner(None, path, retry_errors=True)
+    assert [question["id"] for question in retrying.pending_questions(questions)] == ["1", "3"]
+    keeping = BatchRunner(None, path, retry_errors=False)
+    assert [question["id"] for question in keeping.pending_questions(questions)] == ["3"]
+
+
+def test_load_questions_numbers_questions_without_an_id(tmp_path):
+    jsonl_path = tmp_path / "questions.jsonl"
+    jsonl_path.write_text('"How many users?"\n{"id": "q7", "question": "Churn rate?"}\n\n', encoding='utf-8')
+    csv_path = tmp_path / "questions.csv"
+    csv_path.write_text('question,id\nHow many users?,\nChurn rate?,q7\n', encoding='utf-8')
+
+    expected = [{"id": "0", "question": "How many users?"}, {"id": "q7", "question": "Churn rate?"}]
+    assert load_questions(str(jsonl_path)) == expected
+    assert load_questions(str(csv_path)) == expected
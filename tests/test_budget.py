@@ -0,0 +1,69 @@
+import pytest
+from budget import Budget, BudgetGovernor, call_cost, LEVEL_NORMAL, LEVEL_NO_ENHANCED, LEVEL_FALLBACK_MODEL, LEVEL_STOPPED
+
+
+def governor_after(tokens, **options):
+    governor = BudgetGovernor(session_budget=Budget(max_tokens=1000), **options)
+    governor.start_turn()
+    if tokens:
+        governor.record_call("gpt-4", tokens, 0)
+    return governor
+
+
+@pytest.mark.parametrize("tokens, level", [(0, LEVEL_NORMAL),
+                                           (499, LEVEL_NORMAL),
+                                           (500, LEVEL_NO_ENHANCED),
+                                           (799, LEVEL_NO_ENHANCED),
+                                           (800, LEVEL_FALLBACK_MODEL),
+                                           (999, LEVEL_FALLBACK_MODEL),
+                                           (1000, LEVEL_STOPPED)])
+def test_the_level_rises_with_the_fraction_of_the_budget_used(tokens, level):
+    assert governor_after(tokens).level() == level
+
+
+def test_the_prompt_of_the_next_call_counts_against_the_budget():
+    governor = governor_after(400)
+    assert governor.level() == LEVEL_NORMAL
+    assert governor.level(prompt_tokens=450) == LEVEL_FALLBACK_MODEL
+    assert governor.level(prompt_tokens=600) == LEVEL_STOPPED
+
+
+def test_the_fallback_model_is_used_from_the_fallback_level():
+    governor = governor_after(0, fallback_model="gpt-3.5-turbo")
+    assert governor.model_for("gpt-4", LEVEL_NORMAL) == "gpt-4"
+    assert governor.model_for("gpt-4", LEVEL_NO_ENHANCED) == "gpt-4"
+    assert governor.model_for("gpt-4", LEVEL_FALLBACK_MODEL) == "gpt-3.5-turbo"
+    assert BudgetGovernor(fallback_model=None).model_for("gpt-4", LEVEL_FALLBACK_MODEL) == "gpt-4"
+
+
+def test_the_most_used_budget_sets_the_level():
+    governor = BudgetGovernor(session_budget=Budget(max_tokens=100000, max_model_calls=4), turn_budget=Budget(max_cost=1.0))
+    governor.start_turn()
+    governor.record_call("gpt-3.5-turbo", 10, 10)
+    governor.record_call("gpt-3.5-turbo", 10, 10)
+    assert governor.level() == LEVEL_NO_ENHANCED
+    governor.record_call("gpt-4", 28000, 0)
+    assert call_cost("gpt-4", 28000, 0) == pytest.approx(0.84)
+    assert governor.level() == LEVEL_FALLBACK_MODEL
+    governor.record_call("gpt-4", 10, 10)
+    assert governor.level() == LEVEL_STOPPED
+
+
+def test_a_turn_budget_is_reset_by_each_turn_and_degraded_turns_are_counted():
+    governor = BudgetGovernor(turn_budget=Budget(max_model_calls=2))
+    governor.start_turn()
+    governor.record_call("gpt-3.5-turbo", 10, 10)
+    assert governor.level() == LEVEL_NO_ENHANCED
+    governor.record_call("gpt-3.5-turbo", 10, 10)
+    assert governor.level() == LEVEL_STOPPED
+    governor.end_turn()
+
+    governor.start_turn()
+    assert governor.level() == LEVEL_NORMAL
+    governor.record_call("gpt-3.5-turbo", 10, 10)
+    assert governor.level() == LEVEL_NO_ENHANCED
+    governor.end_turn()
+
+    report = governor.report()
+    assert report["session"]["model_calls"] == 3
+    assert report["stopped_turns"] == 1 and report["degraded_turns"] == 1
@@ -0,0 +1,48 @@
+import time
+import threading
+from chatmessage import ChatMessages, MessageLog
+
+
+def yield_inside_append(frame, event, arg):
+    # Give the other threads a chance to run between the lines of MessageLog.append
+    if frame.f_code is MessageLog.append.__code__:
+        def trace_lines(frame, event, arg):
+            if event == "line":
+                time.sleep(0)
+            return trace_lines
+        return trace_lines
+    return None
+
+
+def test_forks_appending_from_several_threads_keep_their_own_history():
+    base = MessageLog(["q0"])
+    forks = [base.fork() for _ in range(200)]
+    barrier = threading.Barrier(len(forks), timeout=10)
+
+    def append_own(index):
+        barrier.wait()
+        forks[index].append("message %d" % index)
+
+    threading.settrace(yield_inside_append)
+    try:
+        threads = [threading.Thread(target=append_own, args=(index,)) for index in range(len(forks))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        threading.settrace(None)
+
+    assert [list(log) for log in forks] == [["q0", "message %d" % index] for index in range(len(forks))]
+    assert list(base) == ["q0"]
+
+
+def test_evicting_the_only_turn_keeps_the_latest_message():
+    messages = ChatMessages(question="How many users are there?")
+    messages.messages_append({"role": "assistant", "content": None, "function_call": {"name": "sql_inter", "arguments": "{}"}})
+    messages.messages_append({"role": "function", "name": "sql_inter", "content": "[[7043]]"})
+    messages.messages_append({"role": "function", "name": "sql_inter", "content": "[[1869]]"})
+    messages.evict_oldest_turn()
+    messages.evict_oldest_turn()
+    assert [message["content"] for message in messages.history_messages] == ["[[1869]]"]
+    assert messages.tokens_count == messages.history_messages[0].tokens_count
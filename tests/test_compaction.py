@@ -0,0 +1,70 @@
+from chatmessage import ChatMessages
+from compaction import ConversationCompactor, is_summary_message
+from budget import Budget, BudgetGovernor
+from outputsink import JSONSink, ERROR
+from tracing import TraceMetrics
+from standinserver import StandinServer
+
+
+def long_conversation(turns=6):
+    messages = ChatMessages(system_content_list=["You are a data analyst."], question="How many users are there?", tokens_thr=400)
+    messages.messages_append({"role": "assistant", "content": "There are 7043 users in user_demographics."})
+    for index in range(turns):
+        messages.messages_append({"role": "user", "content": "What is the churn rate of contract type %d? " % index + "Please explain. " * 10})
+        messages.messages_append({"role": "assistant", "content": "The churn rate of contract type %d is %d%%." % (index, 10 + index)})
+    return messages
+
+
+def summarize(compactor, messages):
+    assert compactor.schedule(messages)
+    compactor._thread.join(10)
+    return compactor.apply(messages)
+
+
+def test_the_summary_goes_through_the_budget_tracing_and_output_sink_of_the_session():
+    sink = JSONSink()
+    governor = BudgetGovernor(session_budget=Budget(max_tokens=100000))
+    metrics = TraceMetrics()
+    compactor = ConversationCompactor(keep_recent=2, output_sink=sink, budget_governor=governor, metrics=metrics)
+    messages = long_conversation()
+    tokens_before = messages.tokens_count
+
+    with StandinServer(responses=[{"role": "assistant", "content": "7043 users, churn rates between 10% and 15%."}]) as server:
+        tokens_saved = summarize(compactor, messages)
+
+    assert server.stats["requests"] == 1
+    assert tokens_saved > 0 and messages.tokens_count == tokens_before - tokens_saved
+    assert is_summary_message(messages.history_messages[0])
+    assert len(messages.history_messages) == 3
+    assert compactor.stats["summaries"] == 1 and compactor.stats["summary_tokens_used"] > 0
+    assert governor.report()["session"]["model_calls"] == 1
+    assert ("model_call", "") in metrics.spans
+    assert not any(event["kind"] == ERROR for event in sink.events)
+
+
+def test_a_failed_summary_is_reported_through_the_output_sink():
+    sink = JSONSink()
+    compactor = ConversationCompactor(keep_recent=2, output_sink=sink)
+    messages = long_conversation()
+    history = list(messages.history_messages)
+
+    with StandinServer(server_error_rate=1.0):
+        assert summarize(compactor, messages) == 0
+
+    assert list(messages.history_messages) == history
+    assert compactor.stats["failed_summaries"] == 1
+    assert [event["kind"] for event in sink.events] == [ERROR]
+
+
+def test_no_summary_is_requested_once_the_budget_is_used_up():
+    sink = JSONSink()
+    governor = BudgetGovernor(session_budget=Budget(max_tokens=10))
+    compactor = ConversationCompactor(keep_recent=2, output_sink=sink, budget_governor=governor)
+    messages = long_conversation()
+
+    with StandinServer() as server:
+        assert summarize(compactor, messages) == 0
+
+    assert server.stats["requests"] == 0
+    assert compactor.stats["failed_summaries"] == 1
+    assert governor.report()["session"]["model_calls"] == 0
@@ -0,0 +1,101 @@
+import time
+import sqlite3
+import threading
+import pytest
+from dbpool import ConnectionPool, sqlite_connector, reset_session
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "telco.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE user_demographics (customerID TEXT)")
+    connection.commit()
+    connection.close()
+    return path
+
+
+def test_a_released_connection_is_reused(path):
+    pool = ConnectionPool(sqlite_connector(path), size=2)
+    first = pool.acquire()
+    pool.release(first)
+    second = pool.acquire()
+    assert second is first
+    pool.release(second)
+    report = pool.report()
+    assert report["opened"] == 1 and report["reused"] == 1 and report["in_use"] == 0 and report["idle"] == 1
+
+
+def test_the_pool_never_opens_more_than_size_connections(path):
+    pool = ConnectionPool(sqlite_connector(path), size=2, timeout=0.05)
+    borrowed = [pool.acquire(), pool.acquire()]
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+
+    # A waiting caller gets the connection released by another thread
+    pool.timeout = 5
+    released = threading.Timer(0.05, pool.release, (borrowed.pop(),))
+    released.start()
+    borrowed.append(pool.acquire())
+    released.join()
+    report = pool.report()
+    assert report["open"] == 2 and report["opened"] == 2 and report["waits"] == 2
+    for pooled in borrowed:
+        pool.release(pooled)
+
+
+def test_discarded_connections_are_closed_and_free_their_place(path):
+    pool = ConnectionPool(sqlite_connector(path), size=1)
+    pooled = pool.acquire()
+    pool.release(pooled, discard=True)
+    with pytest.raises(sqlite3.ProgrammingError):
+        pooled.connection.execute("SELECT 1")
+    assert pool.report()["open"] == 0
+
+    def failing_reset(connection):
+        raise sqlite3.OperationalError("lost connection")
+
+    pool.reset = failing_reset
+    pooled = pool.acquire()
+    pool.release(pooled)
+    assert pool.report()["open"] == 0 and pool.report()["idle"] == 0
+
+    # A connection that fails its health check is replaced
+    pool.reset = reset_session
+    pooled = pool.acquire()
+    pool.release(pooled)
+    pooled.connection.close()
+    assert pool.acquire() is not pooled
+    assert pool.report()["failed_checks"] == 1
+
+
+def test_idle_connections_are_closed_after_idle_timeout(path):
+    pool = ConnectionPool(sqlite_connector(path), size=2, idle_timeout=0.05)
+    first = pool.acquire()
+    pool.release(first)
+    time.sleep(0.1)
+    second = pool.acquire()
+    assert second is not first
+    assert pool.report()["expired"] == 1 and pool.report()["open"] == 1
+    pool.release(second)
+
+
+def test_the_session_is_reset_before_the_next_borrower(path):
+    pool = ConnectionPool(sqlite_connector(path), size=1)
+    with pool.connection() as connection:
+        connection.execute("CREATE TEMP TABLE scratch (a INTEGER)")
+        connection.execute("INSERT INTO user_demographics VALUES ('7590-VHVEG')")
+    with pool.connection() as connection:
+        assert connection.execute("SELECT name FROM sqlite_temp_master").fetchall() == []
+        assert connection.execute("SELECT COUNT(*) FROM user_demographics").fetchone() == (0,)
+    assert pool.report()["opened"] == 1
+
+
+def test_a_closed_pool_closes_returned_connections(path):
+    pool = ConnectionPool(sqlite_connector(path), size=1)
+    pooled = pool.acquire()
+    pool.close()
+    pool.release(pooled)
+    assert pool.report()["open"] == 0
+    with pytest.raises(RuntimeError):
+        pool.acquire()
@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import decimal
+import pandas as pd
+import pytest
+from dbpool import configure_pool, sqlite_connector
+from extraction import column_kinds, build_frame, concat_chunks, stream_extract, extract_streaming, configure_extraction, EXTRACTION_SETTINGS
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / "telco.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE payments (customer_id INTEGER, account_id INTEGER, charges REAL, contract TEXT)")
+    rows = [(index, None if index % 3 == 0 else 2 ** 40 + index, index / 7, "Month-to-month" if index % 2 else "One year") for index in range(1000)]
+    connection.executemany("INSERT INTO payments VALUES (?, ?, ?, ?)", rows)
+    connection.commit()
+    connection.close()
+    pool = configure_pool(sqlite_connector(path), size=2)
+    settings = dict(EXTRACTION_SETTINGS)
+    yield rows
+    EXTRACTION_SETTINGS.update(settings)
+    pool.close()
+
+
+def test_integers_with_null_stay_exact():
+    columns = ["id", "amount"]
+    rows = [(2 ** 24 + 1, decimal.Decimal("12345678.91")), (None, None)]
+    kinds = column_kinds(columns, rows)
+    assert kinds == ["integer", "decimal"]
+    df = build_frame(columns, rows, kinds)
+    assert str(df["id"].dtype) == "Int32"
+    assert df["id"][0] == 2 ** 24 + 1 and df["id"].isna()[1]
+    assert df["amount"][0] == decimal.Decimal("12345678.91")
+
+
+def test_downcast_floats_is_an_explicit_lossy_option():
+    columns = ["amount", "rate"]
+    rows = [(decimal.Decimal("1.25"), 0.5), (decimal.Decimal("1.5"), None)]
+    kinds = column_kinds(columns, rows)
+    exact = build_frame(columns, rows, kinds)
+    assert exact["amount"][0] == decimal.Decimal("1.25") and exact["rate"].dtype == "float64"
+    compact = build_frame(columns, rows, kinds, downcast_floats=True)
+    assert compact["amount"].dtype == "float32" and compact["rate"].dtype == "float32"
+
+
+def test_kinds_are_decided_from_the_first_chunk_with_values():
+    columns = ["note", "note"]
+    first = [(None, "a")] * 4
+    second = [(7, "b")] * 4
+    kinds = column_kinds(columns, first)
+    assert kinds == [None, "category"]
+    kinds = column_kinds(columns, second, kinds)
+    assert kinds == ["integer", "category"]
+    df = concat_chunks([build_frame(columns, first, kinds), build_frame(columns, second, kinds)], kinds)
+    assert list(df.columns) == ["note", "note"]
+    assert isinstance(df.iloc[:, 1].dtype, pd.CategoricalDtype)
+    assert df.iloc[:, 0].tolist()[-1] == 7
+
+
+def test_stream_extract_matches_the_table(database):
+    df, stats = stream_extract("SELECT * FROM payments", chunk_rows=300)
+    assert stats["chunks"] == 4 and stats["rows"] == 1000
+    assert df["account_id"].tolist()[1:3] == [row[1] for row in database[1:3]]
+    assert df["account_id"].isna().sum() == 334
+    assert str(df["account_id"].dtype) == "Int64"
+    assert df["charges"].tolist() == [row[2] for row in database]
+    assert isinstance(df["contract"].dtype, pd.CategoricalDtype)
+    assert "process_peak_rss_bytes" in stats and "peak_rss_growth_bytes" in stats
+
+
+def test_spill_files_are_unique_per_call(database, tmp_path):
+    pytest.importorskip("pyarrow")
+    configure_extraction(streaming=True, chunk_rows=300, spill_dir=str(tmp_path / "spill"))
+    first, second = {}, {}
+    extract_streaming("SELECT * FROM payments", "payments", first)
+    extract_streaming("SELECT * FROM payments WHERE customer_id < 10", "payments", second)
+    assert first["payments"] != second["payments"]
+    assert os.path.dirname(first["payments"]) == str(tmp_path / "spill")
+    assert len(pd.read_parquet(first["payments"])) == 1000
+    assert len(pd.read_parquet(second["payments"])) == 10
+    assert pd.read_parquet(first["payments"])["account_id"].dropna().iloc[0] == 2 ** 40 + 1
@@ -0,0 +1,97 @@
+import json
+import threading
+from availablefunctions import AvailableFunctions
+from parallelcalls import PARALLEL_FUNCTION_NAME, plan_calls, run_calls, add_parallel_function
+
+
+def dependencies(calls):
+    return [sorted(planned_call.depends_on) for planned_call in plan_calls(calls)]
+
+
+def test_independent_extractions_and_queries_do_not_wait():
+    calls = [{"name": "extract_data", "arguments": {"sql_query": "SELECT * FROM a", "df_name": "a"}},
+             {"name": "extract_data", "arguments": {"sql_query": "SELECT * FROM b", "df_name": "b"}},
+             {"name": "sql_inter", "arguments": {"sql_query": "SELECT 1"}}]
+    assert dependencies(calls) == [[], [], []]
+
+
+def test_python_code_waits_for_the_calls_creating_variables():
+    calls = [{"name": "extract_data", "arguments": {"sql_query": "SELECT * FROM a", "df_name": "a"}},
+             {"name": "extract_data", "arguments": {"sql_query": "SELECT * FROM b", "df_name": "b"}},
+             {"name": "python_inter", "arguments": json.dumps({"py_code": "n = len(a)"})},
+             {"name": "python_inter", "arguments": {"py_code": "m = n + 1"}}]
+    assert dependencies(calls) == [[], [], [0, 1], [0, 1, 2]]
+
+
+def test_writes_keep_their_order():
+    calls = [{"name": "python_inter", "arguments": {"py_code": "df['x'] = 1"}},
+             {"name": "python_inter", "arguments": {"py_code": "print(df.x)"}},
+             {"name": "extract_data", "arguments": {"sql_query": "SELECT * FROM df", "df_name": "df"}}]
+    assert dependencies(calls) == [[], [0], [0, 1]]
+
+
+def test_unknown_and_unparsable_calls_run_alone():
+    calls = [{"name": "sql_inter", "arguments": {"sql_query": "SELECT 1"}},
+             {"name": "python_inter", "arguments": {"py_code": "x = ("}},
+             {"name": "sql_inter", "arguments": {"sql_query": "SELECT 2"}},
+             {"name": "my_function", "arguments": {}}]
+    assert dependencies(calls) == [[], [0], [1], [0, 1, 2]]
+
+
+def test_calls_run_concurrently_and_failures_skip_dependents():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def extract_data(sql_query, df_name, g):
+        # Both extractions have to be running at the same time to pass the barrier
+        barrier.wait()
+        g[df_name] = sql_query
+        return "created %s" % df_name
+
+    def python_inter(py_code, g):
+        exec(py_code, g)
+        return "done"
+
+    functions_dic = {"extract_data": extract_data, "python_inter": python_inter}
+    calls = [{"name": "extract_data", "arguments": {"sql_query": "a", "df_name": "a"}},
+             {"name": "extract_data", "arguments": {"sql_query": "b", "df_name": "b"}},
+             {"name": "python_inter", "arguments": {"py_code": "c = a + undefined"}},
+             {"name": "python_inter", "arguments": {"py_code": "d = c"}}]
+    g = {}
+    results = run_calls(functions_dic, calls, g)
+    assert results[:2] == ["created a", "created b"]
+    assert "error" in results[2]
+    assert results[3] == "Skipped because call 3 returned an error."
+
+
+def test_a_result_mentioning_an_error_does_not_skip_dependents():
+    def extract_data(sql_query, df_name, g):
+        g[df_name] = [0.02]
+        return "created %s" % df_name
+
+    def python_inter(py_code, g):
+        exec(py_code, g)
+        return str(g["percent"])
+
+    functions_dic = {"extract_data": extract_data, "python_inter": python_inter}
+    calls = [{"name": "extract_data", "arguments": {"sql_query": "SELECT error_rate FROM logs", "df_name": "error_rates"}},
+             {"name": "python_inter", "arguments": {"py_code": "percent = error_rates[0] * 100"}}]
+    assert run_calls(functions_dic, calls, {}) == ["created error_rates", "2.0"]
+
+
+def test_add_parallel_function_leaves_the_shared_functions_unchanged():
+    def sql_inter(sql_query, g='globals()'):
+        return sql_query
+
+    description = {"name": "sql_inter", "description": "Run a query", "parameters": {"type": "object", "properties": {}}}
+    shared = AvailableFunctions(functions_list=[sql_inter], functions=[description])
+    parallel = add_parallel_function(shared)
+
+    assert parallel is not shared
+    assert PARALLEL_FUNCTION_NAME in parallel.functions_dic
+    assert [function["name"] for function in parallel.functions] == ["sql_inter", PARALLEL_FUNCTION_NAME]
+    assert list(shared.functions_dic) == ["sql_inter"]
+    assert shared.functions == [description]
+    assert add_parallel_function(parallel) is parallel
+
+    result = json.loads(parallel.functions_dic[PARALLEL_FUNCTION_NAME]([{"name": "sql_inter", "arguments": {"sql_query": "SELECT 1"}}], g={}))
+    assert result == [{"name": "sql_inter", "result": "SELECT 1"}]
@@ -0,0 +1,100 @@
+import sqlite3
+import pytest
+from dbpool import configure_pool, sqlite_connector
+from querycache import QueryCache, normalize_sql, sql_tokens, referenced_tables, statement_keyword, configure_query_cache, get_query_cache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    path = str(tmp_path / "telco.db")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE user_demographics (customerID TEXT, gender TEXT)")
+    connection.commit()
+    connection.close()
+    pool = configure_pool(sqlite_connector(path), size=1)
+    yield QueryCache(version_check_interval=0)
+    pool.close()
+
+
+def kind(cache, sql):
+    return cache.lookup(sql).kind
+
+
+def test_normalized_statements_are_the_same_entry():
+    assert normalize_sql("SELECT COUNT(*) FROM user_demographics;") == normalize_sql("select count( * )\nfrom `user_demographics` -- all rows")
+    assert normalize_sql("SELECT * FROM t WHERE a = \"x\"") == normalize_sql("select * from t where a = 'x'")
+    assert normalize_sql("SELECT * FROM t WHERE a = 'X'") != normalize_sql("select * from t where a = 'x'")
+
+
+def test_reads_writes_and_uncached_statements(cache):
+    assert kind(cache, "SELECT * FROM user_demographics") == "read"
+    assert kind(cache, "SHOW TABLES") == "read"
+    assert kind(cache, "DESCRIBE user_demographics") == "read"
+    assert kind(cache, "UPDATE user_demographics SET gender = 'F'") == "write"
+    assert kind(cache, "INSERT INTO user_demographics VALUES ('1', 'F')") == "write"
+    assert kind(cache, "DROP TABLE user_demographics") == "write"
+    assert kind(cache, "SELECT NOW() FROM user_demographics") == "uncached"
+    assert kind(cache, "SELECT * FROM user_demographics FOR UPDATE") == "uncached"
+    assert kind(cache, "SELECT * INTO OUTFILE '/tmp/x' FROM user_demographics") == "uncached"
+    assert kind(cache, "SET @a = 1") == "uncached"
+
+
+def test_with_statements_are_classified_by_their_statement(cache):
+    assert statement_keyword(sql_tokens("WITH ids AS (SELECT customerID FROM a) SELECT * FROM ids")) == "select"
+    assert statement_keyword(sql_tokens("WITH RECURSIVE n (i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT i FROM n")) == "select"
+    assert kind(cache, "WITH ids AS (SELECT customerID FROM a) SELECT * FROM ids") == "read"
+    update = "WITH ids AS (SELECT customerID FROM churn) UPDATE user_demographics SET gender = 'F' WHERE customerID IN (SELECT customerID FROM ids)"
+    assert statement_keyword(sql_tokens(update)) == "update"
+    assert kind(cache, update) == "write"
+    assert kind(cache, "WITH old AS (SELECT 1) DELETE FROM user_demographics") == "write"
+    assert kind(cache, "WITH x AS (SELECT 1) TABLE x") == "write"
+
+
+def test_referenced_tables_are_lower_case():
+    assert referenced_tables(sql_tokens("SELECT * FROM Users u, churn JOIN telco_db.Payments AS p ON u.id = p.id")) == {"users", "telco_db.payments", "churn"}
+    assert referenced_tables(sql_tokens("SELECT a FROM t ORDER BY a DESC, b")) == {"t"}
+
+
+def test_a_write_invalidates_the_results_of_its_tables(cache):
+    ticket = cache.lookup("SELECT COUNT(*) FROM Users")
+    assert ticket.result is None
+    cache.store(ticket, "[[1]]")
+    assert cache.lookup("select count(*) from Users").result == "[[1]]"
+    cache.store(cache.lookup("UPDATE users SET a = 1"), "[]")
+    assert cache.lookup("SELECT COUNT(*) FROM Users").result is None
+
+    cache.store(cache.lookup("SELECT * FROM churn"), "[[2]]")
+    cache.store(cache.lookup("WITH ids AS (SELECT 1) DELETE FROM churn"), "[]")
+    assert cache.lookup("SELECT * FROM churn").result is None
+    report = cache.report()
+    assert report["hits"] == 1 and report["writes"] == 2
+
+
+def test_server_versions_are_only_turned_off_without_information_schema(cache, monkeypatch):
+    cache.store(cache.lookup("SELECT * FROM user_demographics"), "[[1]]")
+    assert cache.server_versions is False
+
+    lost = QueryCache(version_check_interval=0)
+    attempts = []
+
+    def read_server_versions(tables):
+        attempts.append(tables)
+        if len(attempts) == 1:
+            raise ConnectionError("Lost connection to MySQL server during query")
+        return {table: ("2024-01-01 00:00:00", None) for table in tables}
+
+    monkeypatch.setattr(lost, "read_server_versions", read_server_versions)
+    assert kind(lost, "SELECT * FROM user_demographics") == "uncached"
+    assert lost.server_versions is True
+    assert kind(lost, "SELECT * FROM user_demographics") == "read"
+    assert len(attempts) == 2
+
+
+def test_the_cache_is_opt_in():
+    assert get_query_cache() is None
+    try:
+        assert isinstance(configure_query_cache(max_entries=10), QueryCache)
+        assert get_query_cache().max_entries == 10
+    finally:
+        configure_query_cache(enabled=False)
+    assert get_query_cache() is None
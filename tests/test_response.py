@@ -0,0 +1,102 @@
+import json
+import response
+from chatmessage import ChatMessages
+from interaction import AutoPolicy
+from outputsink import SilentSink
+from budget import Budget, BudgetGovernor
+from standinserver import StandinServer
+
+FUNCTION_CALL = {"role": "assistant", "content": None,
+                 "function_call": {"name": "python_inter", "arguments": json.dumps({"py_code": "result = 1"})}}
+DECOMPOSITION = {"role": "assistant", "content": "1. Count the users. 2. Compute the churn rate."}
+ANSWER = {"role": "assistant", "content": "There are 7043 users."}
+
+
+def is_speculative_request(request):
+    # The speculative request carries the task decomposition examples twice
+    return json.dumps(request["messages"], ensure_ascii=False).count("What is Google Cloud Email?") > 1
+
+
+def first_response(message):
+    def respond(request):
+        return DECOMPOSITION if is_speculative_request(request) else message
+    return respond
+
+
+def enhanced_session(governor):
+    return response.get_chat_response(model="gpt-3.5-turbo",
+                                      messages=ChatMessages(question="How many users are there?"),
+                                      is_enhanced_mode=True,
+                                      interaction_policy=AutoPolicy(),
+                                      output_sink=SilentSink(),
+                                      namespace={},
+                                      budget_governor=governor,
+                                      max_steps=2)
+
+
+def wait_for_speculations():
+    response.SPECULATION_EXECUTOR.shutdown(wait=True)
+    response.configure_speculation()
+
+
+def test_a_discarded_speculation_is_not_counted_in_the_budget_or_the_rate_limiter(monkeypatch):
+    released = []
+    monkeypatch.setattr(response, "release", lambda model, tokens_count=0: released.append(model))
+    governor = BudgetGovernor(session_budget=Budget(max_tokens=100000))
+
+    with StandinServer(responses=[first_response(ANSWER)], latency=0.1) as server:
+        messages = enhanced_session(governor)
+        wait_for_speculations()
+
+    assert messages.messages[-1]["content"] == ANSWER["content"]
+    assert server.stats["requests"] == 2
+    assert governor.report()["session"]["model_calls"] == 1
+    assert released == ["gpt-3.5-turbo"]
+
+
+def test_a_used_speculation_is_counted_in_the_budget(monkeypatch):
+    released = []
+    monkeypatch.setattr(response, "release", lambda model, tokens_count=0: released.append(model))
+    governor = BudgetGovernor(session_budget=Budget(max_tokens=100000))
+
+    with StandinServer(responses=[first_response(FUNCTION_CALL)]) as server:
+        messages = enhanced_session(governor)
+        wait_for_speculations()
+
+    assert messages.messages[-2]["content"] == DECOMPOSITION["content"]
+    assert server.stats["requests"] == 2
+    assert governor.report()["session"]["model_calls"] == 2
+    assert released == []
+
+
+def test_a_request_trimmed_for_the_fallback_model_leaves_the_session_history_intact():
+    messages = ChatMessages(question="How many users are there?")
+    for index in range(40):
+        messages.messages_append({"role": "assistant", "content": "Answer %d: " % index + "churn rate by contract type, " * 40})
+        messages.messages_append({"role": "user", "content": "Question %d?" % (index + 1)})
+    history = list(messages.history_messages)
+    governor = BudgetGovernor(session_budget=Budget(max_tokens=int(messages.tokens_count * 1.1)), fallback_model="gpt-3.5-turbo-0613")
+    sent = []
+
+    def respond(request):
+        sent.append(request)
+        return ANSWER
+
+    with StandinServer(responses=[respond]):
+        answer = response.get_gpt_response(model="gpt-4-1106-preview", messages=messages, output_sink=SilentSink(), budget_governor=governor)
+
+    assert answer["content"] == ANSWER["content"]
+    assert sent[0]["model"] == "gpt-3.5-turbo-0613"
+    assert 0 < len(sent[0]["messages"]) < len(history)
+    assert sent[0]["messages"][-1]["content"] == "Question 40?"
+    assert list(messages.history_messages) == history
+
+
+def test_configure_speculation_resizes_the_pool():
+    previous = response.SPECULATION_EXECUTOR
+    try:
+        executor = response.configure_speculation(max_workers=3)
+        assert response.SPECULATION_EXECUTOR is executor and executor is not previous
+        assert response.SPECULATION_WORKERS == 3
+    finally:
+        response.configure_speculation()
@@ -0,0 +1,206 @@
+import threading
+import tiktoken
+
+# Encoding used when tiktoken does not know the model name, e.g. fine-tuned or newly released models
+DEFAULT_ENCODING_NAME = "cl100k_base"
+
+# Process-wide registry of tiktoken encoders, keyed by encoding name (i.e. model family)
+_encodings = {}
+# Cache of model name -> encoding name, so the model name is only resolved once
+_model_encoding_names = {}
+# Lock protecting both dictionaries, the encoders are created at most once even with concurrent sessions
+_lock = threading.Lock()
+
+
+def get_encoding_name(model="gpt-3.5-turbo"):
+    """
+    Return the name of the tiktoken encoding used by a model, e.g. cl100k_base for the gpt-3.5-turbo and gpt-4 families.
+    :param model: Name of the Chat model, such as gpt-3.5-turbo-16k-0613 or gpt-4-0613.
+    :return: The encoding name, DEFAULT_ENCODING_NAME if the model is unknown to tiktoken.
+    """
+    encoding_name = _model_encoding_names.get(model)
+    if encoding_name is None:
+        try:
+            encoding_name = tiktoken.encoding_for_model(model).name
+        except KeyError:
+            encoding_name = DEFAULT_ENCODING_NAME
+        _model_encoding_names[model] = encoding_name
+    return encoding_name
+
+
+def get_encoding(model="gpt-3.5-turbo"):
+    """
+    Return the shared tiktoken encoder of a model. The encoder of each model family is loaded lazily the first time it is requested,
+    and then reused by every ChatMessages object, copy and MateGen session of the process.
+    :param model: Name of the Chat model.
+    :return: A tiktoken Encoding object.
+    """
+    encoding_name = get_encoding_name(model)
+    encoding = _encodings.get(encoding_name)
+    if encoding is None:
+        with _lock:
+            # Check again inside the lock, another thread may have loaded the encoder meanwhile
+            encoding = _encodings.get(encoding_name)
+            if encoding is None:
+                encoding = tiktoken.get_encoding(encoding_name)
+                _encodings[encoding_name] = encoding
+    return encoding
+
+
+# Registry of Chat models: context window in tokens and per-message overhead of the chat format
+# Model names are matched by their longest registered prefix, e.g. gpt-4-0613 matches gpt-4
+MODEL_REGISTRY = {
+    "gpt-3.5-turbo": {"context_window": 4096, "tokens_per_message": 3, "tokens_per_name": 1},
+    "gpt-3.5-turbo-0301": {"context_window": 4096, "tokens_per_message": 4, "tokens_per_name": -1},
+    "gpt-3.5-turbo-16k": {"context_window": 16385, "tokens_per_message": 3, "tokens_per_name": 1},
+    "gpt-3.5-turbo-1106": {"context_window": 16385, "tokens_per_message": 3, "tokens_per_name": 1},
+    "gpt-3.5-turbo-0125": {"context_window": 16385, "tokens_per_message": 3, "tokens_per_name": 1},
+    "gpt-4": {"context_window": 8192, "tokens_per_message": 3, "tokens_per_name": 1},
+    "gpt-4-32k": {"context_window": 32768, "tokens_per_message": 3, "tokens_per_name": 1},
+    "gpt-4-1106": {"context_window": 128000, "tokens_per_message": 3, "tokens_per_name": 1},
+    "gpt-4-0125": {"context_window": 128000, "tokens_per_message": 3, "tokens_per_name": 1},
+    "gpt-4-turbo": {"context_window": 128000, "tokens_per_message": 3, "tokens_per_name": 1},
+    "gpt-4o": {"context_window": 128000, "tokens_per_message": 3, "tokens_per_name": 1},
+}
+
+# Specification used for models missing from MODEL_REGISTRY
+DEFAULT_MODEL_SPEC = {"context_window": 4096, "tokens_per_message": 3, "tokens_per_name": 1}
+
+# Every reply is primed with <|start|>assistant<|message|>
+REPLY_PRIMING_TOKENS = 3
+# Fixed overhead of the functions parameter, in addition to the function definitions themselves
+FUNCTIONS_OVERHEAD_TOKENS = 9
+
+
+def get_model_spec(model):
+    """
+    Return the registry entry of a model, found by the longest registered prefix of the model name.
+    :param model: Name of the Chat model.
+    :return: A dictionary with the context_window, tokens_per_message and tokens_per_name of the model.
+    """
+    best_prefix = None
+    for prefix in MODEL_REGISTRY:
+        if model.startswith(prefix) and (best_prefix is None or len(prefix) > len(best_prefix)):
+            best_prefix = prefix
+    if best_prefix is None:
+        return DEFAULT_MODEL_SPEC
+    return MODEL_REGISTRY[best_prefix]
+
+
+def count_message_tokens(message, model="gpt-3.5-turbo"):
+    """
+    Count the tokens of a message as it is sent in the chat format, i.e. the encoded values plus the per-message and per-name overhead of the model.
+    Unlike encoding str(message), the Python dict syntax is not counted.
+    :param message: Required parameter, a message dictionary or OpenAIObject.
+    :param model: Name of the Chat model.
+    :return: The number of tokens of the message.
+    """
+    encoding = get_encoding(model)
+    spec = get_model_spec(model)
+    tokens_count = spec["tokens_per_message"]
+    for key, value in message.items():
+        if value is None:
+            continue
+        if key == "function_call":
+            tokens_count += len(encoding.encode(value["name"])) + len(encoding.encode(value["arguments"]))
+        else:
+            tokens_count += len(encoding.encode(str(value)))
+        if key == "name":
+            tokens_count += spec["tokens_per_name"]
+    return tokens_count
+
+
+def _format_type(param, indent):
+    # Format a JSON Schema type the way the model sees it in its function definitions
+    param_type = param.get("type")
+    if param_type == "string":
+        if param.get("enum"):
+            return " | ".join('"%s"' % value for value in param["enum"])
+        return "string"
+    if param_type in ("number", "integer"):
+        if param.get("enum"):
+            return " | ".join(str(value) for value in param["enum"])
+        return "number"
+    if param_type == "boolean":
+        return "boolean"
+    if param_type == "null":
+        return "null"
+    if param_type == "object":
+        return "{\n" + _format_object_properties(param, indent + 2) + "\n}"
+    if param_type == "array":
+        if param.get("items"):
+            return _format_type(param["items"], indent) + "[]"
+        return "any[]"
+    return "any"
+
+
+def _format_object_properties(obj, indent):
+    # Format the properties of a JSON Schema object, one line per property
+    lines = []
+    required = obj.get("required", [])
+    for name, param in obj.get("properties", {}).items():
+        if param.get("description") and indent < 2:
+            lines.append("// %s" % param["description"])
+        optional = "" if name in required else "?"
+        lines.append("%s%s: %s," % (name, optional, _format_type(param, indent)))
+    return "\n".join(" " * indent + line for line in lines)
+
+
+def format_function_definitions(functions):
+    """
+    Format the functions parameter of a request into the TypeScript-like namespace the model actually receives, so that its tokens can be counted.
+    """
+    lines = ["namespace functions {", ""]
+    for function in functions:
+        if function.get("description"):
+            lines.append("// %s" % function["description"])
+        parameters = function.get("parameters", {})
+        if parameters.get("properties"):
+            lines.append("type %s = (_: {" % function["name"])
+            lines.append(_format_object_properties(parameters, 0))
+            lines.append("}) => any;")
+        else:
+            lines.append("type %s = () => any;" % function["name"])
+        lines.append("")
+    lines.append("} // namespace functions")
+    return "\n".join(lines)
+
+
+def count_functions_tokens(functions, model="gpt-3.5-turbo"):
+    """
+    Count the tokens of the functions parameter of a request, e.g. AvailableFunctions.functions.
+    :param functions: A list of function descriptions, or None.
+    :param model: Name of the Chat model.
+    :return: The number of tokens of the function definitions, 0 if there are none.
+    """
+    if not functions:
+        return 0
+    return len(get_encoding(model).encode(format_function_definitions(functions))) + FUNCTIONS_OVERHEAD_TOKENS
+
+
+def get_reserved_completion_tokens(model):
+    """
+    Return the default number of tokens kept free for the model's reply: an eighth of the context window, at least 1000 tokens.
+    """
+    return max(get_model_spec(model)["context_window"] // 8, 1000)
+
+
+def get_prompt_budget(model, functions=None, reserved_completion_tokens=None):
+    """
+    Return the maximum number of message tokens a request to the model can contain, i.e. the context window minus the reserved completion budget,
+    the function definitions and the reply priming. This is the tokens_thr of a ChatMessages object used with the model.
+    :param model: Name of the Chat model.
+    :param functions: Optional parameter, the functions parameter of the requests, e.g. AvailableFunctions.functions.
+    :param reserved_completion_tokens: Optional parameter, the number of tokens kept free for the reply. Defaults to get_reserved_completion_tokens(model).
+    :return: The number of tokens available for the messages.
+    """
+    if reserved_completion_tokens is None:
+        reserved_completion_tokens = get_reserved_completion_tokens(model)
+    return (get_model_spec(model)["context_window"]
+            - reserved_completion_tokens
+            - count_functions_tokens(functions, model)
+            - REPLY_PRIMING_TOKENS)
+
+
+if __name__ == '__main__':
+    print("this file contains the shared tiktoken encoder registry")
@@ -14,38 +14,46 @@ import numpy as np
 import inspect
 import openai
 import time
+from ratelimit import acquire, register_retry
+from toolresult import compact_value, compact_rows
+from dbpool import get_pool
+from extraction import EXTRACTION_SETTINGS, extract_streaming
+from querycache import get_query_cache
 
 def sql_inter(sql_query, g='globals()'):
     """
     This function is used to execute a segment of SQL code and ultimately retrieve the result of the SQL code execution. The core functionality is to transmit the input SQL code to a MySQL environment for execution and return the results. Note that this function uses pymysql to connect to the MySQL database.
     sql_query: A string containing the SQL query to be executed. This query will be used to perform operations on tables within the telco_db database in MySQL and retrieve various related information from these tables.
     g: A variable of type string, representing the environment variable. It does not need to be set; the default parameter is sufficient.
-    Returns: The result of executing sql_query in MySQL.
+    Returns: The result of executing sql_query in MySQL, as JSON rows truncated to the first rows with the total row count.
     """
 
-    mysql_pw = os.getenv('MYSQL_PW')
+    # If the query cache is enabled, a read query asked before is answered from it while the tables it read are unchanged
+    query_cache = get_query_cache()
+    ticket = query_cache.lookup(sql_query) if query_cache is not None else None
+    if ticket is not None and ticket.result is not None:
+        return ticket.result
 
-    connection = pymysql.connect(
-            host='localhost', 
-            user='root', 
-            passwd=mysql_pw, 
-            db='telco_db', 
-            charset='utf8'
-        )
-
-    try:
-        with connection.cursor() as cursor:
+    # Borrow a connection of the shared pool instead of connecting for every query
+    with get_pool().connection() as connection:
+        cursor = connection.cursor()
+        try:
 
             sql = sql_query
             cursor.execute(sql)
 
             results = cursor.fetchall()
 
-    finally:
-        connection.close()
+        finally:
+            cursor.close()
 
 
-    return json.dumps(results)
+    # Only the first rows are returned to the model, the whole result is sent again with every later request
+    result = compact_rows(results)
+    # Store the result of a read query, or invalidate the results of the tables changed by a write
+    if ticket is not None:
+        query_cache.store(ticket, result)
+    return result
 
 def extract_data(sql_query,df_name,g='globals()'):
     """
@@ -56,18 +64,13 @@ def extract_data(sql_query,df_name,g='globals()'):
     Returns: The result of reading and saving the table.
     """
 
-    mysql_pw = os.getenv('MYSQL_PW')
-
-    connection = pymysql.connect(
-            host='localhost', 
-            user='root',
-            passwd=mysql_pw, 
-            db='telco_db', 
-            charset='utf8'
-        )
-
+    # In streaming mode the table is read chunk by chunk with a server-side cursor, see configure_extraction
+    if EXTRACTION_SETTINGS["streaming"]:
+        return extract_streaming(sql_query, df_name, g)
 
-    g[df_name] = pd.read_sql(sql_query, connection)
+    # The connection is borrowed from the shared pool and given back once the table is read
+    with get_pool().connection() as connection:
+        g[df_name] = pd.read_sql(sql_query, connection)
 
     return "Successfully completed the creation of the %s variable." % df_name
 
@@ -86,18 +89,19 @@ def python_inter(py_code, g='globals()'):
         return f"An error occurred during code execution: {e}"
     
     global_vars_after = set(g.keys())
-    new_vars = global_vars_after - global_vars_before
+    # exec adds __builtins__ to a new namespace, it is not a result of the code
+    new_vars = {var for var in global_vars_after - global_vars_before if var != '__builtins__'}
     
-    # If there are new variables
+    # If there are new variables, DataFrames are summarized and long collections truncated instead of printed whole
     if new_vars:
         result = {var: g[var] for var in new_vars}
-        return str(result)
+        return compact_value(result)
     
     # If there are no new variables, which could mean the code is an expression or the code reassigns the same variables
     else:
         try:
             # Try returning the result if it is an expression
-            return str(eval(py_code, g))
+            return compact_value(eval(py_code, g))
         # If there is an error, test if it is due to reassigning the same variables
         except Exception as e:
             try:
@@ -243,6 +247,7 @@ def auto_functions(functions_list):
                           Please help me create a function object for this current function in a similar format.' % (function_name, function_description)
 
 
+            acquire("gpt-4-0613")
             response = openai.ChatCompletion.create(
                               model="gpt-4-0613",
                               messages=[
@@ -263,14 +268,14 @@ def auto_functions(functions_list):
         except Exception as e:
             attempts += 1  # Increment the attempt count
             print("An error occurred:", e)
-            print("Due to a model limit rate error, pausing for 1 minute. The model will be retried after 1 minute.")
-            time.sleep(60)
     
             if attempts == max_attempts:
                 print("Maximum number of attempts reached, terminating the program.")
                 raise  # Re-raise the last exception
             else:
-                print("Retrying...")
+                # Back off before the next attempt, honouring the Retry-After time of a rate limit error
+                delay = register_retry("gpt-4-0613", e, attempts - 1)
+                print("Retrying in %.1f seconds..." % delay)
     return functions
 
 
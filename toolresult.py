@@ -0,0 +1,135 @@
+import json
+import numpy as np
+import pandas as pd
+from tokenizer import get_encoding
+
+# Default maximum number of tokens of the content of a function message, longer results are cut in the middle
+DEFAULT_RESULT_TOKENS = 1000
+# Items of a list, tuple, set or dictionary shown before it is truncated
+MAX_RESULT_ITEMS = 20
+# Rows shown at the head and at the tail of a DataFrame or Series
+SAMPLE_ROWS = 5
+# Share of the token cap kept from the start of a result, the rest is kept from its end
+HEAD_SHARE = 0.75
+
+
+def summarize_dataframe(df, sample_rows=SAMPLE_ROWS):
+    """
+    Summarize a DataFrame for the model instead of printing it whole: its shape, the dtype and missing values of each column,
+    the first and last rows, and the summary statistics of the numeric columns.
+    :param df: Required parameter, the DataFrame to summarize.
+    :param sample_rows: Optional parameter, the number of rows shown at the head and at the tail.
+    :return: The summary as a string.
+    """
+    lines = ["DataFrame with %d rows and %d columns" % df.shape]
+    if df.shape[1]:
+        columns = pd.DataFrame({"dtype": df.dtypes.astype(str), "missing": df.isna().sum()})
+        lines.append("Columns:\n%s" % columns.to_string())
+    if len(df) <= 2 * sample_rows:
+        lines.append("Rows:\n%s" % df.to_string())
+    else:
+        lines.append("First %d rows:\n%s" % (sample_rows, df.head(sample_rows).to_string()))
+        lines.append("Last %d rows:\n%s" % (sample_rows, df.tail(sample_rows).to_string()))
+    numeric = df.select_dtypes(include="number")
+    if numeric.shape[1] and len(df) > 2 * sample_rows:
+        lines.append("Summary statistics:\n%s" % numeric.describe().T.to_string())
+    return "\n".join(lines)
+
+
+def summarize_series(series, sample_rows=SAMPLE_ROWS):
+    """
+    Summarize a Series like summarize_dataframe: its length and dtype, the first and last values, and its summary statistics.
+    """
+    if len(series) <= 2 * sample_rows:
+        return "Series %s of length %d, dtype %s:\n%s" % (series.name, len(series), series.dtype, series.to_string())
+    lines = ["Series %s of length %d, dtype %s, %d missing" % (series.name, len(series), series.dtype, series.isna().sum()),
+             "First %d values:\n%s" % (sample_rows, series.head(sample_rows).to_string()),
+             "Last %d values:\n%s" % (sample_rows, series.tail(sample_rows).to_string())]
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        lines.append("Summary statistics:\n%s" % series.describe().to_string())
+    else:
+        lines.append("Most frequent values:\n%s" % series.value_counts().head(sample_rows).to_string())
+    return "\n".join(lines)
+
+
+def _item_text(item, max_items):
+    # Strings inside a collection keep their quotes, as with str() of the collection
+    return repr(item) if isinstance(item, str) else compact_value(item, max_items)
+
+
+def compact_value(value, max_items=MAX_RESULT_ITEMS):
+    """
+    Convert a value created by an external function into the text sent to the model: DataFrames and Series are summarized,
+    long arrays, lists, tuples, sets and dictionaries are truncated with their item counts, other values are converted with str().
+    :param value: Required parameter, the value to convert.
+    :param max_items: Optional parameter, the number of items shown before a collection is truncated.
+    :return: The text of the value.
+    """
+    if isinstance(value, pd.DataFrame):
+        return summarize_dataframe(value)
+    if isinstance(value, pd.Series):
+        return summarize_series(value)
+    if isinstance(value, np.ndarray):
+        if value.size <= max_items:
+            return str(value)
+        text = "array of shape %s, dtype %s, first items %s" % (value.shape, value.dtype, value.ravel()[:max_items].tolist())
+        if np.issubdtype(value.dtype, np.number):
+            text += ", min %s, max %s, mean %s" % (value.min(), value.max(), value.mean())
+        return text
+    if isinstance(value, dict):
+        items = ["%r: %s" % (key, _item_text(item, max_items)) for key, item in list(value.items())[:max_items]]
+        if len(value) > max_items:
+            items.append("... (%d more items, %d in total)" % (len(value) - max_items, len(value)))
+        return "{%s}" % ", ".join(items)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [_item_text(item, max_items) for item in list(value)[:max_items]]
+        if len(value) > max_items:
+            items.append("... (%d more items, %d in total)" % (len(value) - max_items, len(value)))
+        brackets = "[]" if isinstance(value, list) else "()" if isinstance(value, tuple) else "{}"
+        return brackets[0] + ", ".join(items) + brackets[1]
+    return str(value)
+
+
+def compact_rows(rows, max_rows=MAX_RESULT_ITEMS):
+    """
+    Convert the rows fetched by a SQL query into JSON, keeping the first max_rows rows and the number of rows left out.
+    """
+    rows = list(rows)
+    if len(rows) <= max_rows:
+        return json.dumps(rows, default=str)
+    return "%s\n... (showing the first %d of %d rows)" % (json.dumps(rows[:max_rows], default=str), max_rows, len(rows))
+
+
+def cap_tokens(text, max_tokens=DEFAULT_RESULT_TOKENS, model="gpt-3.5-turbo"):
+    """
+    Cut a text to at most about max_tokens tokens, keeping its start and its end, so that an error message at the end of a long output is kept.
+    :param text: Required parameter, the text to cut.
+    :param max_tokens: Optional parameter, the maximum number of tokens, None for no limit.
+    :param model: Optional parameter, the model whose tokenizer counts the tokens.
+    :return: The text itself if it is short enough, otherwise its start and end around the number of tokens left out.
+    """
+    if max_tokens is None or len(text) <= max_tokens:
+        return text
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    head_count = int(max_tokens * HEAD_SHARE)
+    tail_count = max_tokens - head_count
+    return "%s\n... (%d tokens left out) ...\n%s" % (encoding.decode(tokens[:head_count]),
+                                                      len(tokens) - head_count - tail_count,
+                                                      encoding.decode(tokens[len(tokens) - tail_count:]))
+
+
+def compact_tool_result(function_response, max_tokens=DEFAULT_RESULT_TOKENS):
+    """
+    Compaction stage of the result of an external function before it becomes the content of a function message, which is sent again with every later request:
+    a result that is not a string is converted with compact_value, and the text is cut to max_tokens tokens.
+    """
+    if not isinstance(function_response, str):
+        function_response = compact_value(function_response)
+    return cap_tokens(function_response, max_tokens)
+
+
+if __name__ == '__main__':
+    print("this file contains the compaction of the results of the external functions")
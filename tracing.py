@@ -0,0 +1,266 @@
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+
+# Upper bounds of the buckets of the span duration histogram, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Span():
+    """
+    The Span class records one timed operation of a turn, e.g. a model call, an external function call or a debug round:
+    its wall-clock start and duration, its parent span and attributes such as prompt_tokens, completion_tokens, request_bytes and response_bytes.
+    """
+    __slots__ = ('name', 'span_id', 'parent_id', 'start', 'duration', 'attributes', '_start_counter')
+
+    def __init__(self, name, parent_id=None, attributes=None):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.duration = None
+        self.attributes = attributes or {}
+        self._start_counter = time.perf_counter()
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, **attributes):
+        # A span is only ended once, later calls only add attributes
+        self.attributes.update(attributes)
+        if self.duration is None:
+            self.duration = time.perf_counter() - self._start_counter
+
+    def to_dict(self):
+        return {"name": self.name,
+                "span_id": self.span_id,
+                "parent_id": self.parent_id,
+                "start": self.start,
+                "duration": self.duration,
+                "attributes": self.attributes}
+
+
+class Trace():
+    """
+    The Trace class collects the spans of one turn. Spans opened with the span() context manager are nested in the span opened before them
+    in the same thread, other spans belong to the root span of the turn. Spans can be added from several threads.
+    """
+    enabled = True
+
+    def __init__(self, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.attributes = attributes
+        self.spans = []
+        self.root = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def start_span(self, name, **attributes):
+        """
+        Open a span, ended by span.end(). The first span of the trace is its root span.
+        """
+        stack = self._stack()
+        if stack:
+            parent_id = stack[-1].span_id
+        else:
+            parent_id = self.root.span_id if self.root is not None else None
+        span = Span(name, parent_id, attributes)
+        with self._lock:
+            if self.root is None:
+                self.root = span
+            self.spans.append(span)
+        return span
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Open a span for the duration of a with block. An exception raised in the block is recorded in the error attribute and raised again.
+        """
+        span = self.start_span(name, **attributes)
+        stack = self._stack()
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error="%s: %s" % (type(e).__name__, e))
+            raise
+        finally:
+            stack.pop()
+            span.end()
+
+    def finish(self, **attributes):
+        """
+        End the root span and every span still open, e.g. a model call interrupted by an exception.
+        """
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            if span.duration is None and span is not self.root:
+                span.end(unfinished=True)
+        if self.root is not None:
+            self.root.end(**attributes)
+
+    def to_dicts(self):
+        with self._lock:
+            spans = list(self.spans)
+        dicts = []
+        for span in spans:
+            span_dict = span.to_dict()
+            span_dict["trace_id"] = self.trace_id
+            span_dict["trace"] = self.attributes
+            dicts.append(span_dict)
+        return dicts
+
+    def write_jsonl(self, file):
+        """
+        Write the spans of the trace to a text file, one JSON object per line.
+        """
+        for span in self.to_dicts():
+            file.write(json.dumps(span, ensure_ascii=False, default=str) + '\n')
+
+
+class NullSpan():
+    """
+    Span of a NullTrace, recording nothing.
+    """
+    name = None
+    span_id = None
+    attributes = {}
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, **attributes):
+        pass
+
+
+class NullTrace():
+    """
+    The NullTrace class is used when tracing is disabled: it has the methods of Trace and records nothing.
+    Code computing costly attributes, such as payload sizes, checks trace.enabled first.
+    """
+    enabled = False
+    spans = []
+
+    def start_span(self, name, **attributes):
+        return NULL_SPAN
+
+    @contextmanager
+    def span(self, name, **attributes):
+        yield NULL_SPAN
+
+    def finish(self, **attributes):
+        pass
+
+    def to_dicts(self):
+        return []
+
+
+NULL_SPAN = NullSpan()
+NULL_TRACE = NullTrace()
+
+# One lock per JSONL file, so that concurrent sessions write whole traces
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+
+def append_trace(path, trace):
+    """
+    Append the spans of a trace to a JSONL file, shared by the sessions of the process.
+    """
+    with _file_locks_lock:
+        lock = _file_locks.setdefault(path, threading.Lock())
+    with lock:
+        with open(path, 'a', encoding='utf-8') as f:
+            trace.write_jsonl(f)
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class TraceMetrics():
+    """
+    The TraceMetrics class aggregates the spans of many turns into counters and histograms, exported in the Prometheus text format by to_prometheus():
+    mategen_spans_total, mategen_span_errors_total, mategen_tokens_total, mategen_payload_bytes_total and mategen_span_duration_seconds,
+    labelled by span name and external function.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.spans = {}
+        self.errors = {}
+        self.tokens = {}
+        self.payload_bytes = {}
+        # labels -> [bucket counts, sum, count]
+        self.durations = {}
+
+    def observe(self, trace):
+        """
+        Add the finished spans of a trace to the counters and histograms.
+        """
+        with self._lock:
+            for span in trace.spans:
+                if span.duration is None:
+                    continue
+                labels = (span.name, span.attributes.get("function") or '')
+                self.spans[labels] = self.spans.get(labels, 0) + 1
+                if span.attributes.get("error"):
+                    self.errors[labels] = self.errors.get(labels, 0) + 1
+                for kind in ("prompt", "completion"):
+                    tokens = span.attributes.get(kind + "_tokens")
+                    if tokens:
+                        self.tokens[labels + (kind,)] = self.tokens.get(labels + (kind,), 0) + tokens
+                for direction in ("request", "response"):
+                    size = span.attributes.get(direction + "_bytes")
+                    if size:
+                        self.payload_bytes[labels + (direction,)] = self.payload_bytes.get(labels + (direction,), 0) + size
+                histogram = self.durations.setdefault(labels, [[0] * len(self.buckets), 0.0, 0])
+                for index, bound in enumerate(self.buckets):
+                    if span.duration <= bound:
+                        histogram[0][index] += 1
+                histogram[1] += span.duration
+                histogram[2] += 1
+
+    def to_prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+
+        def counter(name, help_text, values, label_names):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s counter" % name)
+            for labels, value in sorted(values.items()):
+                label_str = ",".join('%s="%s"' % (label, _label_value(v)) for label, v in zip(label_names, labels))
+                lines.append("%s{%s} %s" % (name, label_str, value))
+
+        with self._lock:
+            counter("mategen_spans_total", "Number of finished spans.", self.spans, ("span", "function"))
+            counter("mategen_span_errors_total", "Number of spans that recorded an error.", self.errors, ("span", "function"))
+            counter("mategen_tokens_total", "Prompt and completion tokens of the spans.", self.tokens, ("span", "function", "type"))
+            counter("mategen_payload_bytes_total", "Request and response payload bytes of the spans.", self.payload_bytes, ("span", "function", "direction"))
+
+            name = "mategen_span_duration_seconds"
+            lines.append("# HELP %s Wall-clock duration of the spans." % name)
+            lines.append("# TYPE %s histogram" % name)
+            for (span_name, function), (bucket_counts, total, count) in sorted(self.durations.items()):
+                label_str = 'span="%s",function="%s"' % (_label_value(span_name), _label_value(function))
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, label_str, bound, bucket_count))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, label_str, count))
+                lines.append('%s_sum{%s} %s' % (name, label_str, total))
+                lines.append('%s_count{%s} %d' % (name, label_str, count))
+        return "\n".join(lines) + "\n"
+
+
+if __name__ == '__main__':
+    print("this file contains the spans, traces and metrics of the agent")
@@ -0,0 +1,157 @@
+import time
+from collections import deque
+from tracing import NULL_TRACE
+
+# States of the turn loop run by get_chat_response
+# respond: call the Chat model, review_text: review a text answer, review_code: review and run a function call, check_result: review the function result,
+# sample_fixes: request several candidate fixes of a failed function call at once and run them in parallel (fast debug mode)
+STATE_RESPOND = "respond"
+STATE_REVIEW_TEXT = "review_text"
+STATE_REVIEW_CODE = "review_code"
+STATE_CHECK_RESULT = "check_result"
+STATE_SAMPLE_FIXES = "sample_fixes"
+STATE_DONE = "done"
+
+# Default maximum number of steps of a single turn, a turn reaching it is stopped
+MAX_TURN_STEPS = 50
+
+
+class TurnStep():
+    """
+    The TurnStep class is a compact record of one step of a turn. It keeps no reference to the messages of the conversation,
+    so the record of a turn stays small however many steps the turn takes.
+    """
+    __slots__ = ('index', 'state', 'next_state', 'function_name', 'tokens_count', 'duration')
+
+    def __init__(self, index, state, next_state, function_name, tokens_count, duration):
+        self.index = index
+        self.state = state
+        self.next_state = next_state
+        self.function_name = function_name
+        self.tokens_count = tokens_count
+        self.duration = duration
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return "TurnStep(%d, %s -> %s, function=%s, tokens=%s, %.3fs)" % (
+            self.index, self.state, self.next_state, self.function_name, self.tokens_count, self.duration)
+
+
+class TurnRecord():
+    """
+    The TurnRecord class keeps the steps of one turn, so that a turn can be inspected after it finished: which states it went through,
+    which external functions it called, how the prompt grew and how long each step took.
+    """
+
+    def __init__(self, max_steps=MAX_TURN_STEPS):
+        """
+        :param max_steps: Optional parameter, the maximum number of steps of the turn.
+        """
+        self.max_steps = max_steps
+        self.steps = []
+        # True if the turn was stopped because it reached max_steps
+        self.stopped = False
+        # Wall-clock time from a failed function call to a working fix, for each debug run of the turn
+        self.debug_timings = []
+
+    @property
+    def exhausted(self):
+        return len(self.steps) >= self.max_steps
+
+    def add(self, state, next_state, function_name, tokens_count, duration):
+        self.steps.append(TurnStep(len(self.steps), state, next_state, function_name, tokens_count, duration))
+
+    def add_debug_timing(self, mode, time_to_fix, fixed, candidates=None):
+        self.debug_timings.append({"mode": mode, "time_to_fix": time_to_fix, "fixed": fixed, "candidates": candidates})
+
+    def to_list(self):
+        return [step.to_dict() for step in self.steps]
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __repr__(self):
+        return "TurnRecord(%d steps, max_steps=%d, stopped=%s)" % (len(self.steps), self.max_steps, self.stopped)
+
+
+class TurnState():
+    """
+    The TurnState class holds the state of a turn between the steps of the turn loop: the current state, the messages of the conversation and the
+    message being reviewed. Each step function reads it and sets the next state, instead of calling the next step recursively.
+    """
+
+    def __init__(self,
+                 messages,
+                 is_enhanced_mode=False,
+                 is_task_decomposition=False,
+                 delete_some_messages=False,
+                 record=None,
+                 debug_candidates=0,
+                 policy=None,
+                 sink=None,
+                 namespace=None,
+                 trace=None,
+                 governor=None,
+                 result_tokens=None):
+        self.state = STATE_RESPOND
+        self.messages = messages
+        self.is_enhanced_mode = is_enhanced_mode
+        self.is_task_decomposition = is_task_decomposition
+        # Number of intermediate messages to delete after the next model response
+        self.delete_some_messages = delete_some_messages
+        # Message returned by the model and result of the external function
+        self.response_message = None
+        self.function_response_message = None
+        # Debug prompts still to be sent, one per sub-turn of the debug agent
+        self.debug_prompts = deque()
+        # Number of candidate fixes requested at once in fast debug mode, 0 for the sequential debug agent only
+        self.debug_candidates = debug_candidates
+        # True once the candidate fixes of the current error all failed, the sequential debug agent is then used
+        self.sampling_failed = False
+        # Start time of the current debug run, to measure the time to a working fix
+        self.debug_started = None
+        self.record = record if record is not None else TurnRecord()
+        # Interaction policy taking the decisions of the turn and output sink receiving its output
+        self.policy = policy
+        self.sink = sink
+        # Namespace in which the external functions create their variables, None for the globals of the response module
+        self.namespace = namespace
+        # Trace in which the spans of the turn are recorded, and the span of the current debug round
+        self.trace = trace if trace is not None else NULL_TRACE
+        self.debug_span = None
+        self.debug_rounds = 0
+        # BudgetGovernor enforcing the token, model call, time and cost budgets, None for no budget
+        self.governor = governor
+        # Maximum number of tokens of the result of an external function, None for no limit
+        self.result_tokens = result_tokens
+        self._step_start = None
+
+    def finish(self):
+        # A debug run still open when the turn ends did not reach a working fix
+        if self.debug_started is not None:
+            mode = "parallel+sequential" if self.sampling_failed else "sequential"
+            self.record.add_debug_timing(mode, time.perf_counter() - self.debug_started, False)
+            self.debug_started = None
+        if self.debug_span is not None:
+            self.debug_span.end(fixed=False)
+            self.debug_span = None
+
+    def start_step(self):
+        self._step_start = time.perf_counter()
+        return self.state
+
+    def end_step(self, state):
+        # Record the finished step, without keeping any message
+        function_name = None
+        if self.response_message is not None and self.response_message.get("function_call"):
+            function_name = self.response_message["function_call"].get("name")
+        self.record.add(state, self.state, function_name, self.messages.tokens_count, time.perf_counter() - self._step_start)
+
+
+if __name__ == '__main__':
+    print("this file contains the state of the turn loop")